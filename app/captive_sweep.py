@@ -0,0 +1,151 @@
+"""
+Captive sweep: finds observations whose wildness (captive) has changed on iNaturalist since they were pushed to the DW, and pushes them again.
+
+iNat does not count a change of captive as an update, so the incremental sync misses it. Ids of all current captive observations are paged from the iNat API with only_id=true and captive=true, and compared to the registry of ids last pushed to the target as captive (see registry.py, kept up to date by inat.py in auto and daemon modes). Observations that are captive on iNat but were pushed as wild, or the other way round, are fetched, converted and pushed again, and the registry is updated from what was pushed, as in inat.py. Observations that the conversion skips or drops are recorded in the registry with their current flag, as seen, so that they are not fetched again on every sweep; if they later become convertible, their next edit brings them to the incremental sync. Observations that are not found any more are removed from the registry, and left to the deletion sweep (see sweep.py).
+
+Against an empty registry, run would push all captive observations again, so it refuses to start unless --all is given. Use seed instead to only record the current captive ids, if the DW is known to be up to date, e.g. after a full &captive=true re-sync.
+
+Usage:
+python captive_sweep.py <target> run [sleep]    # push changed observations again
+python captive_sweep.py <target> run [sleep] --all  # same, also if the registry is empty
+python captive_sweep.py <target> dry [sleep]    # write changed ids to ./privatedata/captive_changed.csv, no pushes, no registry changes
+python captive_sweep.py <target> seed [sleep]   # record current captive ids in the registry, no pushes
+
+target: staging | production
+"""
+
+import sys
+import atexit
+
+import numpy as np
+
+import getInat
+import inatHelpers
+import inatToDw
+import logger
+import postDw
+import registry
+import taxon_cache
+
+DRY_OUTPUT_FILE = './privatedata/captive_changed.csv'
+
+# Registries are saved after this many pushed batches, so that an interrupted sweep does not push the same observations again
+SAVE_BATCHES = 10
+
+
+def find_changed(recorded_ids, captive_ids):
+    """Find observations whose captive flag differs from the registry.
+
+    Args:
+        recorded_ids (numpy.ndarray): Sorted ids last pushed as captive
+        captive_ids (numpy.ndarray): Sorted ids that are captive on iNat now
+
+    Returns:
+        tuple: Ids that have become captive, and ids that have become wild (or are not found any more)
+    """
+    return np.setdiff1d(captive_ids, recorded_ids), np.setdiff1d(recorded_ids, captive_ids)
+
+
+### SETUP
+
+if len(sys.argv) < 3:
+    raise ValueError("Missing required arguments. Usage: python captive_sweep.py <target> <run|dry|seed> [sleep] [--all]")
+
+push_all = "--all" in sys.argv
+args = [arg for arg in sys.argv if arg != "--all"]
+
+target = args[1]
+command = args[2]
+
+if target not in ("staging", "production"):
+    raise ValueError(f"Invalid target: {target}")
+if command not in ("run", "dry", "seed"):
+    raise ValueError(f"Invalid command: {command}")
+
+logger.setup_logging(False)
+
+if len(args) > 3:
+    try:
+        getInat.rateLimiter.minInterval = max(int(args[3]), 1)
+    except ValueError:
+        getInat.rateLimiter.minInterval = 1
+else:
+    getInat.rateLimiter.minInterval = 1
+
+captiveRegistry = registry.IdRegistry(target, sync_to_allas=True, name=registry.CAPTIVE_IDS).load()
+if command == "run" and len(captiveRegistry) == 0 and not push_all:
+    raise ValueError(f"Captive registry of {target} is empty, so run would push all captive observations again. Record the current captive ids with seed first, or give --all to push them.")
+if command != "dry":
+    atexit.register(captiveRegistry.save)
+
+
+### SWEEP
+
+captive_ids = []
+for page_ids in getInat.getIdsGenerator(0, urlSuffix="&captive=true"):
+    captive_ids.extend(page_ids)
+captive_ids = np.unique(np.asarray(captive_ids, dtype=np.int64))
+logger.log_minimal(f"{len(captive_ids)} captive observations on iNaturalist, {len(captiveRegistry)} in registry of {target}")
+
+if command == "seed":
+    captiveRegistry.remove(captiveRegistry.ids())
+    captiveRegistry.add(int(observationId) for observationId in captive_ids)
+    logger.log_minimal(f"Recorded {len(captive_ids)} captive ids in registry of {target}")
+    sys.exit(0)
+
+became_captive, became_wild = find_changed(captiveRegistry.ids(), captive_ids)
+changed_ids = [int(observationId) for observationId in np.union1d(became_captive, became_wild)]
+logger.log_minimal(f"Captive flag changed: {len(became_captive)} observations became captive, {len(became_wild)} became wild or were not found")
+
+captive_now = set(became_captive.tolist())
+
+if command == "dry":
+    with open(DRY_OUTPUT_FILE, 'w') as file:
+        file.write("id,captive\n")
+        file.writelines(f"{observationId},{observationId in captive_now}\n" for observationId in changed_ids)
+    logger.log_minimal(f"Changed ids written to {DRY_OUTPUT_FILE}")
+    sys.exit(0)
+
+if not changed_ids:
+    sys.exit(0)
+
+privateObservationData = inatHelpers.load_private_observations()
+private_emails = inatHelpers.load_private_emails()
+taxon_cache.enable()
+
+pushedRegistry = registry.IdRegistry(target, sync_to_allas=True).load()
+atexit.register(pushedRegistry.save)
+
+pushed_count = 0
+not_found_count = 0
+skipped_count = 0
+batch = 0
+
+try:
+    for idGroup, observations in getInat.getMultiple(changed_ids):
+        dwObservations = inatToDw.convertObservations(observations, privateObservationData, private_emails)[0]
+        pushedIds = registry.document_ids_to_observation_ids(dwObservations)
+        if pushedIds:
+            postDw.postMulti(dwObservations, target)
+            pushedRegistry.add(pushedIds)
+            captiveRegistry.update(pushedIds, registry.captive_observation_ids(dwObservations))
+            pushed_count += len(pushedIds)
+
+        # Skipped and dropped observations are recorded as seen, with their current flag
+        foundIds = {inat["id"] for inat in observations}
+        skippedIds = foundIds.difference(pushedIds)
+        captiveRegistry.update(skippedIds, skippedIds & captive_now)
+        skipped_count += len(skippedIds)
+        captiveRegistry.remove(observationId for observationId in idGroup if observationId not in foundIds)
+        not_found_count += len(idGroup) - len(foundIds)
+
+        batch += 1
+        if batch % SAVE_BATCHES == 0:
+            captiveRegistry.save()
+            pushedRegistry.save()
+
+except Exception as e:
+    logger.log_minimal(f"Error during captive sweep: {str(e)}")
+    sys.exit(1)
+
+logger.log_minimal(f"Captive sweep finished: {pushed_count} observations pushed to {target}, {skipped_count} skipped, {not_found_count} not found on iNaturalist")
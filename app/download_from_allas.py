@@ -4,11 +4,23 @@ Downloads data files from Allas S3 object storage at container startup.
 This script runs before the main ETL process to ensure the data files are available locally.
 """
 
+import json
 import os
 import sys
 import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
 
+
+def _create_s3_client():
+    """Create an S3 client for Allas from the ALLAS_ENDPOINT, ALLAS_ACCESS_KEY and ALLAS_SECRET_KEY environment variables."""
+    return boto3.client(
+        's3',
+        endpoint_url=os.getenv('ALLAS_ENDPOINT'),
+        aws_access_key_id=os.getenv('ALLAS_ACCESS_KEY'),
+        aws_secret_access_key=os.getenv('ALLAS_SECRET_KEY')
+    )
+
+
 def download_file(s3_client, bucket, object_key, local_path):
     """Download a single file from Allas S3 storage."""
     print(f"Downloading {object_key} from bucket {bucket}...")
@@ -91,12 +103,7 @@ def download_from_allas(skip_state_file=False):
     
     # Initialize S3 client for Allas
     try:
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=allas_endpoint,
-            aws_access_key_id=allas_access_key,
-            aws_secret_access_key=allas_secret_key
-        )
+        s3_client = _create_s3_client()
     except Exception as e:
         print(f"Error: Failed to initialize S3 client: {str(e)}", file=sys.stderr)
         sys.exit(1)
@@ -114,5 +121,173 @@ def download_from_allas(skip_state_file=False):
         print("Error: One or more files failed to download", file=sys.stderr)
         sys.exit(1)
 
+    # Optional delta of private observation data, see tools/private_delta.py
+    allas_object_key_delta = os.getenv('ALLAS_OBJECT_KEY_DELTA')
+    local_file_path_delta = os.getenv('LOCAL_DATA_PATH_DELTA')
+    if allas_object_key_delta and local_file_path_delta:
+        if _get_etag(s3_client, allas_bucket, allas_object_key_delta) is None:
+            print(f"No private data delta {allas_object_key_delta} in Allas")
+        elif not download_file(s3_client, allas_bucket, allas_object_key_delta, local_file_path_delta):
+            print("Error: Private data delta failed to download", file=sys.stderr)
+            sys.exit(1)
+
+
+def state_bucket_configured():
+    """Check whether the environment variables of the Allas state bucket are set."""
+    return all([os.getenv('ALLAS_ENDPOINT'), os.getenv('ALLAS_ACCESS_KEY'), os.getenv('ALLAS_SECRET_KEY'), os.getenv('ALLAS_STATE_BUCKET')])
+
+
+def download_state_object(object_key, local_path):
+    """Download an optional object from the Allas state bucket.
+
+    Args:
+        object_key (str): Object key in the state bucket
+        local_path (str): Local path to save the object to
+
+    Returns:
+        bool: True if downloaded, False if the object does not exist or Allas is not configured
+    """
+    allas_state_bucket = os.getenv('ALLAS_STATE_BUCKET')
+    if not state_bucket_configured():
+        print(f"Allas is not configured, not downloading {object_key}")
+        return False
+
+    local_dir = os.path.dirname(local_path)
+    if local_dir and not os.path.exists(local_dir):
+        os.makedirs(local_dir, exist_ok=True)
+
+    s3_client = _create_s3_client()
+    return download_file(s3_client, allas_state_bucket, object_key, local_path)
+
+
+def list_state_objects(prefix):
+    """List object keys in the Allas state bucket that start with prefix.
+
+    Args:
+        prefix (str): Object key prefix
+
+    Returns:
+        list: Object keys in ascending order, empty if Allas is not configured
+    """
+    allas_state_bucket = os.getenv('ALLAS_STATE_BUCKET')
+    if not state_bucket_configured():
+        return []
+
+    s3_client = _create_s3_client()
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=allas_state_bucket, Prefix=prefix):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+    return sorted(keys)
+
+
+def read_json_object(object_key):
+    """Read a JSON object from the Allas state bucket.
+
+    Args:
+        object_key (str): Object key in the state bucket
+
+    Raises:
+        Exception: If Allas is not configured or the object cannot be read
+
+    Returns:
+        dict: Data, or None if the object does not exist
+    """
+    allas_state_bucket = os.getenv('ALLAS_STATE_BUCKET')
+    if not state_bucket_configured():
+        raise Exception("Missing required Allas configuration. Check environment variables.")
+
+    s3_client = _create_s3_client()
+    try:
+        response = s3_client.get_object(Bucket=allas_state_bucket, Key=object_key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+def _private_data_objects():
+    """Get S3 client, bucket and (object key, local path) pairs of private data files, or None if Allas is not configured."""
+    allas_endpoint = os.getenv('ALLAS_ENDPOINT')
+    allas_access_key = os.getenv('ALLAS_ACCESS_KEY')
+    allas_secret_key = os.getenv('ALLAS_SECRET_KEY')
+    allas_bucket = os.getenv('ALLAS_BUCKET')
+    objects = [
+        (os.getenv('ALLAS_OBJECT_KEY'), os.getenv('LOCAL_DATA_PATH')),
+        (os.getenv('ALLAS_OBJECT_KEY_2'), os.getenv('LOCAL_DATA_PATH_2')),
+    ]
+    optional_objects = [
+        (os.getenv('ALLAS_OBJECT_KEY_DELTA'), os.getenv('LOCAL_DATA_PATH_DELTA')),
+    ]
+
+    if not all([allas_endpoint, allas_access_key, allas_secret_key, allas_bucket]) or not all(key and path for key, path in objects):
+        return None
+
+    s3_client = _create_s3_client()
+    objects += [(key, path) for key, path in optional_objects if key and path]
+    return s3_client, allas_bucket, objects
+
+
+def _get_etag(s3_client, bucket, object_key):
+    """Get ETag of an object, or None if the object does not exist."""
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=object_key)['ETag']
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return None
+        raise
+
+
+def get_private_data_etags():
+    """Get ETags of private data files in Allas.
+
+    Returns:
+        dict: ETag by object key, empty if Allas is not configured
+    """
+    config = _private_data_objects()
+    if config is None:
+        return {}
+
+    s3_client, allas_bucket, objects = config
+    etags = {}
+    for object_key, local_path in objects:
+        etags[object_key] = _get_etag(s3_client, allas_bucket, object_key)
+    return etags
+
+
+def refresh_private_data(known_etags):
+    """Download private data files whose ETag in Allas differs from the known ETag.
+
+    Used by the daemon to reload private data only when it has been updated, without downloading it on every cycle.
+
+    Args:
+        known_etags (dict): ETag by object key, from get_private_data_etags() or a previous call
+
+    Raises:
+        Exception: If a changed file fails to download
+
+    Returns:
+        dict: ETags of the files now on disk. Equal to known_etags if nothing changed.
+    """
+    config = _private_data_objects()
+    if config is None:
+        return known_etags
+
+    s3_client, allas_bucket, objects = config
+    etags = dict(known_etags)
+    for object_key, local_path in objects:
+        etag = _get_etag(s3_client, allas_bucket, object_key)
+        if etag == known_etags.get(object_key):
+            continue
+        if etag is None:
+            # Optional file has been removed from Allas
+            if os.path.exists(local_path):
+                os.remove(local_path)
+        elif not download_file(s3_client, allas_bucket, object_key, local_path):
+            raise Exception(f"Failed to download changed private data file {object_key}")
+        etags[object_key] = etag
+    return etags
+
+
 if __name__ == '__main__':
     download_from_allas()
@@ -0,0 +1,72 @@
+"""
+File target: writes converted observations to files instead of posting them to the DW.
+
+Used with inat.py target "file", to measure the throughput of the full fetch-and-convert pipeline, or to diff the output of a mapping change before a release. Roots are written as gzip-compressed NDJSON, one root per line, to numbered part files under INAT_FILE_TARGET_DIR/<run id>/. Note that the output includes private documents.
+"""
+
+import gzip
+import json
+import os
+import time
+
+import logger
+
+FILE_TARGET_DIR = os.getenv("INAT_FILE_TARGET_DIR", "./privatedata/file-target")
+
+# Roots per part file
+ROOTS_PER_FILE = 100000
+
+
+class FileSink:
+    """Writes roots to partitioned, compressed NDJSON files.
+
+    Args:
+        output_dir (str): Directory for the run directory
+        roots_per_file (int): Roots per part file
+    """
+
+    def __init__(self, output_dir=FILE_TARGET_DIR, roots_per_file=ROOTS_PER_FILE):
+        self.directory = os.path.join(output_dir, logger.RUN_ID)
+        self.roots_per_file = roots_per_file
+        self.root_count = 0
+        self.part_count = 0
+        self._file = None
+        self._part_root_count = 0
+        self._started = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self, dwObservations):
+        """Write roots of a converted page.
+
+        Args:
+            dwObservations (dict): Observations in FinBIF DW format
+
+        Returns:
+            bool: True, like postDw.postMulti()
+        """
+        for root in dwObservations["roots"]:
+            if self._file is None:
+                self._open_part()
+            self._file.write(json.dumps(root, ensure_ascii=False) + "\n")
+            self._part_root_count += 1
+            self.root_count += 1
+            if self._part_root_count >= self.roots_per_file:
+                self._close_part()
+        return True
+
+    def close(self):
+        """Close the current part file and log the totals."""
+        self._close_part()
+        seconds = time.monotonic() - self._started
+        logger.log_minimal(f"Wrote {self.root_count} roots to {self.part_count} files in {self.directory}, {self.root_count / seconds if seconds else 0:.1f} roots/s")
+
+    def _open_part(self):
+        self.part_count += 1
+        path = os.path.join(self.directory, f"part-{self.part_count:05d}.ndjson.gz")
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._part_root_count = 0
+
+    def _close_part(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,138 @@
+"""
+End-to-end freshness latency: time from a change on iNat to its successful post to a target.
+
+Latency of each posted observation is measured from its created_at if it is new, i.e. created after the start cursor of the cycle, and from its updated_at otherwise. It is split into components that add up to the total:
+
+wait     From the change on iNat until the page was requested (time between runs, earlier pages, sleep between requests)
+fetch    Request of the page, until the response was received
+convert  Sleep between requests and conversion of the page
+queue    Waiting for the pusher of the target, behind earlier pages
+post     Post of the page to the target
+
+Each target counts separately. Latencies are collected into histograms with logarithmic bins, so that memory use does not grow with the number of observations, and take_summary() returns p50, p90 and p99 of the total and of each component, separately for new and updated observations, for the run history (see run_history.py). Percentiles are upper edges of their bins, i.e. at most about 12 % too high.
+"""
+
+import datetime
+import threading
+import time
+import urllib.parse
+
+import numpy
+
+import registry
+
+KINDS = ("new", "updated")
+COMPONENTS = ("total", "wait", "fetch", "convert", "queue", "post")
+PERCENTILES = (50, 90, 99)
+
+# Bin edges in seconds: 20 bins per decade from 10 ms to about three years
+BIN_EDGES = numpy.logspace(-2, 8, 201)
+
+_lock = threading.Lock()
+_histograms = {}
+_max = {}
+
+
+def _reset():
+    global _histograms, _max
+    _histograms = {(kind, component): numpy.zeros(len(BIN_EDGES) + 1, dtype=numpy.int64) for kind in KINDS for component in COMPONENTS}
+    _max = dict.fromkeys(KINDS, 0.0)
+
+
+_reset()
+
+
+def _timestamp(value):
+    """Parse created_at or updated_at of the API to epoch seconds, or None if it is missing or invalid."""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(urllib.parse.unquote(value)).timestamp()
+    except ValueError:
+        return None
+
+
+class PageTiming:
+    """Times of a page, created right after the page has been converted, and handed to the pushers with it.
+
+    Args:
+        inatResponseDict (dict): Page from the API, with "fetch_times" set by getInat.getPageFromAPI()
+        dwObservations (dict): Converted observations of the page
+        since (datetime): Start cursor of the cycle. Observations created after it are new.
+    """
+
+    def __init__(self, inatResponseDict, dwObservations, since):
+        self.converted = time.time()
+        self.fetchStarted, self.fetched = inatResponseDict.get("fetch_times") or (self.converted, self.converted)
+        sinceTimestamp = since.timestamp() if since is not None else None
+        postedIds = set(registry.document_ids_to_observation_ids(dwObservations))
+        changed = {kind: [] for kind in KINDS}
+        for inat in inatResponseDict["results"]:
+            if inat["id"] not in postedIds:
+                continue
+            created = _timestamp(inat.get("created_at"))
+            if created is not None and sinceTimestamp is not None and created > sinceTimestamp:
+                changed["new"].append(created)
+            else:
+                updated = _timestamp(inat.get("updated_at"))
+                if updated is not None:
+                    changed["updated"].append(updated)
+        self.changed = {kind: numpy.array(times) for kind, times in changed.items()}
+
+
+def observe(timing, postStarted, posted):
+    """Add latencies of a page that was posted successfully to a target.
+
+    Args:
+        timing (PageTiming): Times of the page
+        postStarted (float): Epoch seconds when the post was started
+        posted (float): Epoch seconds when the post was finished
+    """
+    components = {
+        "fetch": timing.fetched - timing.fetchStarted,
+        "convert": timing.converted - timing.fetched,
+        "queue": postStarted - timing.converted,
+        "post": posted - postStarted,
+    }
+    with _lock:
+        for kind, changed in timing.changed.items():
+            if not len(changed):
+                continue
+            # Clock skew between iNat and this host can make a change look like it happened after the request
+            wait = numpy.maximum(timing.fetchStarted - changed, 0)
+            total = wait + (posted - timing.fetchStarted)
+            _histograms[(kind, "total")] += numpy.bincount(numpy.searchsorted(BIN_EDGES, total), minlength=len(BIN_EDGES) + 1)
+            _histograms[(kind, "wait")] += numpy.bincount(numpy.searchsorted(BIN_EDGES, wait), minlength=len(BIN_EDGES) + 1)
+            for component, seconds in components.items():
+                _histograms[(kind, component)][numpy.searchsorted(BIN_EDGES, max(seconds, 0))] += len(changed)
+            _max[kind] = max(_max[kind], float(total.max()))
+
+
+def _percentile(histogram, percentile):
+    """Upper edge of the bin that contains the percentile, in seconds."""
+    index = int(numpy.searchsorted(numpy.cumsum(histogram), percentile / 100 * histogram.sum()))
+    return round(float(BIN_EDGES[min(index, len(BIN_EDGES) - 1)]), 2)
+
+
+def take_summary():
+    """Return latency percentiles since the previous call, and reset them.
+
+    Returns:
+        dict: For new and updated observations, "count", "max" and percentiles "p50", "p90" and "p99" of the total latency in seconds, and "components" with the percentiles of each component. Kinds without posted observations are left out.
+    """
+    with _lock:
+        histograms = _histograms
+        maximums = _max
+        _reset()
+
+    summary = {}
+    for kind in KINDS:
+        count = int(histograms[(kind, "total")].sum())
+        if not count:
+            continue
+        summary[kind] = {"count": count, "max": round(maximums[kind], 2)}
+        # Upper edge of the bin can be above the longest latency
+        summary[kind].update({f"p{percentile}": min(_percentile(histograms[(kind, "total")], percentile), summary[kind]["max"]) for percentile in PERCENTILES})
+        summary[kind]["components"] = {component: {f"p{percentile}": _percentile(histograms[(kind, component)], percentile) for percentile in PERCENTILES} for component in COMPONENTS if component != "total"}
+    return summary
+
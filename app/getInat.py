@@ -1,33 +1,297 @@
+import copy
+import datetime
+import hashlib
 import os
+import re
 import requests
 import json
 from collections import OrderedDict
 import time
 import logger
 import sys
+import threading
+import urllib.parse
 
-def getPageFromAPI(url):
-  """Get a single pageful of observations from iNat.
+import inatToDw
+import profiling
+import run_history
+
+
+class RateLimiter:
+  """Keeps at least minInterval seconds between the starts of iNat API requests.
+
+  Shared by all requests of the process, including requests made from several threads.
+  """
+
+  def __init__(self, minInterval = 0):
+    self.minInterval = minInterval
+    self._lock = threading.Lock()
+    self._lastRequest = 0.0
+
+  def wait(self):
+    with self._lock:
+      delay = self._lastRequest + self.minInterval - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+      self._lastRequest = time.monotonic()
+
+
+# Shared rate limit for all iNat API requests. Interval is 0 by default, since the generators sleep between pages themselves.
+rateLimiter = RateLimiter()
+
+# Reuse connections to the API between requests, which matters for long-running processes (daemon mode)
+session = requests.Session()
+
+# Opt-in cache of API responses and fixtures of raw responses, for debugging with single.py
+RESPONSE_CACHE_DIR = './store/response-cache'
+FIXTURE_DIR = './store/fixtures'
+responseCache = None
+
+# place_id filter: Finland, Åland & Finland EEZ
+PLACE_FILTER = "place_id=7020%2C10282%2C165234"
+
+# Which observation fields to get from the API:
+# all = full observations from API v1 (default)
+# sparse = only fields in inatToDw.CONSUMED_FIELDS, using the field selection of API v2. Experimental: API v2 can return some fields in other shapes than v1, check with tests/test_fields.py.
+# verify = full observations, but reading a field that is not in inatToDw.CONSUMED_FIELDS raises an exception. Use this to check the field list after changing the conversion.
+FIELDS_MODE = os.getenv("INAT_FIELDS", "all")
+if FIELDS_MODE not in ("all", "sparse", "verify"):
+  raise ValueError(f"Invalid INAT_FIELDS value: {FIELDS_MODE}")
+
+# How updated observations are paged:
+# id = order by id, starting above the latest id, with updated_since set to the start time of the previous run (default)
+# updated = order by updated_at, with an (updated_at, id) cursor. The next run starts from the latest updated_at received, see getUpdatedAtGenerator().
+PAGINATION = os.getenv("INAT_PAGINATION", "id")
+if PAGINATION not in ("id", "updated"):
+  raise ValueError(f"Invalid INAT_PAGINATION value: {PAGINATION}")
+
+
+def fieldsToRison(fields):
+  """Convert a nested field dictionary to the RISON format used by the API v2 fields parameter, e.g. (id:!t,taxon:(name:!t))."""
+  parts = []
+  for name, subfields in fields.items():
+    if isinstance(subfields, dict):
+      parts.append(name + ":" + fieldsToRison(subfields))
+    else:
+      parts.append(name + ":!t")
+  return "(" + ",".join(parts) + ")"
+
+
+def observationsUrl(parameters, fieldsMode = None):
+  """Build observation search URL from query parameters, selecting fields according to FIELDS_MODE.
+
+  Args:
+    parameters (string): Query parameters, without leading "?" or "&".
+    fieldsMode (string): all, sparse or verify, instead of FIELDS_MODE.
+
+  Returns:
+    string: API URL
+  """
+  if "sparse" == (fieldsMode or FIELDS_MODE):
+    return "https://api.inaturalist.org/v2/observations?" + parameters + "&fields=" + urllib.parse.quote(fieldsToRison(inatToDw.CONSUMED_FIELDS), safe="")
+  return "https://api.inaturalist.org/v1/observations?" + parameters
+
+
+class FieldGuard(dict):
+  """Observation dictionary that raises an exception when a field that is not in the given field list is read.
+
+  Used in verify mode, so that a conversion reading a field that would be missing in sparse mode fails immediately, instead of silently behaving differently. Iterating over the fields, e.g. with items() or json.dumps(), and copying give only the listed fields, as in sparse mode.
+  """
+
+  def __init__(self, data, fields, path = ""):
+    super().__init__(data)
+    self._fields = fields
+    self._path = path
+
+  def _check(self, key):
+    if key not in self._fields:
+      raise Exception(f"Conversion read field '{self._path + str(key)}', which is not in inatToDw.CONSUMED_FIELDS")
+
+  def __getitem__(self, key):
+    self._check(key)
+    return guardValue(super().__getitem__(key), self._fields[key], self._path + key + ".")
+
+  def get(self, key, default = None):
+    self._check(key)
+    if super().__contains__(key):
+      return self[key]
+    return default
+
+  def __contains__(self, key):
+    self._check(key)
+    return super().__contains__(key)
+
+  def pop(self, key, *default):
+    self._check(key)
+    return guardValue(super().pop(key, *default), self._fields[key], self._path + key + ".")
+
+  def setdefault(self, key, default = None):
+    self._check(key)
+    return guardValue(super().setdefault(key, default), self._fields[key], self._path + key + ".")
+
+  def _listed(self):
+    return [key for key in super().keys() if key in self._fields]
+
+  def __iter__(self):
+    return iter(self._listed())
+
+  def __len__(self):
+    return len(self._listed())
+
+  def keys(self):
+    return self._listed()
+
+  def values(self):
+    return [self[key] for key in self._listed()]
+
+  def items(self):
+    return [(key, self[key]) for key in self._listed()]
+
+  def copy(self):
+    return FieldGuard({key: super(FieldGuard, self).__getitem__(key) for key in self._listed()}, self._fields, self._path)
+
+  __copy__ = copy
+
+  def __deepcopy__(self, memo):
+    return FieldGuard({key: copy.deepcopy(super(FieldGuard, self).__getitem__(key), memo) for key in self._listed()}, self._fields, self._path)
+
+
+def guardValue(value, fields, path = ""):
+  if not isinstance(fields, dict):
+    return value
+  if isinstance(value, dict):
+    return FieldGuard(value, fields, path)
+  if isinstance(value, list):
+    return [guardValue(item, fields, path) for item in value]
+  return value
+
+
+def selectFields(inatResponseDict):
+  """In verify mode, wrap observations of an API response with FieldGuard."""
+  if "verify" == FIELDS_MODE:
+    inatResponseDict["results"] = [FieldGuard(observation, inatToDw.CONSUMED_FIELDS) for observation in inatResponseDict["results"]]
+  return inatResponseDict
+
+class ResponseCache:
+  """On-disk cache of raw API responses by URL, for iterating on the conversion without fetching the same observations again (see single.py --cache).
+
+  Args:
+    ttlSeconds (int): Responses older than this are fetched again
+    directory (string): Directory of cached responses
+  """
+
+  def __init__(self, ttlSeconds, directory = RESPONSE_CACHE_DIR):
+    self.ttlSeconds = ttlSeconds
+    self.directory = directory
+    os.makedirs(directory, exist_ok = True)
+
+  def _path(self, url):
+    return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+  def get(self, url):
+    """Return the cached response text of a URL, or None if it is not cached or has expired."""
+    path = self._path(url)
+    try:
+      if time.time() - os.path.getmtime(path) > self.ttlSeconds:
+        return None
+      with open(path, "r", encoding = "utf-8") as file:
+        return file.read()
+    except OSError:
+      return None
+
+  def put(self, url, responseText):
+    path = self._path(url)
+    with open(path + ".tmp", "w", encoding = "utf-8") as file:
+      file.write(responseText)
+    os.replace(path + ".tmp", path)
+
+
+def enableResponseCache(ttlSeconds):
+  """Cache responses of getPageFromAPI() on disk for ttlSeconds. Only for debugging, inat.py never uses the cache."""
+  global responseCache
+  responseCache = ResponseCache(ttlSeconds)
+  return responseCache
+
+
+def fixturePath(name):
+  if not re.fullmatch(r"[A-Za-z0-9_-]+", name):
+    raise ValueError(f"Invalid fixture name: {name}")
+  return os.path.join(FIXTURE_DIR, name + ".json")
+
+
+def saveFixture(name, responseText):
+  """Save a raw API response as a named fixture, which can be replayed offline with loadFixture()."""
+  os.makedirs(FIXTURE_DIR, exist_ok = True)
+  with open(fixturePath(name), "w", encoding = "utf-8") as file:
+    file.write(responseText)
+  logger.log_minimal("Saved fixture " + fixturePath(name))
+
+
+def loadFixture(name):
+  """Load a fixture saved with saveFixture(), as if it was fetched with getPageFromAPI().
+
+  Raises:
+    Exception: If the fixture does not exist or is not valid JSON.
+  """
+  try:
+    with open(fixturePath(name), "r", encoding = "utf-8") as file:
+      responseText = file.read()
+  except OSError:
+    raise Exception(f"Fixture {name} not found in {FIXTURE_DIR}")
+  return selectFields(decodeResponse(responseText))
+
+
+def decodeResponse(responseText, record = None, fetchTimes = None):
+  """Decode the JSON of an API response, saving it first as a fixture if record is given."""
+  if record:
+    saveFixture(record, responseText)
+
+  try:
+    with profiling.stage("page_decode"):
+      inatResponseDict = json.loads(responseText, object_pairs_hook=OrderedDict)
+  except:
+    logger.log_minimal("iNaturalist responded with invalid JSON")
+    raise Exception("iNaturalist API returned invalid JSON")
+
+  if fetchTimes is not None:
+    # For the freshness latency, see freshness.py
+    inatResponseDict["fetch_times"] = fetchTimes
+  return inatResponseDict
+
+
+def getPageFromAPI(url, record = None):
+  """Get a single pageful of observations from iNat, or from the response cache if it is enabled.
 
   Args:
     url (string): API URL to get data from.
+    record (string): Name of a fixture to save the raw response to, or None.
 
   Raises:
     Exception: If API responds with error code, returns invalid JSON, or connection fails after retries.
 
   Returns:
-    orderedDictionary: Observations and associated API metadata (paging etc.)
+    orderedDictionary: Observations and associated API metadata (paging etc.), and "fetch_times": epoch seconds when the request was started and when the response was received
   """
+  if responseCache is not None:
+    responseText = responseCache.get(url)
+    if responseText is not None:
+      logger.log_full("Using cached response of " + url)
+      return decodeResponse(responseText, record)
+
   max_retries = 3
   retry_delay = 10  # seconds
 
   for attempt in range(max_retries):
     logger.log_full("Getting " + url)
+    rateLimiter.wait()
     if attempt > 0:
       logger.log_full(f"Retry attempt {attempt + 1}/{max_retries}")
     
     try:
-      inatResponse = requests.get(url)
+      fetchStarted = time.time()
+      with profiling.stage("fetch"):
+        inatResponse = session.get(url)
+      fetched = time.time()
     except:
       if attempt < max_retries - 1:
         logger.log_full(f"Connection error, waiting {retry_delay} seconds before retry")
@@ -45,13 +309,12 @@ def getPageFromAPI(url):
       raise Exception(f"iNaturalist API responded with error {errorCode}")
 
     logger.log_full("iNaturalist API responded " + str(inatResponse.status_code))
+    run_history.count("bytes", len(inatResponse.content))
 
-    try:
-      inatResponseDict = json.loads(inatResponse.text, object_pairs_hook=OrderedDict)
-      return inatResponseDict
-    except:
-      logger.log_minimal("iNaturalist responded with invalid JSON")
-      raise Exception("iNaturalist API returned invalid JSON")
+    responseText = inatResponse.text
+    if responseCache is not None:
+      responseCache.put(url, responseText)
+    return decodeResponse(responseText, record, (fetchStarted, fetched))
 
   raise Exception("Failed to get data from iNaturalist API after all retries")
 
@@ -83,7 +346,7 @@ def getUpdatedGenerator(latestObsId, latestUpdateTime, pageLimit, perPage, sleep
     logger.log_full("Getting set number " + str(page) + " of " + str(pageLimit) + " latestObsId " + str(latestObsId) + " latestUpdateTime " + latestUpdateTime)
 
     # place_id filter: Finland, Åland & Finland EEZ
-    url = "https://api.inaturalist.org/v1/observations?place_id=7020%2C10282%2C165234&page=1&per_page=" + str(perPage) + "&order=asc&order_by=id&updated_since=" + latestUpdateTime + "&id_above=" + str(latestObsId) + "&include_new_projects=true" + urlSuffix
+    url = observationsUrl(PLACE_FILTER + "&page=1&per_page=" + str(perPage) + "&order=asc&order_by=id&updated_since=" + latestUpdateTime + "&id_above=" + str(latestObsId) + "&include_new_projects=true" + urlSuffix)
 
     # Place: whole world
 #    url = "https://api.inaturalist.org/v1/observations?page=1&per_page=" + str(perPage) + "&order=asc&order_by=id&updated_since=" + latestUpdateTime + "&id_above=" + str(latestObsId) + "&include_new_projects=true" + urlSuffix
@@ -92,7 +355,7 @@ def getUpdatedGenerator(latestObsId, latestUpdateTime, pageLimit, perPage, sleep
       raise Exception("iNat API url malformed, contains space(s)")
 
     try:
-      inatResponseDict = getPageFromAPI(url)
+      inatResponseDict = selectFields(getPageFromAPI(url))
     except Exception as e:
       logger.log_minimal(f"Error fetching data: {str(e)}")
       raise
@@ -122,11 +385,117 @@ def getUpdatedGenerator(latestObsId, latestUpdateTime, pageLimit, perPage, sleep
     yield inatResponseDict
 
 
-def getSingle(observationId):
+def getLatestObservationId():
+  """Get the id of the newest observation in Finland.
+
+  Returns:
+    int: Observation id, 0 if there are no observations
+  """
+  url = observationsUrl(PLACE_FILTER + "&page=1&per_page=1&order=desc&order_by=id")
+  results = selectFields(getPageFromAPI(url))["results"]
+  return results[0]["id"] if results else 0
+
+
+def parseUpdatedAt(updatedAt):
+  """Parse an updated_at value of the API, or a URL-encoded one from the data store, to a timezone-aware datetime."""
+  return datetime.datetime.fromisoformat(urllib.parse.unquote(updatedAt))
+
+
+def getUpdatedAtGenerator(latestObsId, latestUpdateTime, pageLimit, perPage, sleepSeconds, urlSuffix = ""):
+  """Generator that gets and yields updated iNat observations in the order of updated_at.
+
+  Paging uses an (updated_at, id) cursor: each request asks for observations updated since the updated_at of the cursor, and observations at or before the cursor are dropped. Observations with the same updated_at can be split between pages, so ids already received at the cursor time are remembered, and if a whole page has been received already, the next page of the same request is fetched.
+
+  The API does not order observations with the same updated_at by id, so the id of a stored cursor does not tell which of them were received. When resuming, all observations updated at latestUpdateTime are fetched again.
+
+  Args:
+    latestObsId (int): Id of the cursor, only logged. Same arguments as getUpdatedGenerator().
+    latestUpdateTime (string): updated_at of the cursor, URL-encoded.
+    pageLimit (int): Maximum number of pages to fetch
+    perPage (int): Number of observations per page
+    sleepSeconds (int): Seconds to sleep between requests
+    urlSuffix (string): Optional additional parameters for API request. Must start with "&".
+
+  Raises:
+    Exception: If getPageFromAPI() fails to fetch data.
+
+  Yields:
+    orderedDictionary: Observations and associated API metadata (paging etc.), and "cursor": (updated_at URL-encoded, id) of the last observation, which is the watermark to continue from.
+    boolean: Returns False when no more results.
+  """
+  cursorTime = parseUpdatedAt(latestUpdateTime)
+  cursorUpdate = latestUpdateTime
+  cursorId = 0
+  # Ids received at cursorTime during this run
+  seenAtCursor = set()
+  page = 1
+  requestCount = 0
+  totalObservationsProcessed = 0
+
+  while True:
+    requestCount = requestCount + 1
+    if requestCount > pageLimit:
+      raise Exception("Page limit " + str(pageLimit) + " reached, this means that either page limit is set for debugging, or value is too low for production.")
+
+    logger.log_minimal("-----")
+    logger.log_full("Getting page " + str(page) + " updated since " + cursorUpdate + " id " + str(cursorId or latestObsId))
+
+    url = observationsUrl(PLACE_FILTER + "&page=" + str(page) + "&per_page=" + str(perPage) + "&order=asc&order_by=updated_at&updated_since=" + urllib.parse.quote(urllib.parse.unquote(cursorUpdate), safe="") + "&include_new_projects=true" + urlSuffix)
+
+    try:
+      inatResponseDict = selectFields(getPageFromAPI(url))
+    except Exception as e:
+      logger.log_minimal(f"Error fetching data: {str(e)}")
+      raise
+
+    logger.log_minimal(str(inatResponseDict["total_results"]) + " observations remaining")
+
+    received = sorted(inatResponseDict["results"], key=lambda inat: (parseUpdatedAt(inat["updated_at"]), inat["id"]))
+    newObservations = []
+    for inat in received:
+      key = (parseUpdatedAt(inat["updated_at"]), inat["id"])
+      if key > (cursorTime, cursorId) or (key[0] == cursorTime and inat["id"] not in seenAtCursor):
+        newObservations.append(inat)
+
+    if not newObservations:
+      # Everything on a full page has been received already, e.g. many observations updated at the same time
+      if len(received) == perPage:
+        page = page + 1
+        time.sleep(sleepSeconds)
+        continue
+      logger.log_full("-----")
+      logger.log_full("No more observations.")
+      logger.log_full("Total observations processed: " + str(totalObservationsProcessed))
+      yield False
+      break
+
+    # Advance the cursor to the last observation received
+    last = newObservations[-1]
+    lastTime = parseUpdatedAt(last["updated_at"])
+    if lastTime != cursorTime:
+      seenAtCursor = set()
+      cursorId = 0
+    cursorTime = lastTime
+    cursorUpdate = urllib.parse.quote(last["updated_at"], safe="")
+    seenAtCursor.update(inat["id"] for inat in newObservations if parseUpdatedAt(inat["updated_at"]) == cursorTime)
+    cursorId = max(cursorId, max(seenAtCursor))
+    page = 1
+
+    totalObservationsProcessed += len(newObservations)
+    inatResponseDict["results"] = newObservations
+    inatResponseDict["cursor"] = (cursorUpdate, cursorId)
+
+    time.sleep(sleepSeconds)
+    yield inatResponseDict
+
+
+def getSingle(observationId, record = None, fieldsMode = None):
   """Gets and returns a single iNat observation.
 
   Args:
     observationId (int): iNat observation id.
+    record (string): Name of a fixture to save the raw response to, or None.
+    fieldsMode (string): all, sparse or verify, instead of FIELDS_MODE.
 
   Raises:
     Exception: If observation not found or API error occurs.
@@ -134,11 +503,11 @@ def getSingle(observationId):
   Returns:
     orderedDictionary: Single observation and associated API metadata.
   """
-  url = "https://api.inaturalist.org/v1/observations?id=" + str(observationId) + "&order=desc&order_by=created_at&include_new_projects=true"
+  url = observationsUrl("id=" + str(observationId) + "&order=desc&order_by=created_at&include_new_projects=true", fieldsMode)
   print("URL: " + url)
 
   try:
-    inatResponseDict = getPageFromAPI(url)
+    inatResponseDict = selectFields(getPageFromAPI(url, record))
   except Exception as e:
     logger.log_minimal(f"Error fetching observation {observationId}: {str(e)}")
     raise
@@ -147,5 +516,128 @@ def getSingle(observationId):
     raise Exception(f"Observation {observationId} not found in iNaturalist")
 
   return inatResponseDict
-  
 
+
+def getMultiple(observationIds, perPage = 200, sleepSeconds = 1):
+  """Generator that gets iNat observations by id, many ids per request.
+
+  Args:
+    observationIds (list): iNat observation ids.
+    perPage (int): Number of ids per request. iNat API returns at most 200 observations per page.
+    sleepSeconds (int): Seconds to sleep between requests
+
+  Raises:
+    Exception: If getPageFromAPI() fails to fetch data.
+
+  Yields:
+    tuple: (list of requested ids, list of observations found)
+  """
+  for start in range(0, len(observationIds), perPage):
+    idGroup = observationIds[start:start + perPage]
+    idString = "%2C".join(str(observationId) for observationId in idGroup)
+    url = observationsUrl("id=" + idString + "&per_page=" + str(len(idGroup)) + "&order=asc&order_by=id&include_new_projects=true")
+
+    try:
+      inatResponseDict = selectFields(getPageFromAPI(url))
+    except Exception as e:
+      logger.log_minimal(f"Error fetching observations {idGroup[0]}...{idGroup[-1]}: {str(e)}")
+      raise
+
+    logger.log_minimal("Got " + str(len(inatResponseDict["results"])) + " of " + str(len(idGroup)) + " observations")
+    yield idGroup, inatResponseDict["results"]
+
+    if start + perPage < len(observationIds):
+      time.sleep(sleepSeconds)
+
+
+def getIdsGenerator(latestObsId, perPage = 200, urlSuffix = ""):
+  """Generator that gets ids of all observations with the same place filter as getUpdatedGenerator(), without the observation data.
+
+  Uses the API's only_id parameter, so that responses are small. Requests are spaced by the shared rateLimiter.
+
+  Args:
+    latestObsId (int): Highest observation id that should not be fetched.
+    perPage (int): Number of ids per page
+    urlSuffix (string): Optional additional parameters for API request. Must start with "&".
+
+  Raises:
+    Exception: If getPageFromAPI() fails to fetch data.
+
+  Yields:
+    list: Observation ids of one page, in ascending order. Stops when there are no more observations.
+  """
+  while True:
+    url = "https://api.inaturalist.org/v1/observations?" + PLACE_FILTER + "&only_id=true&per_page=" + str(perPage) + "&order=asc&order_by=id&id_above=" + str(latestObsId) + urlSuffix
+
+    if " " in url:
+      raise Exception("iNat API url malformed, contains space(s)")
+
+    inatResponseDict = getPageFromAPI(url)
+    observationIds = [observation["id"] for observation in inatResponseDict["results"]]
+
+    if not observationIds:
+      break
+
+    logger.log_full(str(inatResponseDict["total_results"]) + " ids remaining after id " + str(latestObsId))
+    latestObsId = observationIds[-1]
+    yield observationIds
+
+
+def getTaxa(taxonIds, perPage = 30, sleepSeconds = 1):
+  """Generator that gets iNat taxa by id, many ids per request.
+
+  Args:
+    taxonIds (list): iNat taxon ids.
+    perPage (int): Number of ids per request. iNat API returns at most 30 taxa per request.
+    sleepSeconds (int): Seconds to sleep between requests
+
+  Raises:
+    Exception: If getPageFromAPI() fails to fetch data.
+
+  Yields:
+    list: Taxa of one request, including their ancestors
+  """
+  for start in range(0, len(taxonIds), perPage):
+    idGroup = taxonIds[start:start + perPage]
+    url = "https://api.inaturalist.org/v1/taxa/" + "%2C".join(str(taxonId) for taxonId in idGroup)
+
+    inatResponseDict = getPageFromAPI(url)
+    logger.log_full("Got " + str(len(inatResponseDict["results"])) + " of " + str(len(idGroup)) + " taxa")
+    yield inatResponseDict["results"]
+
+    if start + perPage < len(taxonIds):
+      time.sleep(sleepSeconds)
+
+
+def getSpeciesCountsGenerator(iconicTaxon, perPage = 500, sleepSeconds = 1):
+  """Generator that gets taxa observed with the same place filter as getUpdatedGenerator().
+
+  The API pages at most 10 000 results, so taxa are fetched separately for each iconic taxon.
+
+  Args:
+    iconicTaxon (string): Iconic taxon name, e.g. "Insecta"
+    perPage (int): Number of taxa per page
+    sleepSeconds (int): Seconds to sleep between requests
+
+  Raises:
+    Exception: If getPageFromAPI() fails to fetch data.
+
+  Yields:
+    list: Taxa of one page
+  """
+  page = 1
+  while True:
+    url = "https://api.inaturalist.org/v1/observations/species_counts?" + PLACE_FILTER + "&iconic_taxa=" + iconicTaxon + "&per_page=" + str(perPage) + "&page=" + str(page)
+    inatResponseDict = getPageFromAPI(url)
+    taxa = [result["taxon"] for result in inatResponseDict["results"]]
+    if not taxa:
+      break
+
+    yield taxa
+
+    if page * perPage >= min(inatResponseDict["total_results"], 10000):
+      if inatResponseDict["total_results"] > 10000:
+        logger.log_minimal(f"Only 10000 of {inatResponseDict['total_results']} taxa of {iconicTaxon} can be fetched")
+      break
+    page += 1
+    time.sleep(sleepSeconds)
@@ -1,21 +1,31 @@
+import concurrent.futures
 import datetime
+import functools
+import re
 import sys
 import os
-import json
 import signal
 import atexit
+import threading
+import time
 
+import download_from_allas
+import freshness
 import getInat
 import inatToDw
 import inatHelpers
-import postDw
 import logger
-import upload_to_allas
-
-import pandas
-
-ALLAS_STATE_FILE = './store/data-ALLAS.json'
-MANUAL_STATE_FILE = './store/data-MANUAL.json'
+import mirror
+import profiling
+import push_targets
+import registry
+import run_history
+import state
+import taxon_cache
+import validate_dw
+
+ALLAS_STATE_FILE = state.ALLAS_STATE_FILE
+MANUAL_STATE_FILE = state.MANUAL_STATE_FILE
 
 def subtract_minutes(datetime_str, minutes_to_subtract):
     """Subtract minutes from a datetime string.
@@ -31,11 +41,8 @@ def subtract_minutes(datetime_str, minutes_to_subtract):
         string: New datetime string in ISO format
     """
     try:
-        # Replace encoded characters with their actual representations
-        formatted_str = datetime_str.replace('%3A', ':').replace('%2B', '+').replace('%2F', '/')
-
         # Convert the string to a datetime object
-        datetime_obj = datetime.datetime.fromisoformat(formatted_str)
+        datetime_obj = parse_update_time(datetime_str)
 
         # Subtract the specified number of minutes
         new_datetime_obj = datetime_obj - datetime.timedelta(minutes=minutes_to_subtract)
@@ -53,83 +60,576 @@ def printObject(object):
   print(object.__dict__)
 
 
-def set_variable(var_name, var_value, file_path=ALLAS_STATE_FILE, upload_to_allas_enabled=True):
-    """Set a variable in the data store (optionally upload to Allas).
+def parse_update_time(datetime_str):
+    """Parse a URL-encoded ISO datetime string as stored in the data store.
+
+    Args:
+        datetime_str (string): URL-encoded ISO format datetime string
+
+    Raises:
+        ValueError: If datetime string is invalid
+
+    Returns:
+        datetime: Parsed datetime
+    """
+    formatted_str = datetime_str.replace('%3A', ':').replace('%2B', '+').replace('%2F', '/')
+    return datetime.datetime.fromisoformat(formatted_str)
+
+
+def get_variable_names(mode, target, job=None):
+    """Get data store variable names for a mode and target.
+
+    Args:
+        mode (string): auto | manual
+        target (string): staging | production | file
+        job (string): Name of a manual job, or None
+
+    Raises:
+        ValueError: If mode or target is invalid
+
+    Returns:
+        tuple: Variable names for latest observation id, latest update time and status
+    """
+    if mode == "auto":
+        prefix = "inat_auto"
+    elif mode == "manual":
+        prefix = "inat_MANUAL"
+    else:
+        raise ValueError(f"Invalid mode: {mode}")
+
+    if job is not None:
+        if mode != "manual" or not re.fullmatch(r"[A-Za-z0-9_-]+", job):
+            raise ValueError(f"Invalid job name: {job}")
+        prefix = f"{prefix}_{job}"
+
+    if target not in VALID_TARGETS:
+        raise ValueError(f"Invalid target: {target}")
+
+    # The file target has its own state variables, and is not allowed to touch the state of scheduled runs in Allas
+    if target == "file" and mode != "manual":
+        raise ValueError("Target file can only be used in manual mode")
+
+    return (
+        f"{prefix}_{target}_latest_obsId",
+        f"{prefix}_{target}_latest_update",
+        f"{prefix}_{target}_status",
+    )
+
+
+def get_start_cursor(variables, jobVariableNames):
+    """Get the cursor to start fetching from.
+
+    When syncing several targets, observations are fetched once starting from the cursor of the target that is furthest behind. Targets that are ahead receive some observations again, which is harmless since posting replaces existing documents.
 
     Args:
-        var_name (string): Name of the variable
-        var_value: Value to store
-        file_path (string): JSON file path to read/write
-        upload_to_allas_enabled (bool): If True, sync the JSON file to Allas
+        variables (dict): Variables from the data store
+        jobVariableNames (dict): Variable names by target
 
     Raises:
-        Exception: If file operations fail
+        ValueError: If latest update time is missing or invalid
+
+    Returns:
+        tuple: Latest observation id and latest update time
+    """
+    latest_obs_id = None
+    latest_update = None
+    for target, (variableName_latest_obsId, variableName_latest_update, variableName_status) in jobVariableNames.items():
+        target_latest_obs_id = variables.get(variableName_latest_obsId, 0)
+        target_latest_update = variables.get(variableName_latest_update, "")
+
+        if not target_latest_update:
+            raise ValueError(
+                f"Missing latest update time for {mode} mode. "
+                f"Expected key '{variableName_latest_update}' in {state_file}"
+            )
+
+        try:
+            if latest_update is None or parse_update_time(target_latest_update) < parse_update_time(latest_update):
+                latest_update = target_latest_update
+        except ValueError as e:
+            raise ValueError(f"Invalid latest update time: {target_latest_update}") from e
+
+        if latest_obs_id is None or target_latest_obs_id < latest_obs_id:
+            latest_obs_id = target_latest_obs_id
+
+    return latest_obs_id, latest_update
+
+
+def load_private_data():
+    """Load private observation data and private emails.
+
+    Returns:
+        tuple: Private observation data (DataFrame) and private emails (dict)
     """
+    try:
+        with profiling.stage("private_load"):
+            privateObservationData = inatHelpers.load_private_observations()
+    except Exception as e:
+        raise Exception(f"Failed to load private observation data: {str(e)}")
 
     try:
-        # Read existing data from the file
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as file:
-                data = json.load(file)
-        else:
-            data = {}
-
-        # Update the data with new variable
-        data[var_name] = var_value
-
-        # Write the updated data back to the file
-        with open(file_path, 'w') as file:
-            json.dump(data, file, indent=4)
-        
-        if upload_to_allas_enabled:
-            # Upload to Allas after each write (real-time sync)
-            upload_to_allas.upload_state_file(file_path, silent=True)
-            logger.log_minimal(f"Updated variable {var_name} as {var_value} and synced to Allas")
-        else:
-            logger.log_minimal(f"Updated variable {var_name} as {var_value} (local only)")
+        with profiling.stage("email_load"):
+            private_emails = inatHelpers.load_private_emails()
     except Exception as e:
-        logger.log_minimal(f"Failed to update variable {var_name} as {var_value}")
-        raise Exception(f"Failed to update data store: {str(e)}")
+        raise Exception(f"Failed to load private emails: {str(e)}")
+
+    return privateObservationData, private_emails
+
+
+def checkpoint(jobVariableNames, target, dwObservations, cursor):
+    """Store progress of a target after a page has been posted to it.
+
+    The cursor is the latest observation id, or (latest update, latest observation id) with INAT_PAGINATION=updated. The cursor is uploaded to Allas every REGISTRY_SAVE_PAGES pages, after the registries that cover its pages have been saved (see sync_state()).
+    """
+    global checkpointsSinceSync
+
+    run_history.count_posted(target, len(dwObservations["roots"]))
+
+    variableName_latest_obsId, variableName_latest_update, variableName_status = jobVariableNames[target]
+    with checkpointLock:
+        if target in registries:
+            registries[target].add(registry.document_ids_to_observation_ids(dwObservations))
+        if target in captiveRegistries:
+            captiveRegistries[target].update(registry.document_ids_to_observation_ids(dwObservations), registry.captive_observation_ids(dwObservations))
+
+        if isinstance(cursor, tuple):
+            latestUpdate, latestObsId = cursor
+            state.set_variable(variableName_latest_update, latestUpdate, file_path=state_file, upload_to_allas_enabled=sync_to_allas, upload_now=False)
+        else:
+            latestObsId = cursor
+        state.set_variable(variableName_latest_obsId, latestObsId, file_path=state_file, upload_to_allas_enabled=sync_to_allas, upload_now=False)
+        state.set_variable(variableName_status, "ongoing", file_path=state_file, upload_to_allas_enabled=sync_to_allas, upload_now=False)
+
+        checkpointsSinceSync += 1
+        if checkpointsSinceSync >= REGISTRY_SAVE_PAGES:
+            sync_state()
+
+
+def save_registries():
+    """Save registries of pushed ids and captive ids.
+
+    Returns:
+        bool: True if all registries were saved
+    """
+    saved = True
+    for idRegistry in list(registries.values()) + list(captiveRegistries.values()):
+        saved = idRegistry.save() and saved
+    return saved
+
+
+def sync_state(silent=True):
+    """Save the registries, and then upload the state to Allas.
+
+    The state is uploaded only if the registries were saved, so that a cursor in Allas never covers ids that are missing from the registries in Allas, e.g. after the pod is killed. Otherwise the deletion sweep would never find those observations.
+    """
+    global checkpointsSinceSync
+    if not sync_to_allas:
+        return
+    with checkpointLock:
+        if not save_registries():
+            logger.log_minimal("Registries were not saved, state is not uploaded to Allas")
+            return
+        state.upload_state(state_file, silent=silent)
+        checkpointsSinceSync = 0
+
+
+class FreshStream:
+    """Stream of new observations, fetched with priority over updated observations.
+
+    In id order, updated observations are fetched before any new observation, so after a burst of updates a new observation can wait for a whole run. This stream fetches observations with ids above its own cursor (variables inat_auto_<target>_fresh_latest_obsId), at the start of a cycle, every FRESH_INTERVAL_SECONDS between pages of updated observations, and at the end. Its pages are posted by their own pushers, so they do not queue behind updated pages. Requests of both streams share the rate limit of the cycle. Updated observations still cover new observations as well, so an observation that appears on the API late with a lower id is not lost.
+
+    Both streams fetch observations created during the cycle, so each stream drops observations that the other one has already put to its pushers in the same or a newer version (see exclude_updated()). If a fresh pusher fails, its target is not posted the dropped observations on this cycle, but its fresh cursor stays where it was, so they are fetched again on the next cycle.
 
+    Args:
+        variables (dict): Variables from the data store
+        privateObservationData (PrivateObservations): Private observation data by id
+        private_emails (dict): Private emails by user login
+        sleepSeconds (int): Seconds to sleep between requests
+        since (datetime): Start cursor of the cycle, for the freshness latency
+        updatedPushers (list): Pushers of updated observations
+    """
 
-def read_variables(file_path=ALLAS_STATE_FILE):
-    """Read variables from the data store.
+    def __init__(self, variables, privateObservationData, private_emails, sleepSeconds, since, updatedPushers):
+        self.privateObservationData = privateObservationData
+        self.private_emails = private_emails
+        self.sleepSeconds = sleepSeconds
+        self.since = since
+        self.updatedPushers = updatedPushers
+        self.variableNames = {target: tuple(name.replace("_latest_", "_fresh_latest_").replace("_status", "_fresh_status") for name in variableNames[target]) for target in targets}
+
+        cursors = [variables.get(names[0]) for names in self.variableNames.values()]
+        if None in cursors:
+            # Starting the stream: observations until now are covered by the updated stream
+            self.cursor = getInat.getLatestObservationId()
+            for names in self.variableNames.values():
+                state.set_variable(names[0], self.cursor, file_path=state_file, upload_to_allas_enabled=sync_to_allas)
+            logger.log_minimal(f"Fresh stream starts above id {self.cursor}")
+        else:
+            self.cursor = min(cursors)
+
+        # updated_at of observations put to the pushers of each stream on this cycle, by id. Only ids above the start cursor are fetched by both streams.
+        self.startCursor = self.cursor
+        self.freshVersions = {}
+        self.updatedVersions = {}
+
+        self.pushers = [push_targets.TargetPusher(target, functools.partial(checkpoint, self.variableNames)) for target in targets]
+        self._lastPoll = None
+
+    def poll(self, force=False):
+        """Fetch and post new observations, if FRESH_INTERVAL_SECONDS has passed since the previous poll or force is True."""
+        if not force and self._lastPoll is not None and time.monotonic() - self._lastPoll < FRESH_INTERVAL_SECONDS:
+            return
+        if all(pusher.failed for pusher in self.pushers):
+            return
+
+        pages = 0
+        for multiObservationDict in getInat.getUpdatedGenerator(self.cursor, FRESH_UPDATED_SINCE, pageLimit=FRESH_MAX_PAGES, perPage=100, sleepSeconds=self.sleepSeconds):
+            if multiObservationDict is False:
+                break
+            run_history.count("fresh_fetched", len(multiObservationDict['results']))
+            if mirror.writer is not None:
+                mirror.writer.upsert(multiObservationDict['results'])
+
+            with profiling.stage("convert"):
+                dwObservations, latestObsId = inatToDw.convertObservations(multiObservationDict['results'], self.privateObservationData, self.private_emails)
+            dwObservations = self._exclude(multiObservationDict['results'], dwObservations, self.freshVersions, self.updatedVersions, self.updatedPushers)
+            timing = freshness.PageTiming(multiObservationDict, dwObservations, self.since)
+            for pusher in self.pushers:
+                pusher.put(dwObservations, latestObsId, timing)
+            self.cursor = multiObservationDict['results'][-1]['id']
+
+            pages += 1
+            if pages >= FRESH_MAX_PAGES or stop_requested.is_set():
+                break
+
+        if pages:
+            logger.log_minimal(f"Fresh stream posted {pages} pages of new observations, up to id {self.cursor}")
+        self._lastPoll = time.monotonic()
+
+    def exclude_updated(self, inatObservations, dwObservations):
+        """Drop observations from a page of updated observations that this stream has already put to its pushers in the same or a newer version.
+
+        Args:
+            inatObservations (list): Observations of the page from the API
+            dwObservations (dict): Converted observations of the page
+
+        Returns:
+            dict: Converted observations to put to the pushers of updated observations
+        """
+        return self._exclude(inatObservations, dwObservations, self.updatedVersions, self.freshVersions, self.pushers)
+
+    def _exclude(self, inatObservations, dwObservations, ownVersions, otherVersions, otherPushers):
+        """Drop observations that the other stream has already put in the same or a newer version, and record the versions of the rest.
+
+        If the page has a newer version of an observation that the other stream has put, waits until the other stream has posted its queued pages, so that the older version is not posted after the newer one.
+        """
+        dropIds = set()
+        newer = False
+        for inat in inatObservations:
+            if inat["id"] <= self.startCursor:
+                continue
+            updatedAt = getInat.parseUpdatedAt(inat["updated_at"])
+            putUpdatedAt = otherVersions.get(inat["id"])
+            if putUpdatedAt is not None and updatedAt <= putUpdatedAt:
+                dropIds.add(inat["id"])
+                continue
+            newer = newer or putUpdatedAt is not None
+            ownVersions[inat["id"]] = updatedAt
+
+        if newer:
+            for pusher in otherPushers:
+                pusher.wait()
+        if not dropIds:
+            return dwObservations
+        roots = [dw for dw, observationId in zip(dwObservations["roots"], registry.document_ids_to_observation_ids(dwObservations)) if observationId not in dropIds]
+        return dict(dwObservations, roots=roots)
+
+    def close(self):
+        """Wait until new observations have been posted.
+
+        Returns:
+            list: Targets that failed
+        """
+        for pusher in self.pushers:
+            pusher.close()
+        return [pusher.target for pusher in self.pushers if pusher.failed]
+
+
+def run_cycle(privateObservationData, private_emails, job=None):
+    """Fetch, convert and post all observations updated since the latest update of the targets.
+
+    Args:
+        privateObservationData (PrivateObservations): Private observation data by id
+        private_emails (dict): Private emails by user login
+        job (string): Name of a manual job, which has its own suffix and state variables. Requests of concurrent jobs are spaced by the shared rate limiter.
 
     Raises:
-        Exception: If file operations fail
+        Exception: If fetching, converting or posting fails
 
     Returns:
-        dict: Stored variables
+        bool: True if finished, False if stopped by a termination signal before finishing
     """
+    # This will be the new updatedLast time in Variables. Generating update time here, since observations are coming from the API sorted by id, not by datemodified -> cannot use time of last record. With INAT_PAGINATION=updated, the updated_at of the last record is used instead.
+    now = datetime.datetime.now(datetime.timezone.utc)
+    thisUpdateTime = now.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+    thisUpdateTime = thisUpdateTime.replace(":", "%3A")
+    thisUpdateTime = thisUpdateTime.replace("+", "%2B")
+
+    logPrefix = f"[{job}] " if job else ""
+    logger.log_minimal(logPrefix + "Starting at " + str(thisUpdateTime))
+
+    # Get latest update data
     try:
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as file:
-                variables = json.load(file)
-                logger.log_minimal(f"Read variables from {file_path}: {variables}")
-                return variables
-        else:
-            logger.log_minimal(f"No state file found at {file_path}, starting with empty variables")
-            return {}
+        variables = state.read_variables(state_file)
     except Exception as e:
-        raise Exception(f"Failed to read from data store {file_path}: {str(e)}")
+        raise Exception(f"Failed to read variables: {str(e)}")
+
+    # Automatic scheduled update has no filters, manually triggered update uses the suffix from the state file
+    if job:
+        urlSuffix = variables["inat_MANUAL_jobs"][job]
+        jobVariableNames = {target: get_variable_names(mode, target, job) for target in targets}
+        sleepSeconds = 0
+    else:
+        urlSuffix = variables.get("inat_MANUAL_urlSuffix", "") if mode == "manual" else ""
+        jobVariableNames = variableNames
+        sleepSeconds = sleep
+
+    latest_obs_id, latest_update = get_start_cursor(variables, jobVariableNames)
+    # Observations created after this are new, for the freshness latency
+    since = parse_update_time(latest_update)
+    updatedPagination = getInat.PAGINATION == "updated"
+    generator = getInat.getUpdatedAtGenerator if updatedPagination else getInat.getUpdatedGenerator
+    # Watermark of updated pagination: (updated_at, id) of the last observation received
+    watermark = None
+
+    # Reduce minutes from datetime. This is done because observations can appear on the API with delay of few minutes, which would cause them not to be processed. 
+    if OVERLAP_MINUTES > 0:
+        try:
+            latest_update = subtract_minutes(latest_update, OVERLAP_MINUTES)
+        except ValueError as e:
+            raise ValueError(f"Invalid latest update time: {str(e)}")
+
+    # GET DATA
+    page = 1
+    props = {"sleepSeconds": sleepSeconds, "perPage": 100, "pageLimit": 10000, "urlSuffix": urlSuffix}
+
+    # Each target is posted to in its own thread, so that targets are posted to concurrently and a failing target does not stop the others
+    pushers = [push_targets.TargetPusher(target, functools.partial(checkpoint, jobVariableNames)) for target in targets]
+    finished = False
+    fresh = None
+
+    # For each pageful of data
+    try:
+        # New observations first, and then between pages of updated observations
+        if FRESH_STREAM_ENABLED and mode in ("auto", "daemon"):
+            fresh = FreshStream(variables, privateObservationData, private_emails, sleepSeconds, since, pushers)
+            fresh.poll(force=True)
+
+        for multiObservationDict in generator(latest_obs_id, latest_update, **props):
+            # If no more observations on page, finish the process by saving update time and resetting observation id to zero.
+            if multiObservationDict is False:
+                for pusher in pushers:
+                    pusher.close()
+                    if pusher.failed:
+                        continue
+                    variableName_latest_obsId, variableName_latest_update, variableName_status = jobVariableNames[pusher.target]
+                    if updatedPagination:
+                        # The latest update of each target has been stored with its pages, and stays as it is if nothing was received. The id is reset, so that switching back to INAT_PAGINATION=id does not skip observations with lower ids; here it only fetches again the observations at exactly the latest update.
+                        state.set_variable(variableName_latest_obsId, 0, file_path=state_file, upload_to_allas_enabled=sync_to_allas, upload_now=False)
+                        state.set_variable(variableName_status, "finished", file_path=state_file, upload_to_allas_enabled=sync_to_allas, upload_now=False)
+                        logger.log_minimal(logPrefix + "Finished " + pusher.target + ", latest update " + (watermark[0] if watermark else "unchanged"))
+                        continue
+                    state.set_variable(variableName_latest_update, thisUpdateTime, file_path=state_file, upload_to_allas_enabled=sync_to_allas, upload_now=False)
+                    state.set_variable(variableName_latest_obsId, 0, file_path=state_file, upload_to_allas_enabled=sync_to_allas, upload_now=False)
+                    state.set_variable(variableName_status, "finished", file_path=state_file, upload_to_allas_enabled=sync_to_allas, upload_now=False)
+                    logger.log_minimal(logPrefix + "Finished " + pusher.target + ", latest update set to " + thisUpdateTime)
+                sync_state()
+                finished = True
+                break
+
+            run_history.count("pages")
+            run_history.count("fetched", len(multiObservationDict['results']))
+            if page == 1:
+                run_history.count("total_results", multiObservationDict['total_results'])
+
+            # Raw observations are kept in the local mirror, for reconversion (see mirror.py)
+            if mirror.writer is not None:
+                mirror.writer.upsert(multiObservationDict['results'])
+
+            # CONVERT
+            with profiling.stage("convert"):
+                dwObservations, latestObsId = inatToDw.convertObservations(multiObservationDict['results'], privateObservationData, private_emails)
+            run_history.count("converted", len(dwObservations["roots"]))
+            # New observations that the fresh stream has already posted
+            if fresh is not None:
+                dwObservations = fresh.exclude_updated(multiObservationDict['results'], dwObservations)
+            timing = freshness.PageTiming(multiObservationDict, dwObservations, since)
+
+            # POST
+            # State is stored by the pusher of each target after its post succeeds
+            if all(pusher.failed for pusher in pushers):
+                raise Exception("Posting failed for all targets")
+            if updatedPagination:
+                watermark = multiObservationDict["cursor"]
+            for pusher in pushers:
+                pusher.put(dwObservations, watermark if updatedPagination else latestObsId, timing)
+
+            if fresh is not None:
+                fresh.poll()
+
+            # In daemon mode, a termination signal stops the cycle after the current page. The targets resume from their checkpoints.
+            if stop_requested.is_set():
+                logger.log_minimal("Stopping before the cycle has finished")
+                break
+
+            if page < props["pageLimit"]:
+                page = page + 1
+            else:
+                # Exception because this should not happen in production (happens only if pageLimit is too low compared to frequency of this script being run)
+                raise Exception("Page limit " + str(props["pageLimit"]) + " reached, this means that either page limit is set for debugging, or value is too low for production.")
+        # Observations created during the cycle
+        if fresh is not None and finished:
+            fresh.poll(force=True)
+    finally:
+        for pusher in pushers:
+            pusher.close()
+        freshFailedTargets = fresh.close() if fresh is not None else []
+
+    run_history.count("dropped", validate_dw.log_counts()["dropped"])
+
+    failedTargets = [pusher.target for pusher in pushers if pusher.failed]
+    failedTargets += [target for target in freshFailedTargets if target not in failedTargets]
+    if failedTargets:
+        raise Exception("Posting failed for targets: " + ", ".join(failedTargets))
+
+    return finished
+
+
+def run_jobs(privateObservationData, private_emails, jobs):
+    """Run manual jobs concurrently.
+
+    Jobs share the private data, HTTP sessions and a rate limiter that keeps sleep seconds between all requests to iNat. A failing job does not stop the others, and each job resumes from its own state on the next run.
+
+    Args:
+        privateObservationData (PrivateObservations): Private observation data by id
+        private_emails (dict): Private emails by user login
+        jobs (list): Names of jobs
+
+    Raises:
+        Exception: If any of the jobs failed
+    """
+    getInat.rateLimiter.minInterval = sleep
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="job") as executor:
+        futures = {job: executor.submit(run_cycle, privateObservationData, private_emails, job) for job in jobs}
+
+    failedJobs = []
+    for job, future in futures.items():
+        if future.exception():
+            logger.log_minimal(f"[{job}] Failed: {str(future.exception())}")
+            failedJobs.append(job)
+        else:
+            logger.log_minimal(f"[{job}] Done")
+
+    if failedJobs:
+        raise Exception("Manual jobs failed: " + ", ".join(failedJobs))
+
+
+def run_daemon():
+    """Run incremental cycles every daemon_interval minutes until a termination signal.
+
+    Private data stays loaded between cycles, and is downloaded and loaded again only when its ETag in Allas changes. When only the private data delta changes, it is applied to the loaded data in place.
+    """
+    privateObservationData, private_emails = load_private_data()
+    etags = download_from_allas.get_private_data_etags()
+    consecutive_failures = 0
+
+    while not stop_requested.is_set():
+        run_history.start()
+        status = "failed"
+        try:
+            changed_etags = download_from_allas.refresh_private_data(etags)
+            changed_keys = {key for key, etag in changed_etags.items() if etag != etags.get(key)}
+            if changed_keys == {DELTA_OBJECT_KEY} and os.path.exists(inatHelpers.PRIVATE_DELTA_FILE):
+                # Only the delta has changed: apply it to the loaded data. Loading the files again would give the same version, so a delta that cannot be applied is skipped, and the loaded data is used as it is.
+                try:
+                    inatHelpers.apply_private_delta(privateObservationData, inatHelpers.PRIVATE_DELTA_FILE)
+                except Exception as e:
+                    logger.log_minimal(f"Private data delta not applied, continuing with version {privateObservationData.version}: {str(e)}")
+            elif changed_keys:
+                logger.log_minimal("Private data has changed in Allas, loading it again")
+                privateObservationData, private_emails = load_private_data()
+            etags = changed_etags
+
+            status = "finished" if run_cycle(privateObservationData, private_emails) else "stopped"
+            consecutive_failures = 0
+        except Exception as e:
+            consecutive_failures += 1
+            logger.log_minimal(f"Error during cycle ({consecutive_failures} consecutive): {str(e)}")
+            if consecutive_failures >= DAEMON_MAX_CONSECUTIVE_FAILURES:
+                logger.log_minimal("Too many consecutive failed cycles, exiting")
+                run_history.record(mode, targets, status, sync_to_allas)
+                sys.exit(1)
+
+        run_history.record(mode, targets, status, sync_to_allas)
+
+        if taxon_cache.cache is not None:
+            taxon_cache.cache.save()
+        if mirror.writer is not None:
+            mirror.writer.close()
+        sync_state(silent=False)
+
+        if not stop_requested.is_set():
+            logger.log_minimal(f"Next cycle in {daemon_interval} minutes")
+            stop_requested.wait(daemon_interval * 60)
+
+    logger.log_minimal("Daemon stopped")
 
 
 ### SETUP
 
+# Target "file" writes to files instead of posting, see file_sink.py
+VALID_TARGETS = ("staging", "production", "file")
+
+# Allas object of the private data delta, see tools/private_delta.py
+DELTA_OBJECT_KEY = os.getenv('ALLAS_OBJECT_KEY_DELTA')
+
+# Cursors are uploaded to Allas after this many posted pages, after saving the registries of pushed ids, which are too large to upload after every page
+REGISTRY_SAVE_PAGES = 10
+checkpointLock = threading.RLock()
+checkpointsSinceSync = 0
+
+# Daemon exits after this many failed cycles in a row, so that the pod is restarted
+DAEMON_MAX_CONSECUTIVE_FAILURES = 5
+
+# Freshness-first stream of new observations in auto and daemon modes, see FreshStream
+FRESH_STREAM_ENABLED = os.getenv('INAT_FRESH_STREAM', 'false').lower() == 'true'
+FRESH_INTERVAL_SECONDS = int(os.getenv('INAT_FRESH_INTERVAL_SECONDS', '60') or 60)
+# Pages of new observations fetched per poll, before returning to updated observations
+FRESH_MAX_PAGES = 10
+# New observations are fetched by id, so updated_since only needs to cover all of them
+FRESH_UPDATED_SINCE = "2000-01-01T00%3A00%3A00%2B00%3A00"
+
+# Minutes fetched again before the latest update, since observations can appear on the API with a delay of a few minutes
+OVERLAP_MINUTES = int(os.getenv('INAT_OVERLAP_MINUTES', '3') or 3)
+
+# Optional --profile[=DIR] for CPU profiling, see profiling.py
+cpu_profile_dir = profiling.parse_profile_argument(sys.argv)
+
 # Mandatory command line arguments
 if len(sys.argv) < 4:
-    raise ValueError("Missing required arguments. Usage: python inat.py <target> <mode> <full_logging> [sleep]")
+    raise ValueError("Missing required arguments. Usage: python inat.py <target>[,<target>...] <mode> <full_logging> [sleep] [daemon_interval]")
 
-target = sys.argv[1] # staging | production
-mode = sys.argv[2] # auto | manual
+targets = sys.argv[1].split(",") # staging | production | file | staging,production
+mode = sys.argv[2] # auto | manual | daemon
 
 if sys.argv[3].lower() == 'false':
     full_logging_on = False
 else:
     full_logging_on = True
 
-# Only auto mode syncs state to/from Allas. Manual mode is local-only.
-sync_to_allas = (mode == "auto")
+# Manual mode is local-only. Auto and daemon modes sync state to/from Allas, and use the same state variables.
+sync_to_allas = mode in ("auto", "daemon")
 state_file = ALLAS_STATE_FILE if sync_to_allas else MANUAL_STATE_FILE
 
 # Optional command line arguments
@@ -144,51 +644,50 @@ if len(sys.argv) > 4:
 else:
     sleep = 10
 
+# Minutes between cycles in daemon mode, default 10 minutes
+if len(sys.argv) > 5:
+    try:
+        daemon_interval = max(int(sys.argv[5]), 1)
+    except ValueError:
+        daemon_interval = 10
+else:
+    daemon_interval = 10
+
 # Setup logging
 logger.setup_logging(full_logging_on)
+profiling.start(cpu_profile_dir)
 
-# This will be the new updatedLast time in Variables. Generating update time here, since observations are coming from the API sorted by id, not by datemodified -> cannot use time of last record
-now = datetime.datetime.now()
-thisUpdateTime = now.strftime("%Y-%m-%dT%H:%M:%S+00:00")
-thisUpdateTime = thisUpdateTime.replace(":", "%3A")
-thisUpdateTime = thisUpdateTime.replace("+", "%2B")
+# Validate targets and get their variable names before doing anything else
+if len(set(targets)) != len(targets):
+    raise ValueError(f"Duplicate targets: {sys.argv[1]}")
+variableNames = {target: get_variable_names("auto" if mode == "daemon" else mode, target) for target in targets}
 
-logger.log_minimal("Starting at " + str(thisUpdateTime))
-logger.log_minimal("Target " + str(target))
+logger.log_minimal("Run id " + logger.RUN_ID)
+logger.log_minimal("Targets " + ", ".join(targets))
 logger.log_minimal("Mode " + str(mode))
 logger.log_minimal("Full logging " + str(full_logging_on))
 logger.log_minimal("Sleep between iNat requests " + str(sleep))
 logger.log_minimal("State file " + str(state_file))
 
-# Load private data
-try:
-    privateObservationData = pandas.read_csv("./privatedata/latest-ALLAS.tsv", sep='\t')
-
-    # Exclude the last row if it is empty
-    if privateObservationData.iloc[-1].isnull().all():
-        privateObservationData = privateObservationData.iloc[:-1]
-
-    rowCount = len(privateObservationData.index)
-    logger.log_minimal("Loaded " + str(rowCount) + " private observation rows")
-except Exception as e:
-    raise Exception(f"Failed to load private observation data: {str(e)}")
-
-try:
-    private_emails = inatHelpers.load_private_emails()
-except Exception as e:
-    raise Exception(f"Failed to load private emails: {str(e)}")
-
-logger.log_full("------------------------------------------------")
+# Set by a termination signal in daemon mode
+stop_requested = threading.Event()
 
 # Setup signal handlers to upload state file on termination
 def signal_handler(signum, frame):
-    """Handle termination signals by uploading state file before exit."""
+    """Handle termination signals by uploading state file before exit.
+
+    In daemon mode, the first signal stops the daemon after the current page, and a second signal exits immediately.
+    """
+    if mode == "daemon" and not stop_requested.is_set():
+        logger.log_minimal(f"Received signal {signum}, stopping after the current page...")
+        stop_requested.set()
+        return
     if sync_to_allas:
         logger.log_minimal(f"Received signal {signum}, uploading state file to Allas...")
-        upload_to_allas.upload_state_file(state_file, silent=False)
+        sync_state(silent=False)
     sys.exit(1)
 
-# Register signal handlers / atexit upload only for auto mode (Allas sync)
+# Register signal handlers / atexit upload only for modes that sync to Allas
 if sync_to_allas:
     # Register signal handlers for graceful shutdown
     signal.signal(signal.SIGTERM, signal_handler)
@@ -196,8 +695,8 @@ if sync_to_allas:
 
     # Register atexit handler to upload on normal exit
     def upload_on_exit():
-        """Upload state file when script exits normally."""
-        upload_to_allas.upload_state_file(state_file, silent=True)
+        """Save registries and upload state file when script exits normally."""
+        sync_state(silent=True)
 
     atexit.register(upload_on_exit)
 
@@ -212,101 +711,61 @@ if mode == "manual" and not os.path.exists(state_file):
         f"e.g. docker run ... -v ./store:/app/store ..."
     )
 
-# Get latest update data
-try:
-    variables = read_variables(state_file)
-except Exception as e:
-    raise Exception(f"Failed to read variables: {str(e)}")
-
-# Automatic scheduled update
-if mode == "auto":
-    urlSuffix = ""
-    if target == "staging":
-        variableName_latest_obsId = "inat_auto_staging_latest_obsId"
-        variableName_latest_update = "inat_auto_staging_latest_update"
-        variableName_status = "inat_auto_staging_status"
-    elif target == "production":
-        variableName_latest_obsId = "inat_auto_production_latest_obsId"
-        variableName_latest_update = "inat_auto_production_latest_update"
-        variableName_status = "inat_auto_production_status"
-    else:
-        raise ValueError(f"Invalid target: {target}")
-
-# Manually triggered update
-elif mode == "manual":
-    urlSuffix = variables.get("inat_MANUAL_urlSuffix", "")
-    if target == "staging":
-        variableName_latest_obsId = "inat_MANUAL_staging_latest_obsId"
-        variableName_latest_update = "inat_MANUAL_staging_latest_update"
-        variableName_status = "inat_MANUAL_staging_status"
-    elif target == "production":
-        variableName_latest_obsId = "inat_MANUAL_production_latest_obsId"
-        variableName_latest_update = "inat_MANUAL_production_latest_update"
-        variableName_status = "inat_MANUAL_production_status"
-    else:
-        raise ValueError(f"Invalid target: {target}")
-else:
-    raise ValueError(f"Invalid mode: {mode}")
-
-latest_obs_id = variables.get(variableName_latest_obsId, 0)
-latest_update = variables.get(variableName_latest_update, "")
-
-if not latest_update:
-    raise ValueError(
-        f"Missing latest update time for {mode} mode. "
-        f"Expected key '{variableName_latest_update}' in {state_file}"
-    )
-
-# Reduce minutes from datetime. This is done because observations can appear on the API with delay of few minutes, which would cause them not to be processed. 
+# Ids pushed in auto and daemon modes are recorded per target, for the deletion sweep (see sweep.py), and ids pushed as captive for the captive sweep (see captive_sweep.py)
+registries = {}
+captiveRegistries = {}
+if sync_to_allas:
+    try:
+        registries = {target: registry.IdRegistry(target, sync_to_allas=True).load() for target in targets}
+        captiveRegistries = {target: registry.IdRegistry(target, sync_to_allas=True, name=registry.CAPTIVE_IDS).load() for target in targets}
+    except Exception as e:
+        raise Exception(f"Failed to load registry of pushed ids: {str(e)}")
+
+# Taxon cache for higher taxa, if INAT_TAXON_CACHE is enabled (see taxon_cache.py)
+if taxon_cache.enable(sync_to_allas) is not None:
+    atexit.register(taxon_cache.cache.save)
+
+# Mirror of raw observations, if INAT_MIRROR is enabled (see mirror.py)
+if mirror.enable(sync_to_allas) is not None:
+    atexit.register(mirror.writer.close)
+
+if mode == "daemon":
+    run_daemon()
+    sys.exit(0)
+
+# In manual mode, the state file can have named jobs, e.g. "inat_MANUAL_jobs": {"captive": "&captive=true", "casual": "&quality_grade=casual"}, that are run concurrently instead of inat_MANUAL_urlSuffix
+jobs = []
+if mode == "manual":
+    jobs = list(state.read_variables(state_file).get("inat_MANUAL_jobs") or {})
+    for job in jobs:
+        get_variable_names(mode, targets[0], job)
+    if jobs:
+        logger.log_minimal("Jobs " + ", ".join(jobs))
+
+run_history.start()
 try:
-    latest_update = subtract_minutes(latest_update, 3)
-except ValueError as e:
-    raise ValueError(f"Invalid latest update time: {str(e)}")
-
-# GET DATA
-page = 1
-props = {"sleepSeconds": sleep, "perPage": 100, "pageLimit": 10000, "urlSuffix": urlSuffix}
+    privateObservationData, private_emails = load_private_data()
 
-# For each pageful of data
-try:
-    for multiObservationDict in getInat.getUpdatedGenerator(latest_obs_id, latest_update, **props):
-        # If no more observations on page, finish the process by saving update time and resetting observation id to zero.
-        if multiObservationDict is False:
-            set_variable(variableName_latest_update, thisUpdateTime, file_path=state_file, upload_to_allas_enabled=sync_to_allas)
-            set_variable(variableName_latest_obsId, 0, file_path=state_file, upload_to_allas_enabled=sync_to_allas)
-            set_variable(variableName_status, "finished", file_path=state_file, upload_to_allas_enabled=sync_to_allas)
-            logger.log_minimal("Finished, latest update set to " + thisUpdateTime)
-            break
-
-        # CONVERT
-        dwObservations, latestObsId = inatToDw.convertObservations(multiObservationDict['results'], privateObservationData, private_emails)
-
-        # POST
-        postSuccess = postDw.postMulti(dwObservations, target)
-
-        # If this pageful contained data, and was saved successfully to DW, set latestObsId as variable
-        if postSuccess:
-            set_variable(variableName_latest_obsId, latestObsId, file_path=state_file, upload_to_allas_enabled=sync_to_allas)
-            set_variable(variableName_status, "ongoing", file_path=state_file, upload_to_allas_enabled=sync_to_allas)
-
-        if page < props["pageLimit"]:
-            page = page + 1
-        else:
-            # Exception because this should not happen in production (happens only if pageLimit is too low compared to frequency of this script being run)
-            raise Exception("Page limit " + str(props["pageLimit"]) + " reached, this means that either page limit is set for debugging, or value is too low for production.")
+    logger.log_full("------------------------------------------------")
 
+    if jobs:
+        run_jobs(privateObservationData, private_emails, jobs)
+        status = "finished"
+    else:
+        status = "finished" if run_cycle(privateObservationData, private_emails) else "stopped"
 except Exception as e:
     logger.log_minimal(f"Error during processing: {str(e)}")
+    run_history.record(mode, targets, "failed", sync_to_allas, jobs)
     if sync_to_allas:
         # Upload state file before exiting on error
         logger.log_minimal("Uploading state file to Allas before exit...")
-        upload_to_allas.upload_state_file(state_file, silent=False)
+        sync_state(silent=False)
     # Don't re-raise the exception, just exit with error code
     sys.exit(1)
 
+run_history.record(mode, targets, status, sync_to_allas, jobs)
+
 if sync_to_allas:
     # Upload state file on successful completion
     logger.log_minimal("Uploading final state file to Allas...")
-    upload_to_allas.upload_state_file(state_file, silent=False)
-
-
+    sync_state(silent=False)
@@ -1,4 +1,5 @@
 import math
+import os
 import re
 import pandas
 import logger
@@ -23,6 +24,116 @@ def is_valid_string(s):
   return bool(s) and not s.startswith(' ')
 
 
+# Header line stamping the version of a private data file, e.g. "# version 20240101T120000" as the first line of latest-ALLAS.tsv
+PRIVATE_VERSION_PREFIX = "# version "
+
+# Header line of a private data delta file: "# private-delta <from_version> <to_version>"
+PRIVATE_DELTA_PREFIX = "# private-delta "
+
+PRIVATE_DELTA_FILE = os.getenv('LOCAL_DATA_PATH_DELTA', './privatedata/latest-ALLAS-delta.tsv')
+
+
+class PrivateObservations(dict):
+  """Private observation data as a dict of records by observation id, with the version of the data.
+
+  Keyed by id, so that looking up an observation and applying a delta take time proportional to the number of observations looked up or changed.
+  """
+
+  def __init__(self, records, version):
+    super().__init__(records)
+    self.version = version
+
+
+def read_private_header(file_path, prefix):
+  """Read a header line of a private data file.
+
+  Returns:
+    list: Values after the prefix, or None if the file has no such header line
+  """
+  with open(file_path, 'r') as file:
+    first_line = file.readline().rstrip("\n")
+  if first_line.startswith(prefix):
+    return first_line[len(prefix):].split()
+  return None
+
+
+def read_private_records(file_path, skiprows):
+  df = pandas.read_csv(file_path, sep='\t', skiprows=skiprows)
+
+  # Exclude the last row if it is empty
+  if len(df.index) and df.iloc[-1].isnull().all():
+    df = df.iloc[:-1]
+
+  return df
+
+
+def load_private_observations(file_path="./privatedata/latest-ALLAS.tsv", delta_file_path=PRIVATE_DELTA_FILE):
+  """Load private observation data, and apply the delta file if it exists.
+
+  Args:
+    file_path (str): Private data file, from tools/simplify.py or tools/private_delta.py
+    delta_file_path (str): Delta file, from tools/private_delta.py
+
+  Raises:
+    Exception: If delta_file_path is not a delta file
+
+  Returns:
+    PrivateObservations: Private data by observation id
+  """
+  header = read_private_header(file_path, PRIVATE_VERSION_PREFIX)
+  df = read_private_records(file_path, 1 if header else 0)
+  version = header[0] if header else "unknown"
+
+  privateObservations = PrivateObservations(df.set_index('id', drop=False).to_dict(orient='index'), version)
+
+  logger.log_minimal("Loaded " + str(len(privateObservations)) + " private observation rows, version " + version)
+
+  if delta_file_path and os.path.exists(delta_file_path):
+    apply_private_delta(privateObservations, delta_file_path)
+
+  return privateObservations
+
+
+def apply_private_delta(privateObservations, delta_file_path):
+  """Apply a delta file to private observation data in place.
+
+  The delta applies only to the version it was made from. If the data already has the version the delta leads to, nothing is done. A delta made from another version is skipped with a warning, e.g. when the full file has been replaced in Allas and the old delta is still there, and the data is used as it is.
+
+  Args:
+    privateObservations (PrivateObservations): Private data, modified in place
+    delta_file_path (str): Delta file, from tools/private_delta.py
+
+  Raises:
+    Exception: If the file is not a delta file
+
+  Returns:
+    bool: True if the data has the version the delta leads to, False if the delta was skipped
+  """
+  header = read_private_header(delta_file_path, PRIVATE_DELTA_PREFIX)
+  if not header or len(header) != 2:
+    raise Exception(f"Not a private data delta file: {delta_file_path}")
+  from_version, to_version = header
+
+  if privateObservations.version == to_version:
+    logger.log_minimal(f"Private data is already version {to_version}, delta not applied")
+    return True
+  if privateObservations.version != from_version:
+    logger.log_minimal(f"Warning: private data delta from version {from_version} does not apply to version {privateObservations.version}, delta skipped")
+    return False
+
+  delta = read_private_records(delta_file_path, 1)
+  removals = delta[delta['op'] == 'remove']
+  upserts = delta[delta['op'] == 'upsert'].drop(columns='op')
+
+  for observationId in removals['id']:
+    privateObservations.pop(observationId, None)
+  privateObservations.update(upserts.set_index('id', drop=False).to_dict(orient='index'))
+  privateObservations.version = to_version
+
+  logger.log_minimal(f"Applied private data delta {from_version} -> {to_version}: {len(upserts.index)} upserts, {len(removals.index)} removals")
+  return True
+
+
 def load_private_emails():
   private_user_data = pandas.read_csv("./privatedata/inaturalist-suomi-20-users-ALLAS.csv", sep=',') 
 
@@ -83,13 +194,13 @@ def extractAtlasCode(text):
 
     allowedAtlasCodes = ["1","2","3","4","5","6","7","8","61","62","63","64","65","66","71","72","73","74","75","81","82"]
 
-    logger.log_full(" ATLASCODE: " + atlasCode + " ")
+    logger.log_record("atlascode", " ATLASCODE: %s ", atlasCode)
 
     # Check if code is allowed
     if atlasCode in allowedAtlasCodes:
         return atlasCode
     else:
-        logger.log_full(" Disallowed atlascode skipped: " + atlasCode + " ")
+        logger.log_record("atlascode", " Disallowed atlascode skipped: %s ", atlasCode)
         return None
 
 
@@ -4,6 +4,8 @@ import copy
 import logger
 
 import inatHelpers
+import taxon_cache
+import validate_dw
 
 """
 BUGFIXES COMPARED TO PHP-VERSION 9/2020:
@@ -36,14 +38,62 @@ Note:
 """
 
 
+# iNat observation fields read by convertObservations(), including helpers in inatHelpers. Nested objects and lists of objects list their own fields, other fields are marked with True.
+# When INAT_FIELDS=sparse, only these fields are requested from the API, and when INAT_FIELDS=verify, reading any other field fails (see getInat.py). Update this when the conversion starts to use a new field.
+CONSUMED_FIELDS = {
+  "id": True,
+  "uri": True,
+  "created_at": True, # Not used in the conversion, but for the freshness latency (see freshness.py)
+  "created_at_details": {"date": True},
+  "updated_at": True,
+  "observed_on_details": {"date": True},
+  "time_observed_at": True,
+  "taxon": {"id": True, "name": True, "rank": True, "iconic_taxon_name": True},
+  "species_guess": True,
+  "identifications": {"taxon": {"name": True}, "user": {"login": True, "name": True}},
+  "user": {"id": True, "login": True, "name": True, "orcid": True, "spam": True, "suspended": True},
+  "description": True,
+  "captive": True,
+  "non_traditional_projects": {"project_id": True},
+  "project_observations": {"project": {"id": True}},
+  "place_guess": True,
+  "tags": True,
+  "observation_photos": {"photo": {"id": True, "url": True, "license_code": True}},
+  "sounds": {"id": True, "file_url": True},
+  "ofvs": {"name_ci": True, "value_ci": True, "taxon": {"name": True}},
+  "license_code": True,
+  "annotations": {"controlled_attribute_id": True, "controlled_value_id": True, "vote_score": True},
+  "quality_metrics": {"user": {"spam": True, "suspended": True}, "agree": True, "metric": True},
+  "flags": {"id": True},
+  "spam": True,
+  "quality_grade": True,
+  "out_of_range": True,
+  "taxon_geoprivacy": True,
+  "geoprivacy": True,
+  "comments_count": True,
+  "num_identification_agreements": True,
+  "num_identification_disagreements": True,
+  "owners_identification_from_vision": True,
+  "oauth_application_id": True,
+  "identifications_count": True,
+  "identifications_most_agree": True,
+  "identifications_most_disagree": True,
+  "faves_count": True,
+  "geojson": {"coordinates": True},
+  "positional_accuracy": True,
+  "mappable": True,
+  "obscured": True,
+}
+
+
 def skipObservation(inat):
   # Note: This is only for skipping observations that don't YET have enough info to be worthwhile to be included to DW. Don't skip e.g. spam here, because then spammy observations would stay in DW forever. Instead mark them as having issues.
 
   if not inat["taxon"]:
-    logger.log_full(" skipping " + str(inat["id"]) + " without taxon.")
+    logger.log_record("skip", " skipping %s without taxon.", inat["id"])
     return True
   elif not inat["observed_on_details"]:
-    logger.log_full(" skipping " + str(inat["id"]) + " without date.")
+    logger.log_record("skip", " skipping %s without date.", inat["id"])
     return True
   else:
     return False
@@ -220,29 +270,24 @@ def convertObservations(inatObservations, privateObservationData, private_emails
   dwObservations = []
   lastUpdateKey = 0
 
+  # Fetch taxa of the page that are missing from the taxon cache, in bulk
+  if taxon_cache.cache is not None:
+    taxon_cache.cache.prefetch([inat['taxon']['id'] for inat in inatObservations if inat['taxon']])
+
   # For each observation
   for nro, inat in enumerate(inatObservations):
 
     # Get private data
-    privateData = privateObservationData.loc[privateObservationData['id'] == inat["id"]]
-    privateData = privateData.to_dict(orient='records')
-
-    logSuffix = ""
-
-    has_private_data = False
-    if privateData:
-      has_private_data = True
-      logSuffix = logSuffix + " has private data"
-      privateData = privateData[0]
+    privateData = privateObservationData.get(inat["id"])
+    has_private_data = privateData is not None
 
     # Get private emails
     has_private_email = False
     if inat['user']['login'] in private_emails:
       has_private_email = True
       private_email = private_emails[inat['user']['login']]
-      logSuffix = logSuffix + " has private email"
 
-    logger.log_full("Converting obs " + str(inat["id"]) + logSuffix)
+    logger.log_record("convert", "Converting obs %s%s%s", inat["id"], " has private data" if has_private_data else "", " has private email" if has_private_email else "")
 
     # Skip incomplete observations
     if skipObservation(inat):
@@ -318,6 +363,11 @@ def convertObservations(inatObservations, privateObservationData, private_emails
     # Scientific name iNat interprets this to be
     unitFacts.append({ "fact": "taxonInterpretationByiNaturalist", "value": inat['taxon']['name']})
 
+    # Higher taxa iNat places the taxon in, to resolve homonyms. Available only if the taxon cache is enabled.
+    if taxon_cache.cache is not None:
+      for rank, name in taxon_cache.cache.higher_taxa(inat['taxon']['id']).items():
+        unitFacts.append({ "fact": rank + "ByiNaturalist", "value": name})
+
 
     # Identifiers
     documentId = dw["collectionId"] + "/" + str(inat["id"])
@@ -525,7 +575,7 @@ def convertObservations(inatObservations, privateObservationData, private_emails
           unit['dead'] = value
     elif 'annotations' not in inat:
       # 2026-04-13: iNat data can now miss the annotations key
-      print(f"No annotations on {inat['id']}")
+      logger.log_record("annotations", "No annotations on %s", inat['id'])
         
 
     # Quality metrics
@@ -699,11 +749,15 @@ def convertObservations(inatObservations, privateObservationData, private_emails
     # -------------------------------------
     # Finalize
 
-    dwObservations.append(dw)
-
-    # Store last converted observation
+    # Store last converted observation, also if it is dropped, so that it is not fetched again
     lastUpdateKey = inat["id"]
 
+    # Repair or drop documents that the DW would reject, so that they don't fail the whole batch
+    if not validate_dw.validate_root(dw):
+      continue
+
+    dwObservations.append(dw)
+
   # End for each observations
 
   # Root elements for DW
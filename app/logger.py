@@ -1,32 +1,101 @@
+import datetime
+import json
 import logging
+import os
+import threading
+import time
 
-def setup_logging(logging_on):
+# Unique id of this run (start time + commit), included in JSON log lines
+RUN_ID = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ") + "-" + os.environ.get('APP_GIT_SHA', 'unknown')[:7]
+
+# Maximum number of per-record messages per second for each message key, 0 for no limit
+RECORD_RATE_LIMIT = float(os.getenv("LOG_RECORD_RATE_LIMIT", "20") or 0)
+
+_record_lock = threading.Lock()
+_record_buckets = {}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as JSON lines with the run id."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "run_id": RUN_ID,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(logging_on, json_output=None):
     """Configure logging level based on logging_on parameter.
-    
+
     Args:
         logging_on (bool): If True, enables full logging. If False, enables minimal logging.
+        json_output (bool): If True, log JSON lines. Defaults to True if LOG_FORMAT environment variable is "json".
     """
+    if json_output is None:
+        json_output = os.getenv("LOG_FORMAT", "text").lower() == "json"
+
     level = logging.DEBUG if logging_on else logging.INFO
-    logging.basicConfig(level=level, format='%(message)s')
-    
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_output else logging.Formatter('%(message)s'))
+    logging.basicConfig(level=level, handlers=[handler])
+
     # Suppress verbose boto3/botocore debug logs (they're too noisy)
     logging.getLogger('boto3').setLevel(logging.WARNING)
     logging.getLogger('botocore').setLevel(logging.WARNING)
     logging.getLogger('s3transfer').setLevel(logging.WARNING)
     logging.getLogger('urllib3').setLevel(logging.WARNING)
 
-def log_full(msg):
+def log_full(msg, *args):
     """Log a detailed message that should only appear in full logging mode.
-    
+
+    Formatting is lazy: give values as args, e.g. log_full("Converting obs %s", obsId), so that nothing is formatted when full logging is off.
+
     Args:
-        msg (str): The message to log
+        msg (str): The message to log, with %-style placeholders for args
+        args: Values for the placeholders
     """
-    logging.debug(msg)
+    logging.debug(msg, *args)
 
-def log_minimal(msg):
+def log_minimal(msg, *args):
     """Log an important message that should appear in both full and minimal logging modes.
-    
+
+    Args:
+        msg (str): The message to log, with %-style placeholders for args
+        args: Values for the placeholders
+    """
+    logging.info(msg, *args)
+
+def log_record(key, msg, *args):
+    """Log a per-record detail message in full logging mode, rate limited per key.
+
+    Use for messages written for each observation. When full logging is off, this returns after a single level check. When it is on, at most LOG_RECORD_RATE_LIMIT messages per second are written for each key, and the number of suppressed messages is added to the next message that is written.
+
     Args:
-        msg (str): The message to log
+        key (str): Message kind, e.g. "convert" or "skip"
+        msg (str): The message to log, with %-style placeholders for args
+        args: Values for the placeholders
     """
-    logging.info(msg) 
\ No newline at end of file
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+
+    if RECORD_RATE_LIMIT > 0:
+        now = time.monotonic()
+        with _record_lock:
+            tokens, updated, suppressed = _record_buckets.get(key, (RECORD_RATE_LIMIT, now, 0))
+            tokens = min(RECORD_RATE_LIMIT, tokens + (now - updated) * RECORD_RATE_LIMIT)
+            if tokens < 1:
+                _record_buckets[key] = (tokens, now, suppressed + 1)
+                return
+            _record_buckets[key] = (tokens - 1, now, 0)
+
+        if suppressed:
+            msg = msg + " (%d similar messages suppressed)"
+            args = args + (suppressed,)
+
+    logging.debug(msg, *args)
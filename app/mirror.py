@@ -0,0 +1,460 @@
+"""
+Local mirror of raw iNat observations, so that all observations can be converted again without fetching them from the iNat API.
+
+When enabled with INAT_MIRROR=true, inat.py appends each fetched page to a gzipped NDJSON segment in ./store/mirror. Each line has the observation id, its updated_at and the raw observation. A new segment is written on each run (and each daemon cycle), and synced to Allas in auto and daemon modes. Segments are append-only: an observation that is fetched again is written again, and the line with the latest updated_at of each id wins, or the latest written line if they are equal.
+
+The deletion sweep (sweep.py) writes a tombstone line, without the observation and with the time of the deletion as updated_at, for each observation it deletes from the DW, so that reconversion does not push it again. If the observation is fetched again later, e.g. after it has been moved back to Finland, its newer version wins.
+
+Convert the mirror again and push it to targets, e.g. after a change in inatToDw.py:
+python mirror.py reconvert <targets> [--taxon NAME_OR_ID] [--captive true|false] [--quality-grade GRADE] [--user LOGIN] [--min-id N] [--max-id N] [--workers N]
+
+Observations are read in the order they were mirrored, not in id order. A large reconversion can be run in parts with --min-id and --max-id. With INAT_TAXON_CACHE=true, missing taxa are fetched to the taxon cache before the conversion, and worker processes use the cache read-only.
+
+Merge segments into one, keeping only the newest line of each id:
+python mirror.py compact
+"""
+
+import argparse
+import array
+import collections
+import concurrent.futures
+import datetime
+import gzip
+import json
+import math
+import os
+import threading
+
+import numpy as np
+
+import download_from_allas
+import inatHelpers
+import inatToDw
+import logger
+import push_targets
+import taxon_cache
+import upload_to_allas
+import validate_dw
+
+MIRROR_ENABLED = os.getenv("INAT_MIRROR", "false").lower() == "true"
+
+MIRROR_DIR = './store/mirror'
+# Segments are stored in the Allas state bucket with this prefix, followed by the file name
+MIRROR_OBJECT_PREFIX = 'mirror-ALLAS/'
+# Names of segments that compact() has merged and removed, so that other hosts remove their local copies too
+COMPACTED_OBJECT_KEY = 'mirror-compacted-ALLAS.json'
+SEGMENT_PREFIX = 'mirror-'
+SEGMENT_SUFFIX = '.ndjson.gz'
+
+# Observations per task sent to a reconvert worker, same as an API page
+RECONVERT_BATCH_SIZE = 100
+# Log progress after this many pushed pages
+PROGRESS_INTERVAL_PAGES = 100
+
+# Lines start with the id and updated_at, so that they can be read without decoding the observation
+ID_PREFIX = '{"id": '
+UPDATED_AT_PREFIX = ', "updated_at": '
+# Lines of deleted observations end with this
+TOMBSTONE_SUFFIX = '"observation": null}\n'
+
+
+def _segment_name():
+    # Names sort in the order the segments were written
+    return SEGMENT_PREFIX + datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%fZ") + SEGMENT_SUFFIX
+
+
+def _line(observation):
+    return json.dumps({"id": observation["id"], "updated_at": observation.get("updated_at"), "observation": observation}, ensure_ascii=False) + "\n"
+
+
+def _tombstone(observationId, deletedAt):
+    return json.dumps({"id": observationId, "updated_at": deletedAt, "observation": None}) + "\n"
+
+
+def observation_id(line):
+    """Get the observation id of a mirror line without decoding it."""
+    return int(line[len(ID_PREFIX):line.index(",")])
+
+
+def observation_updated_at(line):
+    """Get updated_at of a mirror line as epoch seconds without decoding the observation, or -inf if it is missing."""
+    start = line.index(",") + len(UPDATED_AT_PREFIX)
+    if line[start] != '"':
+        return -math.inf
+    return datetime.datetime.fromisoformat(line[start + 1:line.index('"', start + 1)]).timestamp()
+
+
+class MirrorWriter:
+    """Writes fetched observations to a new segment. Observations can be upserted from several threads, e.g. concurrent manual jobs.
+
+    Args:
+        sync_to_allas (bool): If True, upload the segment to Allas when it is closed
+    """
+
+    def __init__(self, sync_to_allas=False):
+        self.sync_to_allas = sync_to_allas
+        self._file = None
+        self._path = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def upsert(self, observations):
+        """Append observations to the current segment, opening a new segment if needed.
+
+        Args:
+            observations (list): Observations in iNat format, as returned by the API
+        """
+        self._write([_line(observation) for observation in observations])
+
+    def remove(self, observationIds):
+        """Append tombstones of observations that have been deleted from the DW.
+
+        Args:
+            observationIds (list): iNat observation ids
+        """
+        deletedAt = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        self._write([_tombstone(int(observationId), deletedAt) for observationId in observationIds])
+
+    def _write(self, lines):
+        with self._lock:
+            if self._file is None:
+                os.makedirs(MIRROR_DIR, exist_ok=True)
+                self._path = os.path.join(MIRROR_DIR, _segment_name())
+                self._file = gzip.open(self._path + '.tmp', 'wt', encoding='utf-8')
+                self._count = 0
+            self._file.writelines(lines)
+            self._count += len(lines)
+
+    def close(self):
+        """Close the current segment and upload it to Allas if sync is enabled. The next upsert starts a new segment."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            os.replace(self._path + '.tmp', self._path)
+            path, count = self._path, self._count
+            self._file = None
+
+        name = os.path.basename(path)
+        if self.sync_to_allas and not upload_to_allas.upload_object(path, MIRROR_OBJECT_PREFIX + name, silent=True):
+            logger.log_minimal(f"Failed to upload mirror segment {name} to Allas")
+        logger.log_minimal(f"Wrote {count} observations to mirror segment {name}")
+
+
+# Writer used by inat.py, set by enable()
+writer = None
+
+
+def enable(sync_to_allas=False):
+    """Set up the mirror writer, if INAT_MIRROR is enabled.
+
+    Returns:
+        MirrorWriter: The writer, or None if disabled
+    """
+    global writer
+    if MIRROR_ENABLED:
+        writer = MirrorWriter(sync_to_allas)
+    return writer
+
+
+def sync_segments():
+    """Sync local segments with Allas, if it is configured.
+
+    Segments that are in Allas but not local are downloaded, and local segments that are not in Allas are uploaded, e.g. segments of manual runs or segments whose upload failed. Only local segments that compact() has recorded as merged are removed.
+
+    Raises:
+        Exception: If a segment cannot be downloaded
+
+    Returns:
+        list: Paths of local segments, oldest first
+    """
+    os.makedirs(MIRROR_DIR, exist_ok=True)
+    local = {name for name in os.listdir(MIRROR_DIR) if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)}
+    if not download_from_allas.state_bucket_configured():
+        return [os.path.join(MIRROR_DIR, name) for name in sorted(local)]
+
+    remote = {key[len(MIRROR_OBJECT_PREFIX):] for key in download_from_allas.list_state_objects(MIRROR_OBJECT_PREFIX)}
+    compacted = set((download_from_allas.read_json_object(COMPACTED_OBJECT_KEY) or {}).get("segments", []))
+
+    for name in sorted(remote - local):
+        if not download_from_allas.download_state_object(MIRROR_OBJECT_PREFIX + name, os.path.join(MIRROR_DIR, name)):
+            raise Exception(f"Failed to download mirror segment {name}")
+    for name in sorted(local - remote):
+        if name in compacted:
+            os.remove(os.path.join(MIRROR_DIR, name))
+        elif not upload_to_allas.upload_object(os.path.join(MIRROR_DIR, name), MIRROR_OBJECT_PREFIX + name, silent=True):
+            logger.log_minimal(f"Failed to upload mirror segment {name} to Allas, keeping it locally")
+
+    return [os.path.join(MIRROR_DIR, name) for name in sorted((local - compacted) | remote)]
+
+
+def select_latest(segmentPaths, minId=None, maxId=None):
+    """Find the newest line of each observation id, i.e. the line with the latest updated_at. Lines with the same updated_at are ordered by segment and line, e.g. when the same version has been fetched by overlapping runs.
+
+    Args:
+        segmentPaths (list): Segment paths, oldest first
+        minId (int): Skip observations with a smaller id
+        maxId (int): Skip observations with a larger id
+
+    Returns:
+        tuple: Line numbers to read by segment index (sorted numpy arrays), and the number of observations
+    """
+    ids, updated, segments, lines = array.array('q'), array.array('d'), array.array('q'), array.array('q')
+    for segmentIndex, path in enumerate(segmentPaths):
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            for lineNumber, line in enumerate(file):
+                ids.append(observation_id(line))
+                updated.append(observation_updated_at(line))
+                segments.append(segmentIndex)
+                lines.append(lineNumber)
+
+    ids, updated = np.frombuffer(ids, dtype=np.int64), np.frombuffer(updated, dtype=np.float64)
+    segments, lines = np.frombuffer(segments, dtype=np.int64), np.frombuffer(lines, dtype=np.int64)
+    if not len(ids):
+        return {}, 0
+
+    # Overlapping runs, e.g. a long manual job and an auto run, can write an older version to a later segment
+    order = np.lexsort((lines, segments, updated, ids))
+    sortedIds = ids[order]
+    # The last entry of each id in (id, updated_at, segment, line) order is the newest
+    isNewest = np.append(sortedIds[1:] != sortedIds[:-1], True)
+    if minId is not None:
+        isNewest &= sortedIds >= minId
+    if maxId is not None:
+        isNewest &= sortedIds <= maxId
+    selected = order[isNewest]
+
+    byIndex = {}
+    for segmentIndex in np.unique(segments[selected]):
+        inSegment = selected[segments[selected] == segmentIndex]
+        byIndex[int(segmentIndex)] = np.sort(lines[inSegment])
+    return byIndex, len(selected)
+
+
+def iter_latest(segmentPaths, minId=None, maxId=None, tombstones=False):
+    """Yield the newest raw line of each observation, in segment order. Observations whose newest line is a tombstone are skipped, unless tombstones is True."""
+    byIndex, count = select_latest(segmentPaths, minId, maxId)
+    logger.log_minimal(f"Mirror has {count} observations to read from {len(segmentPaths)} segments")
+    for segmentIndex, lineNumbers in byIndex.items():
+        position = 0
+        with gzip.open(segmentPaths[segmentIndex], 'rt', encoding='utf-8') as file:
+            for lineNumber, line in enumerate(file):
+                if lineNumber == lineNumbers[position]:
+                    if tombstones or not line.endswith(TOMBSTONE_SUFFIX):
+                        yield line
+                    position += 1
+                    if position == len(lineNumbers):
+                        break
+
+
+def matches(observation, filters):
+    """Check an observation against reconvert filters.
+
+    Args:
+        observation (dict): Observation in iNat format
+        filters (dict): Optional keys taxon (name or id, matches also descendants), captive (bool), quality_grade and user (login)
+
+    Returns:
+        bool: True if the observation matches all filters
+    """
+    if filters.get("taxon") is not None:
+        taxon = observation.get("taxon") or {}
+        value = filters["taxon"]
+        isMatch = taxon.get("name") == value
+        if not isMatch and value.isdigit():
+            isMatch = taxon.get("id") == int(value) or int(value) in (taxon.get("ancestor_ids") or [])
+        if not isMatch:
+            return False
+    if filters.get("captive") is not None and bool(observation.get("captive")) != filters["captive"]:
+        return False
+    if filters.get("quality_grade") is not None and observation.get("quality_grade") != filters["quality_grade"]:
+        return False
+    if filters.get("user") is not None and (observation.get("user") or {}).get("login") != filters["user"]:
+        return False
+    return True
+
+
+# Private data of a reconvert worker process, set by _init_worker()
+_worker = {}
+
+
+def _init_worker(logging_on):
+    logger.setup_logging(logging_on)
+    _worker["privateObservationData"] = inatHelpers.load_private_observations()
+    _worker["private_emails"] = inatHelpers.load_private_emails()
+    # Taxa have been fetched by the parent process, see _prefetch_taxa()
+    taxon_cache.enable(fetch=False)
+
+
+def _prefetch_taxa(segmentPaths, filters, minId=None, maxId=None):
+    """Fetch taxa of the observations to reconvert to the taxon cache, and save it, before worker processes load it.
+
+    Workers use the cache read-only, so that taxa are fetched only here, within the rate limit of this process, and the fetched taxa are saved.
+    """
+    cache = taxon_cache.enable(download_from_allas.state_bucket_configured())
+    if cache is None:
+        return
+    taxonIds = set()
+    for line in iter_latest(segmentPaths, minId, maxId):
+        observation = json.loads(line)["observation"]
+        if observation.get("taxon") and matches(observation, filters):
+            taxonIds.add(observation["taxon"]["id"])
+    logger.log_minimal(f"Fetching {len(cache.missing(taxonIds))} of {len(taxonIds)} taxa to taxon cache")
+    cache.prefetch(taxonIds)
+    cache.save()
+
+
+def _convert_batch(lines, filters):
+    observations = [json.loads(line)["observation"] for line in lines]
+    observations = [observation for observation in observations if matches(observation, filters)]
+    if not observations:
+        return None, 0, collections.Counter()
+    dwObservations, latestObsId = inatToDw.convertObservations(observations, _worker["privateObservationData"], _worker["private_emails"])
+    return dwObservations, latestObsId, validate_dw.take_counts()
+
+
+def _batches(lines, size):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _log_progress(target, dwObservations, latestObsId):
+    logger.log_record("mirror", "Pushed %s reconverted observations to %s", len(dwObservations["roots"]), target)
+
+
+def reconvert(targets, filters, minId=None, maxId=None, workers=None, logging_on=False):
+    """Convert the newest version of each mirrored observation again, in parallel, and push the results to targets.
+
+    Args:
+        targets (list): Targets to push to (staging, production or file)
+        filters (dict): Filters, see matches()
+        minId (int): Skip observations with a smaller id
+        maxId (int): Skip observations with a larger id
+        workers (int): Number of worker processes, default is the number of CPUs
+        logging_on (bool): Full logging in worker processes
+
+    Raises:
+        Exception: If pushing fails for all targets
+    """
+    segmentPaths = sync_segments()
+    _prefetch_taxa(segmentPaths, filters, minId, maxId)
+    pushers = [push_targets.TargetPusher(target, _log_progress) for target in targets]
+    workers = workers or os.cpu_count()
+    converted = 0
+    pages = 0
+
+    def handle(result):
+        nonlocal converted, pages
+        dwObservations, batchLatestId, counts = result
+        validate_dw.add_counts(counts)
+        if not dwObservations or not dwObservations["roots"]:
+            return
+        if all(pusher.failed for pusher in pushers):
+            raise Exception("Posting failed for all targets")
+        for pusher in pushers:
+            pusher.put(dwObservations, batchLatestId)
+        converted += len(dwObservations["roots"])
+        pages += 1
+        if pages % PROGRESS_INTERVAL_PAGES == 0:
+            logger.log_minimal(f"Reconverted {converted} observations")
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(logging_on,)) as executor:
+            # Only a few batches per worker are in flight, so that the mirror is not read to memory ahead of the workers. Results are handled in order.
+            pending = collections.deque()
+            for batch in _batches(iter_latest(segmentPaths, minId, maxId), RECONVERT_BATCH_SIZE):
+                pending.append(executor.submit(_convert_batch, batch, filters))
+                if len(pending) >= workers * 4:
+                    handle(pending.popleft().result())
+            while pending:
+                handle(pending.popleft().result())
+    finally:
+        for pusher in pushers:
+            pusher.close()
+
+    counts = validate_dw.log_counts()
+    logger.log_minimal(f"Reconverted {converted} observations, {counts['dropped']} dropped by validation")
+
+    failedTargets = [pusher.target for pusher in pushers if pusher.failed]
+    if failedTargets:
+        raise Exception("Posting failed for targets: " + ", ".join(failedTargets))
+
+
+def compact():
+    """Merge all segments into one that has only the newest line of each id, and remove the merged segments locally and from Allas.
+
+    The merged segment is named after the newest merged segment, so that segments written while compacting still sort after it.
+    """
+    segmentPaths = sync_segments()
+    if len(segmentPaths) < 2:
+        logger.log_minimal("Nothing to compact")
+        return
+
+    newestName = os.path.basename(segmentPaths[-1])
+    path = os.path.join(MIRROR_DIR, newestName[:-len(SEGMENT_SUFFIX)] + "-compacted" + SEGMENT_SUFFIX)
+    count = 0
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as file:
+        # Tombstones are kept, so that they still win over older versions in segments that have not been synced yet
+        for line in iter_latest(segmentPaths, tombstones=True):
+            file.write(line)
+            count += 1
+    os.replace(path + '.tmp', path)
+
+    syncToAllas = download_from_allas.state_bucket_configured()
+    if syncToAllas:
+        if not upload_to_allas.upload_object(path, MIRROR_OBJECT_PREFIX + os.path.basename(path), silent=True):
+            os.remove(path)
+            raise Exception("Failed to upload compacted mirror segment to Allas")
+        mergedNames = [os.path.basename(segmentPath) for segmentPath in segmentPaths]
+        if upload_to_allas.update_json_object(COMPACTED_OBJECT_KEY, lambda data: {"segments": sorted(set((data or {}).get("segments", [])) | set(mergedNames))}) is None:
+            raise Exception("Failed to record merged mirror segments in Allas, they are not removed")
+
+    # Remove merged segments only after the compacted segment is stored and the merged segments are recorded
+    for segmentPath in segmentPaths:
+        if syncToAllas:
+            upload_to_allas.delete_object(MIRROR_OBJECT_PREFIX + os.path.basename(segmentPath), silent=True)
+        os.remove(segmentPath)
+    logger.log_minimal(f"Compacted {len(segmentPaths)} segments to {os.path.basename(path)} with {count} observations")
+
+
+def _parse_bool(value):
+    if value not in ("true", "false"):
+        raise argparse.ArgumentTypeError("must be true or false")
+    return value == "true"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reconvert or compact the local mirror of raw iNat observations.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    reconvertParser = subparsers.add_parser("reconvert", help="Convert mirrored observations again and push them to targets")
+    reconvertParser.add_argument("targets", help="Comma-separated targets: staging, production, file")
+    reconvertParser.add_argument("--taxon", help="Taxon name or iNat taxon id, id matches also descendants")
+    reconvertParser.add_argument("--captive", type=_parse_bool, help="true or false")
+    reconvertParser.add_argument("--quality-grade", help="e.g. research, needs_id, casual")
+    reconvertParser.add_argument("--user", help="iNat user login")
+    reconvertParser.add_argument("--min-id", type=int)
+    reconvertParser.add_argument("--max-id", type=int)
+    reconvertParser.add_argument("--workers", type=int)
+    reconvertParser.add_argument("--full-logging", action="store_true")
+
+    subparsers.add_parser("compact", help="Merge segments, keeping the newest version of each observation")
+
+    args = parser.parse_args()
+
+    if args.command == "reconvert":
+        logger.setup_logging(args.full_logging)
+        targets = [target.strip() for target in args.targets.split(",") if target.strip()]
+        if not targets or any(target not in ("staging", "production", "file") for target in targets):
+            raise ValueError("Targets must be comma-separated staging, production or file")
+        filters = {"taxon": args.taxon, "captive": args.captive, "quality_grade": args.quality_grade, "user": args.user}
+        reconvert(targets, filters, args.min_id, args.max_id, args.workers, args.full_logging)
+    else:
+        logger.setup_logging(False)
+        compact()
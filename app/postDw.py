@@ -2,6 +2,9 @@ import requests
 import os
 import logger
 
+# Reuse connections to the API between requests, which matters for long-running processes (daemon mode)
+session = requests.Session()
+
 def get_token(target):
     """Get API token for the specified target environment.
 
@@ -63,7 +66,7 @@ def postSingle(dwObs, target):
     logger.log_full(f"Pushing to {target} API")
 
     logger.log_full("Pushing to " + targetUrl)
-    targetResponse = requests.post(url=targetUrl, json=dwObs, headers=headers)
+    targetResponse = session.post(url=targetUrl, json=dwObs, headers=headers)
 
     if targetResponse.status_code == 200:
         logger.log_full("DW API responded " + str(targetResponse.status_code))
@@ -91,7 +94,7 @@ def postMulti(dwObs, target):
     logger.log_full(f"Pushing to {target} API")
 
     logger.log_full("Pushing to " + targetUrl)
-    targetResponse = requests.post(url=targetUrl, json=dwObs, headers=headers)
+    targetResponse = session.post(url=targetUrl, json=dwObs, headers=headers)
 
     if targetResponse.status_code == 200:
         logger.log_full("API responded " + str(targetResponse.status_code))
@@ -101,3 +104,31 @@ def postMulti(dwObs, target):
         raise Exception(f"API responded with error {errorCode}: {targetResponse.text}")
 
 
+def postDelete(observationIds, target):
+    """Send DELETE commands for observations to FinBIF DW API.
+
+    Args:
+        observationIds (list): iNat observation ids
+        target (string): Either "staging" or "production"
+
+    Raises:
+        ValueError: If target is invalid
+        Exception: If API request fails
+
+    Returns:
+        bool: True if successful
+    """
+    targetUrl, headers = get_request_config(target)
+    headers["Content-Type"] = "text/plain"
+
+    payload = "\n".join(f"DELETE http://tun.fi/HR.3211/{observationId}" for observationId in observationIds)
+
+    logger.log_full(f"Sending {len(observationIds)} DELETE commands to " + targetUrl)
+    targetResponse = session.post(url=targetUrl, data=payload.encode("utf-8"), headers=headers)
+
+    if targetResponse.status_code == 200:
+        logger.log_full("API responded " + str(targetResponse.status_code))
+        return True
+    else:
+        errorCode = str(targetResponse.status_code)
+        raise Exception(f"API responded with error {errorCode}: {targetResponse.text}")
@@ -0,0 +1,294 @@
+"""
+Opt-in memory and CPU profiling, and memory budget for inat.py and single.py.
+
+Code is divided into stages with `with profiling.stage("convert"):`. Settings from environment variables:
+
+INAT_MEMORY_PROFILE=true
+    Trace allocations with tracemalloc. At the end of each stage, records traced peak, RSS and the top allocation sites of the stage, and logs a per-stage report when the script exits. Tracing slows the run down considerably.
+INAT_MEMORY_BUDGET_MB=<megabytes>
+    Fail with a clear error when the process RSS exceeds the budget at a stage boundary, instead of being killed by the OOM killer. Works also without profiling, and costs one read of /proc/self/statm per stage.
+
+--profile[=DIR] (command line option of inat.py and single.py)
+    Profile CPU time per stage. Each stage is run under cProfile, and the stacks of threads that are in a stage are sampled every 5 ms. When the script exits, writes <stage>.pstats (for pstats or snakeviz) and <stage>.collapsed (collapsed stacks for flamegraph.pl or speedscope) to DIR (default ./profile), and logs the sampled time and the top functions by own time of each stage. cProfile slows Python code down, so compare stages with each other rather than with unprofiled runs.
+
+Stages: private_load, email_load (load), fetch, page_decode, convert, post and state_sync. Stages can run concurrently in several threads (e.g. post), so traced peaks of overlapping stages include each other's allocations.
+"""
+
+import atexit
+import collections
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+import logger
+
+MEMORY_PROFILE_ENABLED = os.getenv("INAT_MEMORY_PROFILE", "false").lower() == "true"
+MEMORY_BUDGET_MB = int(os.getenv("INAT_MEMORY_BUDGET_MB", "0") or 0)
+
+TOP_ALLOCATION_SITES = 10
+
+CPU_PROFILE_DIR = './profile'
+CPU_SAMPLE_INTERVAL_SECONDS = 0.005
+TOP_FUNCTIONS = 10
+
+_lock = threading.Lock()
+_stages = {}
+# Wall time spent in each stage, summed over threads, for the run history
+_stage_seconds = collections.Counter()
+
+# Leave out allocations made by tracemalloc itself and by imports
+_SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+
+def _rss_mb():
+    """Return current resident set size in megabytes."""
+    try:
+        with open("/proc/self/statm") as file:
+            resident_pages = int(file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        # Not Linux: fall back to peak RSS, which ru_maxrss reports in kilobytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def check_budget(stage_name):
+    """Raise an exception if RSS exceeds INAT_MEMORY_BUDGET_MB.
+
+    Raises:
+        Exception: If memory budget is exceeded
+    """
+    if MEMORY_BUDGET_MB <= 0:
+        return
+    rss = _rss_mb()
+    if rss > MEMORY_BUDGET_MB:
+        raise Exception(f"Memory budget exceeded after stage '{stage_name}': RSS {rss:.0f} MB, budget {MEMORY_BUDGET_MB} MB (INAT_MEMORY_BUDGET_MB)")
+
+
+def parse_profile_argument(argv):
+    """Remove --profile or --profile=DIR from command line arguments.
+
+    Args:
+        argv (list): Command line arguments, modified in place
+
+    Returns:
+        str: Output directory of the CPU profile, or None if not given
+    """
+    output_dir = None
+    for argument in list(argv[1:]):
+        if argument == "--profile" or argument.startswith("--profile="):
+            argv.remove(argument)
+            output_dir = argument.partition("=")[2] or CPU_PROFILE_DIR
+    return output_dir
+
+
+def start(cpu_profile_dir=None):
+    """Start allocation tracing if INAT_MEMORY_PROFILE is enabled, and CPU profiling if an output directory is given. Reports are logged on exit.
+
+    Args:
+        cpu_profile_dir (str): Output directory of the CPU profile, from parse_profile_argument()
+    """
+    if cpu_profile_dir:
+        _start_cpu(cpu_profile_dir)
+    if not MEMORY_PROFILE_ENABLED:
+        return
+    tracemalloc.start()
+    atexit.register(report)
+    logger.log_minimal("Memory profiling on" + (f", budget {MEMORY_BUDGET_MB} MB" if MEMORY_BUDGET_MB > 0 else ""))
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Context manager marking a stage of the pipeline for profiling, budget checks and the wall time per stage of the run history.
+
+    Args:
+        name (str): Stage name, e.g. "private_load", "page_decode", "convert", "post"
+    """
+    started = time.perf_counter()
+    try:
+        if _cpu_profile_dir is None:
+            with _memory_stage(name):
+                yield
+        else:
+            with _cpu_stage(name), _memory_stage(name):
+                yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with _lock:
+            _stage_seconds[name] += elapsed
+
+
+@contextlib.contextmanager
+def _memory_stage(name):
+    if not tracemalloc.is_tracing():
+        yield
+        check_budget(name)
+        return
+
+    before = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+    tracemalloc.reset_peak()
+    yield
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+    rss = _rss_mb()
+
+    with _lock:
+        stats = _stages.setdefault(name, {"count": 0, "peak_traced_mb": 0.0, "max_rss_mb": 0.0, "top": []})
+        stats["count"] += 1
+        stats["max_rss_mb"] = max(stats["max_rss_mb"], rss)
+        # Keep allocation sites of the occurrence with the highest peak
+        if peak / 1024 / 1024 >= stats["peak_traced_mb"]:
+            stats["peak_traced_mb"] = peak / 1024 / 1024
+            stats["top"] = after.compare_to(before, "lineno")[:TOP_ALLOCATION_SITES]
+
+    check_budget(name)
+
+
+def take_stage_seconds():
+    """Return wall time spent in each stage since the previous call, summed over threads, and reset it.
+
+    Returns:
+        dict: Seconds by stage name
+    """
+    global _stage_seconds
+    with _lock:
+        stage_seconds = _stage_seconds
+        _stage_seconds = collections.Counter()
+    return {name: round(seconds, 3) for name, seconds in stage_seconds.items()}
+
+
+def report():
+    """Log traced peak, RSS and top allocation sites per stage."""
+    with _lock:
+        logger.log_minimal("-----")
+        logger.log_minimal(f"Memory profile, peak RSS of the process {_peak_rss_mb():.0f} MB")
+        for name, stats in _stages.items():
+            logger.log_minimal(f"Stage {name}: {stats['count']} times, traced peak {stats['peak_traced_mb']:.1f} MB, max RSS {stats['max_rss_mb']:.0f} MB")
+            for statistic in stats["top"]:
+                logger.log_minimal(f"    {statistic}")
+
+
+# CPU profiling state, set by _start_cpu()
+_cpu_profile_dir = None
+# Stages that each thread is in, innermost last
+_thread_stages = {}
+# cProfile profilers by (stage, thread id), since a profiler only sees the thread it was enabled in
+_profilers = {}
+# Sampled collapsed stacks by stage
+_samples = collections.defaultdict(collections.Counter)
+_sampler_stop = threading.Event()
+
+
+def _start_cpu(output_dir):
+    global _cpu_profile_dir
+    os.makedirs(output_dir, exist_ok=True)
+    _cpu_profile_dir = output_dir
+    threading.Thread(target=_sample, name="cpu-sampler", daemon=True).start()
+    atexit.register(report_cpu)
+    logger.log_minimal(f"CPU profiling on, writing profiles to {output_dir}")
+
+
+def _profiler(name, thread_id):
+    key = (name, thread_id)
+    with _lock:
+        if key not in _profilers:
+            _profilers[key] = cProfile.Profile()
+        return _profilers[key]
+
+
+@contextlib.contextmanager
+def _cpu_stage(name):
+    # Only one profiler can be active in a thread, so the profiler of an outer stage is paused during an inner stage
+    thread_id = threading.get_ident()
+    stages = _thread_stages.setdefault(thread_id, [])
+    if stages:
+        _profiler(stages[-1], thread_id).disable()
+    profiler = _profiler(name, thread_id)
+    stages.append(name)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        stages.pop()
+        if stages:
+            _profiler(stages[-1], thread_id).enable()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample():
+    """Record the stack of each thread that is in a stage, every CPU_SAMPLE_INTERVAL_SECONDS."""
+    while not _sampler_stop.wait(CPU_SAMPLE_INTERVAL_SECONDS):
+        frames = sys._current_frames()
+        for thread_id, stages in list(_thread_stages.items()):
+            frame = frames.get(thread_id)
+            try:
+                name = stages[-1]
+            except IndexError:
+                continue
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            _samples[name][";".join(reversed(stack))] += 1
+
+
+def _top_functions(stats):
+    """Return the TOP_FUNCTIONS functions with the most own time, as (seconds, label)."""
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:TOP_FUNCTIONS]
+    return [(own_time, f"{os.path.basename(filename)}:{line}({function})") for (filename, line, function), (_, _, own_time, _, _) in functions]
+
+
+def report_cpu():
+    """Write pstats and collapsed stack files per stage, and log sampled time and top functions of each stage."""
+    _sampler_stop.set()
+    with _lock:
+        profilers = dict(_profilers)
+
+    logger.log_minimal("-----")
+    logger.log_minimal(f"CPU profile in {_cpu_profile_dir}")
+    for name in sorted({name for name, _ in profilers}):
+        stats = None
+        for (stage_name, _), profiler in profilers.items():
+            if stage_name != name:
+                continue
+            profiler.create_stats()
+            if not profiler.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profiler, stream=io.StringIO())
+            else:
+                stats.add(profiler)
+        if stats is None:
+            continue
+        stats.dump_stats(os.path.join(_cpu_profile_dir, f"{name}.pstats"))
+
+        samples = _samples.get(name, {})
+        with open(os.path.join(_cpu_profile_dir, f"{name}.collapsed"), "w") as file:
+            for stack, count in sorted(samples.items()):
+                file.write(f"{stack} {count}\n")
+
+        sampled_seconds = sum(samples.values()) * CPU_SAMPLE_INTERVAL_SECONDS
+        logger.log_minimal(f"Stage {name}: {sampled_seconds:.2f} s sampled, {stats.total_tt:.2f} s profiled, top functions by own time:")
+        for own_time, label in _top_functions(stats):
+            logger.log_minimal(f"    {own_time:8.3f} s  {label}")
@@ -0,0 +1,84 @@
+import queue
+import threading
+import time
+
+import file_sink
+import freshness
+import logger
+import postDw
+import profiling
+
+
+class TargetPusher:
+    """Posts converted pages to one target in a background thread.
+
+    Pages are handed over with put() and posted in order. After each successfully posted page, on_success(target, dwObservations, latestObsId) is called, so that the caller can store a checkpoint for this target. If posting fails, the pusher marks itself failed and discards further pages, so that a failing target does not stop other targets. A slow target can have at most max_pending_pages pages waiting before put() blocks.
+
+    Target "file" writes the pages to files (see file_sink.py) instead of posting them.
+    """
+
+    def __init__(self, target, on_success, max_pending_pages=10):
+        self.target = target
+        self.on_success = on_success
+        self.failed = False
+        self.error = None
+        self.posted_pages = 0
+        self._sink = file_sink.FileSink() if target == "file" else None
+        self._queue = queue.Queue(maxsize=max_pending_pages)
+        self._thread = threading.Thread(target=self._run, name=f"push-{target}", daemon=True)
+        self._thread.start()
+
+    def put(self, dwObservations, latestObsId, timing=None):
+        """Queue a converted page for posting.
+
+        Args:
+            dwObservations (dict): Observations in FinBIF DW format
+            latestObsId (int): Id of the last observation on the page
+            timing (freshness.PageTiming): Times of the page, if freshness latency is measured
+        """
+        if not self.failed:
+            self._queue.put((dwObservations, latestObsId, timing))
+
+    def wait(self):
+        """Wait until pages queued so far have been posted, or discarded after a failure."""
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """Wait until all queued pages have been posted and stop the thread."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        if self._sink is not None:
+            self._sink.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                # After a failure, keep draining the queue so that put() never blocks
+                if not self.failed:
+                    self._post(*item)
+            finally:
+                self._queue.task_done()
+
+    def _post(self, dwObservations, latestObsId, timing):
+        try:
+            postStarted = time.time()
+            with profiling.stage("post"):
+                if self._sink is not None:
+                    postSuccess = self._sink.write(dwObservations)
+                else:
+                    postSuccess = postDw.postMulti(dwObservations, self.target)
+            if postSuccess:
+                if timing is not None:
+                    freshness.observe(timing, postStarted, time.time())
+                self.posted_pages += 1
+                self.on_success(self.target, dwObservations, latestObsId)
+        except Exception as e:
+            self.failed = True
+            self.error = e
+            logger.log_minimal(f"Posting to {self.target} failed, no more pages will be posted to it on this run: {str(e)}")
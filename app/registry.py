@@ -0,0 +1,124 @@
+import os
+import threading
+
+import numpy as np
+
+import logger
+import upload_to_allas
+import download_from_allas
+
+REGISTRY_FILE = './store/{name}-{target}.npz'
+REGISTRY_OBJECT_KEY = '{name}-{target}-ALLAS.npz'
+
+# Registry of ids pushed to a target, for the deletion sweep
+PUSHED_IDS = 'pushed-ids'
+# Registry of ids last pushed to a target as captive (not wild), for the captive sweep
+CAPTIVE_IDS = 'captive-ids'
+
+
+def document_ids_to_observation_ids(dwObservations):
+    """Get iNat observation ids of documents converted by inatToDw.convertObservations().
+
+    Args:
+        dwObservations (dict): Observations in FinBIF DW format
+
+    Returns:
+        list: iNat observation ids as integers
+    """
+    return [int(dw["documentId"].rsplit("/", 1)[1]) for dw in dwObservations["roots"]]
+
+
+def captive_observation_ids(dwObservations):
+    """Get iNat observation ids of converted documents that have a unit marked as not wild, i.e. captive on iNat."""
+    return [
+        int(dw["documentId"].rsplit("/", 1)[1])
+        for dw in dwObservations["roots"]
+        if any(unit.get("wild") is False for gathering in dw["publicDocument"]["gatherings"] for unit in gathering["units"])
+    ]
+
+
+class IdRegistry:
+    """Ids of observations that have been pushed to a target.
+
+    Used by the deletion sweep to find observations that exist in the DW but no longer on iNat, and with name CAPTIVE_IDS by the captive sweep to find observations whose wildness has changed since they were pushed. Ids are kept as a sorted int64 array, and saved delta-encoded and compressed, so that millions of ids take a few megabytes. New ids are collected to a set and merged into the array when needed.
+
+    Args:
+        target (str): staging | production
+        sync_to_allas (bool): If True, download the registry from Allas on load and upload it on save
+        name (str): PUSHED_IDS | CAPTIVE_IDS
+    """
+
+    def __init__(self, target, sync_to_allas=False, name=PUSHED_IDS):
+        self.target = target
+        self.sync_to_allas = sync_to_allas
+        self.name = name
+        self.file_path = REGISTRY_FILE.format(name=name, target=target)
+        self.object_key = REGISTRY_OBJECT_KEY.format(name=name, target=target)
+        self.changed = False
+        self._ids = np.empty(0, dtype=np.int64)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.sync_to_allas:
+            download_from_allas.download_state_object(self.object_key, self.file_path)
+
+        if os.path.exists(self.file_path):
+            with np.load(self.file_path) as data:
+                self._ids = np.cumsum(data['id_deltas'], dtype=np.int64)
+        logger.log_minimal(f"Loaded {len(self._ids)} ids to registry {self.name} of {self.target}")
+        return self
+
+    def add(self, observationIds):
+        with self._lock:
+            self._pending.update(observationIds)
+            self.changed = True
+
+    def remove(self, observationIds):
+        with self._lock:
+            self._merge()
+            self._ids = self._ids[~np.isin(self._ids, np.asarray(list(observationIds), dtype=np.int64))]
+            self.changed = True
+
+    def update(self, observationIds, includedIds):
+        """Set which of observationIds are in the registry: includedIds are added, and the others removed."""
+        includedIds = set(includedIds)
+        self.remove(observationId for observationId in observationIds if observationId not in includedIds)
+        self.add(includedIds)
+
+    def ids(self):
+        """Return all ids as a sorted int64 array."""
+        with self._lock:
+            self._merge()
+            return self._ids
+
+    def __len__(self):
+        return len(self.ids())
+
+    def save(self):
+        """Save the registry if it has changed, and upload it to Allas if sync is enabled.
+
+        Returns:
+            bool: True if saved (and uploaded), or there was nothing to save. On failure the registry stays changed, so that the next save tries again.
+        """
+        if not self.changed:
+            return True
+
+        self.changed = False
+        ids = self.ids()
+        temp_path = self.file_path + '.tmp.npz'
+        np.savez_compressed(temp_path, id_deltas=np.diff(ids, prepend=0))
+        os.replace(temp_path, self.file_path)
+
+        if self.sync_to_allas and not upload_to_allas.upload_object(self.file_path, self.object_key, silent=True):
+            self.changed = True
+            logger.log_minimal(f"Failed to upload registry {self.name} of {self.target} to Allas")
+            return False
+        logger.log_minimal(f"Saved {len(ids)} ids to registry {self.name} of {self.target}")
+        return True
+
+    def _merge(self):
+        if self._pending:
+            pending = np.fromiter(self._pending, dtype=np.int64, count=len(self._pending))
+            self._ids = np.union1d(self._ids, pending)
+            self._pending = set()
@@ -0,0 +1,272 @@
+"""
+History of runs of inat.py, with throughput trends and anomaly report.
+
+Each run (and each daemon cycle) appends one record to the history: run id, git sha (APP_GIT_SHA), mode, targets, status, pages, observations fetched (and fetched by the fresh stream), converted, skipped, dropped by validation and posted per target, bytes fetched, wall time per stage, freshness latency percentiles of new and updated observations (see freshness.py), and total_results of the API at the start. The history is kept as JSON in ./store/history-ALLAS.json, and merged into the Allas state bucket with compare-and-swap in auto and daemon modes, so that concurrent runs keep each other's records. Manual runs are recorded in ./store/history-MANUAL.json only.
+
+Show recent runs, throughput per git sha, and runs whose volume or duration deviates from the previous runs of the same mode and targets, or whose p90 freshness latency exceeds the freshness SLO:
+python run_history.py report [--last N] [--volume-factor F] [--duration-factor F] [--freshness-slo SECONDS] [--fail-on-anomaly] [--local]
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+import download_from_allas
+import freshness
+import logger
+import profiling
+import upload_to_allas
+
+HISTORY_FILE = './store/history-ALLAS.json'
+MANUAL_HISTORY_FILE = './store/history-MANUAL.json'
+HISTORY_OBJECT_KEY = 'history-ALLAS.json'
+
+# Oldest records are removed when the history grows longer than this
+HISTORY_MAX_RUNS = int(os.getenv("INAT_HISTORY_MAX_RUNS", "2000") or 2000)
+
+# A run is flagged if its volume is this many times more or less than the median of previous runs, or if it takes this many times longer or has this many times lower throughput
+VOLUME_FACTOR = float(os.getenv("INAT_HISTORY_VOLUME_FACTOR", "3") or 3)
+DURATION_FACTOR = float(os.getenv("INAT_HISTORY_DURATION_FACTOR", "2") or 2)
+
+# A run is flagged if the p90 freshness latency of new or updated observations is longer than this many seconds, 0 = no SLO
+FRESHNESS_SLO_SECONDS = float(os.getenv("INAT_FRESHNESS_SLO_SECONDS", "0") or 0)
+
+# Previous runs of the same mode and targets that a run is compared to
+BASELINE_RUNS = 20
+MIN_BASELINE_RUNS = 5
+# Throughput of runs with fewer observations is mostly startup time, and is not compared
+MIN_OBSERVATIONS_FOR_THROUGHPUT = 500
+
+_lock = threading.Lock()
+_counts = collections.Counter()
+_posted = collections.Counter()
+_started = time.time()
+
+
+def start():
+    """Start a new run or daemon cycle: reset counters, stage times and freshness latencies."""
+    global _started
+    with _lock:
+        _counts.clear()
+        _posted.clear()
+        _started = time.time()
+    profiling.take_stage_seconds()
+    freshness.take_summary()
+
+
+def count(name, value=1):
+    """Add to a counter of the current run, e.g. pages, fetched, converted, dropped, bytes or total_results."""
+    with _lock:
+        _counts[name] += value
+
+
+def count_posted(target, value):
+    """Add observations posted to a target in the current run."""
+    with _lock:
+        _posted[target] += value
+
+
+def record(mode, targets, status, sync_to_allas, jobs=None):
+    """Append a record of the current run to the history, and log a summary of it.
+
+    Args:
+        mode (str): auto | manual | daemon
+        targets (list): Targets of the run
+        status (str): finished | stopped | failed
+        sync_to_allas (bool): If True, merge the record into the history in Allas
+        jobs (list): Names of manual jobs, if any
+
+    Returns:
+        dict: The record
+    """
+    with _lock:
+        counts = dict(_counts)
+        posted = dict(_posted)
+        started = _started
+    wall_seconds = round(time.time() - started, 3)
+
+    fetched = counts.get("fetched", 0)
+    run = {
+        "run_id": logger.RUN_ID,
+        "git_sha": os.environ.get('APP_GIT_SHA', 'unknown'),
+        "started": datetime.datetime.fromtimestamp(started, datetime.timezone.utc).isoformat(timespec="seconds"),
+        "mode": mode,
+        "targets": list(targets),
+        "jobs": jobs or [],
+        "status": status,
+        "pages": counts.get("pages", 0),
+        "fetched": fetched,
+        "fresh_fetched": counts.get("fresh_fetched", 0),
+        "converted": counts.get("converted", 0),
+        "skipped": fetched - counts.get("converted", 0) - counts.get("dropped", 0),
+        "dropped": counts.get("dropped", 0),
+        "posted": posted,
+        "bytes": counts.get("bytes", 0),
+        "total_results": counts.get("total_results"),
+        "wall_seconds": wall_seconds,
+        "stage_seconds": profiling.take_stage_seconds(),
+        "freshness": freshness.take_summary(),
+    }
+    logger.log_minimal(f"Run {status}: {fetched} observations fetched, {run['converted']} converted, posted {posted}, {run['bytes'] / 1024 / 1024:.1f} MB in {wall_seconds:.0f} s")
+    for kind, latency in run["freshness"].items():
+        logger.log_minimal(f"Freshness of {latency['count']} {kind} observations: p50 {latency['p50']:.0f} s, p90 {latency['p90']:.0f} s, p99 {latency['p99']:.0f} s, max {latency['max']:.0f} s")
+
+    try:
+        _append(run, sync_to_allas)
+    except Exception as e:
+        logger.log_minimal(f"Failed to save run history: {str(e)}")
+    return run
+
+
+def _trim(runs):
+    return runs[-HISTORY_MAX_RUNS:]
+
+
+def _append(run, sync_to_allas):
+    if sync_to_allas:
+        history = upload_to_allas.update_json_object(HISTORY_OBJECT_KEY, lambda data: {"runs": _trim((data or {}).get("runs", []) + [run])}, silent=True)
+        if history is None:
+            raise Exception("Failed to merge the record into the run history in Allas")
+        file_path = HISTORY_FILE
+    else:
+        file_path = MANUAL_HISTORY_FILE
+        history = {"runs": _trim(_read(file_path) + [run])}
+
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(history, file)
+    os.replace(temp_path, file_path)
+
+
+def _read(file_path):
+    if not os.path.exists(file_path):
+        return []
+    with open(file_path) as file:
+        return json.load(file).get("runs", [])
+
+
+def load_history(local=False):
+    """Load the run history, from Allas if it is configured.
+
+    Args:
+        local (bool): If True, read ./store/history-MANUAL.json instead
+
+    Returns:
+        list: Records, oldest first
+    """
+    if local:
+        return _read(MANUAL_HISTORY_FILE)
+    download_from_allas.download_state_object(HISTORY_OBJECT_KEY, HISTORY_FILE)
+    return _read(HISTORY_FILE)
+
+
+def throughput(run):
+    """Observations fetched per second of wall time, or None if the run was too small to compare."""
+    if run["fetched"] < MIN_OBSERVATIONS_FOR_THROUGHPUT or run["wall_seconds"] <= 0:
+        return None
+    return run["fetched"] / run["wall_seconds"]
+
+
+def anomalies(run, baseline, volume_factor=VOLUME_FACTOR, duration_factor=DURATION_FACTOR, freshness_slo=FRESHNESS_SLO_SECONDS):
+    """Compare a run to previous runs of the same mode and targets, and to the freshness SLO.
+
+    Args:
+        run (dict): Record of the run
+        baseline (list): Records of previous finished runs
+        volume_factor (float): Flag fetched volume more or less than this many times the median
+        duration_factor (float): Flag wall time longer, or throughput lower, than this many times the median
+        freshness_slo (float): Flag p90 freshness latency longer than this many seconds, 0 = no SLO
+
+    Returns:
+        list: Reasons the run is flagged, empty if it looks normal
+    """
+    flags = []
+    if run["status"] != "finished":
+        flags.append(run["status"])
+    if freshness_slo > 0:
+        # Records from before the freshness latency was measured have no "freshness"
+        for kind, latency in run.get("freshness", {}).items():
+            if latency["p90"] > freshness_slo:
+                flags.append(f"{kind} p90 {latency['p90']:.0f} s")
+    if len(baseline) < MIN_BASELINE_RUNS:
+        return flags
+
+    median_fetched = statistics.median(previous["fetched"] for previous in baseline)
+    if median_fetched > 0:
+        ratio = run["fetched"] / median_fetched
+        if ratio > volume_factor or ratio < 1 / volume_factor:
+            flags.append(f"volume x{ratio:.2f}")
+    elif run["fetched"] > MIN_OBSERVATIONS_FOR_THROUGHPUT:
+        flags.append(f"volume {run['fetched']} vs median 0")
+
+    median_wall = statistics.median(previous["wall_seconds"] for previous in baseline)
+    if median_wall > 0 and run["wall_seconds"] > duration_factor * median_wall:
+        flags.append(f"duration x{run['wall_seconds'] / median_wall:.2f}")
+
+    rates = [rate for rate in (throughput(previous) for previous in baseline) if rate is not None]
+    rate = throughput(run)
+    if rate is not None and len(rates) >= MIN_BASELINE_RUNS:
+        median_rate = statistics.median(rates)
+        if rate < median_rate / duration_factor:
+            flags.append(f"throughput x{rate / median_rate:.2f}")
+    return flags
+
+
+def report(runs, last=30, volume_factor=VOLUME_FACTOR, duration_factor=DURATION_FACTOR, freshness_slo=FRESHNESS_SLO_SECONDS):
+    """Print the last runs with their anomalies, and throughput per git sha.
+
+    Returns:
+        int: Number of flagged runs among the printed runs
+    """
+    previous_by_group = collections.defaultdict(list)
+    rows = []
+    for run in runs:
+        group = (run["mode"], ",".join(run["targets"]))
+        baseline = previous_by_group[group][-BASELINE_RUNS:]
+        rows.append((run, anomalies(run, baseline, volume_factor, duration_factor, freshness_slo)))
+        if run["status"] == "finished":
+            previous_by_group[group].append(run)
+
+    rows = rows[-last:]
+    print(f"{'started':<25} {'mode':<7} {'targets':<20} {'sha':<8} {'fetched':>8} {'posted':>8} {'wall s':>8} {'obs/s':>7} {'new p90':>8} {'upd p90':>8}  flags")
+    for run, flags in rows:
+        rate = run["fetched"] / run["wall_seconds"] if run["wall_seconds"] > 0 else 0
+        posted = min(run["posted"].values()) if run["posted"] else 0
+        latency = {kind: f"{value['p90']:.0f}" for kind, value in run.get("freshness", {}).items()}
+        print(f"{run['started']:<25} {run['mode']:<7} {','.join(run['targets']):<20} {run['git_sha'][:7]:<8} {run['fetched']:>8} {posted:>8} {run['wall_seconds']:>8.0f} {rate:>7.1f} {latency.get('new', '-'):>8} {latency.get('updated', '-'):>8}  {', '.join(flags)}")
+
+    print()
+    print("Throughput by git sha (runs with at least " + str(MIN_OBSERVATIONS_FOR_THROUGHPUT) + " observations):")
+    rates_by_sha = collections.OrderedDict()
+    for run, _ in rows:
+        rate = throughput(run)
+        if rate is not None:
+            rates_by_sha.setdefault(run["git_sha"], []).append(rate)
+    for sha, rates in rates_by_sha.items():
+        print(f"  {sha[:7]:<8} {len(rates):>4} runs, median {statistics.median(rates):.1f} obs/s")
+
+    return sum(1 for _, flags in rows if flags)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report of the run history of inat.py.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    reportParser = subparsers.add_parser("report", help="Show recent runs, anomalies and throughput trend")
+    reportParser.add_argument("--last", type=int, default=30, help="Number of runs to show")
+    reportParser.add_argument("--volume-factor", type=float, default=VOLUME_FACTOR)
+    reportParser.add_argument("--duration-factor", type=float, default=DURATION_FACTOR)
+    reportParser.add_argument("--freshness-slo", type=float, default=FRESHNESS_SLO_SECONDS, help="Flag runs whose p90 freshness latency is longer than this many seconds")
+    reportParser.add_argument("--fail-on-anomaly", action="store_true", help="Exit with code 1 if any shown run is flagged")
+    reportParser.add_argument("--local", action="store_true", help="Report manual runs from ./store/history-MANUAL.json")
+    args = parser.parse_args()
+
+    logger.setup_logging(False)
+    flagged = report(load_history(args.local), args.last, args.volume_factor, args.duration_factor, args.freshness_slo)
+    if flagged and args.fail_on_anomaly:
+        sys.exit(1)
@@ -0,0 +1,335 @@
+"""
+Sharded re-sync of a range of observation ids, spread across several pods without a coordinator.
+
+A sync is planned once: the id range is split into shard records, stored as JSON objects in the Allas state bucket (shards-ALLAS/<sync>/shard-00001.json etc.). Each worker pod claims a shard by writing a time-limited lease (owner and expiry time) to its record. Writes are compare-and-swap (see upload_to_allas.update_json_object), so only one pod can claim a shard. The lease is renewed with the cursor of each target after each posted page, and in the background while pages are slow to post, but only if a page has been posted within PROGRESS_TIMEOUT_SECONDS, so that a stuck pod lets its lease expire. A failed write keeps the lease, unless another pod owns the shard or the lease has expired. When the shard is done, the lease is released with the final cursor. If a pod crashes, its lease expires and another pod continues the shard from its cursor.
+
+Workers do not update the registry of pushed ids (see registry.py), which the deletion sweep uses. The registry is saved as one object that each writer replaces whole, so concurrent workers, and the auto or daemon run, would overwrite each other's ids. After a sync, add its ids to the registry from a FinBIF export with sweep.py <target> seed, while no auto run is ongoing, so that the sweep finds observations of the sync that are deleted later.
+
+python shards.py plan <sync> <shards> <min_id> <max_id> [--updated-since TIME] [--url-suffix SUFFIX]
+python shards.py work <sync> <targets> [--sleep N] [--full-logging]
+python shards.py status <sync>
+python shards.py retry <sync>
+"""
+
+import argparse
+import datetime
+import os
+import re
+import signal
+import socket
+import sys
+import threading
+import time
+
+import download_from_allas
+import getInat
+import inatHelpers
+import inatToDw
+import logger
+import push_targets
+import taxon_cache
+import upload_to_allas
+import validate_dw
+
+SHARD_OBJECT_PREFIX = 'shards-ALLAS/'
+
+# Lease is lost if it is not renewed within this time, e.g. when the pod crashes
+LEASE_SECONDS = int(os.getenv("INAT_SHARD_LEASE_MINUTES", "10") or 10) * 60
+
+# Lease is not renewed in the background if no page has been posted within this time
+PROGRESS_TIMEOUT_SECONDS = 2 * LEASE_SECONDS
+
+# Default start of updated_since, which covers all observations
+ALL_TIME = "2000-01-01T00%3A00%3A00%2B00%3A00"
+
+VALID_TARGETS = ("staging", "production", "file")
+
+
+def _sync_prefix(sync):
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", sync):
+        raise ValueError(f"Invalid sync name: {sync}")
+    return f"{SHARD_OBJECT_PREFIX}{sync}/"
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+
+
+def plan(sync, shardCount, minId, maxId, updatedSince=ALL_TIME, urlSuffix=""):
+    """Split ids minId..maxId to shards of about equal size, and store their records in Allas.
+
+    Raises:
+        ValueError: If the arguments are invalid
+        Exception: If the sync has already been planned, or a record cannot be written
+    """
+    prefix = _sync_prefix(sync)
+    if shardCount < 1 or minId > maxId:
+        raise ValueError("Shard count must be positive and min id at most max id")
+    if urlSuffix and not urlSuffix.startswith("&"):
+        raise ValueError("URL suffix must start with &")
+    if download_from_allas.list_state_objects(prefix):
+        raise Exception(f"Sync {sync} has already been planned")
+
+    size = -(-(maxId - minId + 1) // shardCount)
+    shard = 0
+    for start in range(minId, maxId + 1, size):
+        shard += 1
+        record = {
+            "sync": sync,
+            "shard": shard,
+            # Ids above first_id - 1 and below last_id + 1 are fetched
+            "first_id": start,
+            "last_id": min(start + size - 1, maxId),
+            "updated_since": updatedSince,
+            "url_suffix": urlSuffix,
+            "cursors": {},
+            "status": "pending",
+            "owner": None,
+            "lease_expires": 0,
+            "updated": _now(),
+        }
+        if upload_to_allas.update_json_object(f"{prefix}shard-{shard:05d}.json", lambda data, record=record: record if data is None else None) is None:
+            raise Exception(f"Failed to store shard {shard} of sync {sync}")
+    logger.log_minimal(f"Planned sync {sync}: {shard} shards of ids {minId}-{maxId}")
+
+
+def read_shards(sync):
+    """Read the records of all shards of a sync, in shard order."""
+    return [download_from_allas.read_json_object(key) for key in download_from_allas.list_state_objects(_sync_prefix(sync))]
+
+
+class Lease:
+    """Lease of one shard, held by this pod.
+
+    Args:
+        key (string): Object key of the shard record
+        owner (string): Id of this pod
+        record (dict): Shard record when the lease was claimed
+    """
+
+    def __init__(self, key, owner, record):
+        self.key = key
+        self.owner = owner
+        self.record = record
+        self.lost = False
+        self._lastProgress = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_periodically, name=f"lease-{record['shard']}", daemon=True)
+        self._heartbeat.start()
+
+    def _write(self, change, target=None, cursor=None):
+        ownerChanged = False
+
+        def update(data):
+            nonlocal ownerChanged
+            # Another pod has taken the shard after the lease expired
+            if data is None or data["owner"] != self.owner:
+                ownerChanged = True
+                return None
+            data.update(change)
+            if target is not None:
+                data["cursors"][target] = cursor
+            data["updated"] = _now()
+            return data
+
+        with self._lock:
+            if self.lost:
+                return False
+            record = upload_to_allas.update_json_object(self.key, update, silent=True)
+            if record is not None:
+                self.record = record
+                return True
+            # A failed request is retried on the next write, as long as no other pod can have taken over
+            if ownerChanged or self.record["lease_expires"] < time.time():
+                self.lost = True
+                self._stop.set()
+                logger.log_minimal(f"Lost lease of shard {self.record['shard']}")
+            else:
+                logger.log_minimal(f"Failed to write lease of shard {self.record['shard']}, keeping it until it expires")
+            return False
+
+    def renew(self, target=None, cursor=None):
+        """Extend the lease, and store the cursor of a target if given, i.e. after a page has been posted to it."""
+        if target is not None:
+            self._lastProgress = time.monotonic()
+        return self._write({"lease_expires": time.time() + LEASE_SECONDS}, target, cursor)
+
+    def release(self, status, error=None):
+        """Give up the lease, and set the status of the shard (finished, failed or pending)."""
+        self._stop.set()
+        change = {"status": status, "owner": None, "lease_expires": 0}
+        if error is not None:
+            change["error"] = error
+        return self._write(change)
+
+    def _renew_periodically(self):
+        while not self._stop.wait(LEASE_SECONDS / 3):
+            idleSeconds = time.monotonic() - self._lastProgress
+            if idleSeconds > PROGRESS_TIMEOUT_SECONDS:
+                logger.log_minimal(f"No page posted to shard {self.record['shard']} in {idleSeconds / 60:.0f} minutes, letting the lease expire")
+                continue
+            self.renew()
+
+
+def claim(sync, owner):
+    """Claim the first shard that is pending, or whose lease has expired.
+
+    Returns:
+        Lease: Lease of the claimed shard, or None if there is nothing left to claim
+    """
+    for key in download_from_allas.list_state_objects(_sync_prefix(sync)):
+        def update(data):
+            expired = data["status"] == "ongoing" and data["lease_expires"] < time.time()
+            if data["status"] != "pending" and not expired:
+                return None
+            if expired:
+                logger.log_minimal(f"Lease of shard {data['shard']} held by {data['owner']} has expired, taking over")
+            data.update({"status": "ongoing", "owner": owner, "lease_expires": time.time() + LEASE_SECONDS, "updated": _now()})
+            return data
+
+        record = upload_to_allas.update_json_object(key, update, silent=True)
+        if record is not None:
+            return Lease(key, owner, record)
+    return None
+
+
+def run_shard(lease, targets, privateObservationData, private_emails, sleepSeconds):
+    """Fetch, convert and post the observations of a shard, continuing from its cursors.
+
+    Raises:
+        Exception: If fetching or converting fails, posting fails for all targets, or the lease is lost
+    """
+    record = lease.record
+    # Resume from the target that is furthest behind. Posting replaces existing documents, so the others get some observations again.
+    latestObsId = min(record["cursors"].get(target, record["first_id"] - 1) for target in targets)
+    logger.log_minimal(f"Shard {record['shard']}: ids {latestObsId + 1}-{record['last_id']}")
+
+    def on_success(target, dwObservations, cursor):
+        lease.renew(target, cursor)
+
+    pushers = [push_targets.TargetPusher(target, on_success) for target in targets]
+    props = {"sleepSeconds": sleepSeconds, "perPage": 100, "pageLimit": 10000, "urlSuffix": record["url_suffix"] + "&id_below=" + str(record["last_id"] + 1)}
+    try:
+        for multiObservationDict in getInat.getUpdatedGenerator(latestObsId, record["updated_since"], **props):
+            if multiObservationDict is False:
+                break
+            dwObservations = inatToDw.convertObservations(multiObservationDict['results'], privateObservationData, private_emails)[0]
+            if all(pusher.failed for pusher in pushers):
+                raise Exception("Posting failed for all targets")
+            if lease.lost:
+                raise Exception("Lease lost, another pod continues the shard")
+            for pusher in pushers:
+                pusher.put(dwObservations, multiObservationDict['results'][-1]['id'])
+    finally:
+        for pusher in pushers:
+            pusher.close()
+
+    validate_dw.log_counts()
+
+    failedTargets = [pusher.target for pusher in pushers if pusher.failed]
+    if failedTargets:
+        raise Exception("Posting failed for targets: " + ", ".join(failedTargets))
+
+
+def work(sync, targets, sleepSeconds=1):
+    """Claim and run shards of a sync until none are left.
+
+    Returns:
+        int: Number of shards that failed on this pod
+    """
+    owner = f"{socket.gethostname()}-{os.getpid()}"
+    privateObservationData = inatHelpers.load_private_observations()
+    private_emails = inatHelpers.load_private_emails()
+    # Several pods would overwrite each other's cache in Allas, so the cache is only used locally
+    taxon_cache.enable()
+
+    failed = 0
+    while True:
+        lease = claim(sync, owner)
+        if lease is None:
+            break
+        try:
+            run_shard(lease, targets, privateObservationData, private_emails, sleepSeconds)
+        except (KeyboardInterrupt, SystemExit):
+            # Let another pod continue from the cursors right away, instead of after the lease expires
+            lease.release("pending")
+            raise
+        except Exception as e:
+            logger.log_minimal(f"Shard {lease.record['shard']} failed: {str(e)}")
+            failed += 1
+            if not lease.lost:
+                lease.release("failed", str(e))
+            continue
+        if lease.release("finished"):
+            logger.log_minimal(f"Shard {lease.record['shard']} finished")
+
+    logger.log_minimal(f"No more shards to claim in sync {sync}")
+    return failed
+
+
+def status(sync):
+    """Log the status of each shard of a sync."""
+    for record in read_shards(sync):
+        line = f"Shard {record['shard']}: {record['status']}, ids {record['first_id']}-{record['last_id']}, cursors {record['cursors']}"
+        if record["owner"]:
+            line += f", leased by {record['owner']} for {int(record['lease_expires'] - time.time())} s"
+        if record.get("error"):
+            line += f", error: {record['error']}"
+        logger.log_minimal(line)
+
+
+def retry(sync):
+    """Set failed shards of a sync back to pending, so that workers claim them again. They continue from their cursors."""
+    for key in download_from_allas.list_state_objects(_sync_prefix(sync)):
+        def update(data):
+            if data["status"] != "failed":
+                return None
+            data.update({"status": "pending", "error": None, "updated": _now()})
+            return data
+
+        record = upload_to_allas.update_json_object(key, update)
+        if record is not None:
+            logger.log_minimal(f"Shard {record['shard']} set to pending")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sharded re-sync of observation ids across several pods.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    planParser = subparsers.add_parser("plan", help="Split an id range to shards")
+    planParser.add_argument("sync", help="Name of the sync")
+    planParser.add_argument("shards", type=int)
+    planParser.add_argument("min_id", type=int)
+    planParser.add_argument("max_id", type=int)
+    planParser.add_argument("--updated-since", default=ALL_TIME, help="URL-encoded ISO time, default covers all observations")
+    planParser.add_argument("--url-suffix", default="", help="Additional API parameters, starting with &")
+
+    workParser = subparsers.add_parser("work", help="Claim and run shards until none are left")
+    workParser.add_argument("sync")
+    workParser.add_argument("targets", help="Comma-separated targets: staging, production, file")
+    workParser.add_argument("--sleep", type=int, default=1, help="Seconds between requests to iNat")
+    workParser.add_argument("--full-logging", action="store_true")
+
+    statusParser = subparsers.add_parser("status", help="Show the status of each shard")
+    statusParser.add_argument("sync")
+
+    retryParser = subparsers.add_parser("retry", help="Set failed shards back to pending")
+    retryParser.add_argument("sync")
+
+    args = parser.parse_args()
+    logger.setup_logging(getattr(args, "full_logging", False))
+
+    if args.command == "plan":
+        plan(args.sync, args.shards, args.min_id, args.max_id, args.updated_since, args.url_suffix)
+    elif args.command == "work":
+        targets = [target.strip() for target in args.targets.split(",") if target.strip()]
+        if not targets or any(target not in VALID_TARGETS for target in targets):
+            raise ValueError("Targets must be comma-separated staging, production or file")
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        if work(args.sync, targets, args.sleep):
+            raise SystemExit(1)
+    elif args.command == "status":
+        status(args.sync)
+    else:
+        retry(args.sync)
@@ -1,5 +1,6 @@
 
 import sys
+import atexit
 import pprint
 
 import getInat
@@ -7,9 +8,11 @@ import inatToDw
 import postDw
 
 import json
-import pandas
 
 import inatHelpers
+import profiling
+import taxon_cache
+import validate_dw
 
 """
 Test observations
@@ -29,25 +32,159 @@ https://www.inaturalist.org/flags?commit=Suodata&flaggable_type=Observation&flag
 
 """
 
+# Test observations above, by fixture name. python single.py record-fixtures saves them to ./store/fixtures, as full responses of API v1, and as sparse responses of API v2 with suffix -sparse (see tests/test_fields.py).
+TEST_OBSERVATIONS = {
+  "tags": 60063865,
+  "projects": 53608382,
+  "locality": 39330050,
+  "obscured": 60201865,
+  "private": 60934016,
+  "no_accuracy": 62132113,
+  "quality_metrics": 55900883,
+  "quality_metrics_deleted_user": 60213784,
+}
+
 # Input
 # TODO: Input validation?
-id = sys.argv[1] # id of the iNat observation
-target = sys.argv[2] # dry | dry-verbose | production
+# Usage:
+# python single.py <observation_id | fixture:NAME> <target>
+# python single.py bulk <ids_file | -> <target>
+# python single.py record-fixtures
+# Add --profile[=DIR] to profile CPU time per stage, see profiling.py
+# Add --cache[=MINUTES] to cache iNat responses on disk (default 60 minutes), and --record=NAME to save the response of the observation as fixture NAME, which is replayed offline with fixture:NAME
+# target: dry | dry-verbose | staging | production
+
+def read_ids(source):
+  """Read observation ids from a file, or from stdin if source is "-".
+
+  Ids can be separated by newlines, commas or whitespace. Duplicates are removed, order is preserved.
+  """
+  if "-" == source:
+    text = sys.stdin.read()
+  else:
+    with open(source, "r") as file:
+      text = file.read()
+
+  ids = []
+  for token in text.replace(",", " ").split():
+    if not token.isdigit():
+      raise ValueError(f"Invalid observation id: {token}")
+    ids.append(int(token))
+
+  return list(dict.fromkeys(ids))
+
+
+def parse_options(argv):
+  """Remove --cache[=MINUTES] and --record=NAME from command line arguments.
+
+  Returns:
+    tuple: Cache time to live in minutes or None, and fixture name or None
+  """
+  cacheMinutes = None
+  record = None
+  for argument in list(argv[1:]):
+    if argument == "--cache" or argument.startswith("--cache="):
+      argv.remove(argument)
+      cacheMinutes = int(argument.partition("=")[2] or 60)
+    elif argument.startswith("--record="):
+      argv.remove(argument)
+      record = argument.partition("=")[2]
+  return cacheMinutes, record
+
+
+def record_fixtures():
+  """Fetch the test observations and save their responses as fixtures, in both all and sparse fields modes."""
+  for name, observationId in TEST_OBSERVATIONS.items():
+    getInat.getSingle(observationId, record = name, fieldsMode = "all")
+    getInat.getSingle(observationId, record = name + "-sparse", fieldsMode = "sparse")
+
+
+def print_validation_counts():
+  """Print violations found by local validation, see validate_dw.py."""
+  counts = validate_dw.take_counts()
+  violations = {reason: count for reason, count in counts.items() if reason not in ("checked", "dropped")}
+  if violations:
+    print(f"Validation dropped {counts['dropped']} of {counts['checked']} documents, violations: " + ", ".join(f"{reason} {count}" for reason, count in sorted(violations.items())))
+
+
+def run_bulk(source, target):
+  """Fetch, convert and post observations by id, many ids per request."""
+  ids = read_ids(source)
+  print(f"Processing {len(ids)} observations")
+
+  notFound = []
+  skipped = []
+  postedCount = 0
+
+  for idGroup, observations in getInat.getMultiple(ids):
+    foundIds = {inat["id"] for inat in observations}
+    notFound.extend(observationId for observationId in idGroup if observationId not in foundIds)
+
+    with profiling.stage("convert"):
+      dwObservations, lastUpdateKey = inatToDw.convertObservations(observations, privateObservationData, private_emails)
+
+    convertedIds = {int(dw["documentId"].rsplit("/", 1)[1]) for dw in dwObservations["roots"]}
+    skipped.extend(observationId for observationId in idGroup if observationId in foundIds and observationId not in convertedIds)
+
+    if "staging" == target or "production" == target:
+      if dwObservations["roots"]:
+        with profiling.stage("post"):
+          postDw.postMulti(dwObservations, target)
+        postedCount += len(dwObservations["roots"])
+
+    if "dry-verbose" == target:
+      print(json.dumps(dwObservations))
+
+  print("--------------------------------------------------------------")
+  print(f"Requested: {len(ids)}, posted: {postedCount}, not found: {len(notFound)}, skipped by conversion: {len(skipped)}")
+  if notFound:
+    print("Not found on iNaturalist: " + ",".join(str(observationId) for observationId in notFound))
+  if skipped:
+    print("Skipped by conversion: " + ",".join(str(observationId) for observationId in skipped))
+  print_validation_counts()
+
+
+# Optional --profile[=DIR] for CPU profiling, see profiling.py
+cpu_profile_dir = profiling.parse_profile_argument(sys.argv)
+cacheMinutes, record = parse_options(sys.argv)
+if cacheMinutes is not None:
+  getInat.enableResponseCache(cacheMinutes * 60)
+
+if "record-fixtures" == sys.argv[1]:
+  record_fixtures()
+  sys.exit(0)
+
+if "bulk" == sys.argv[1]:
+  source = sys.argv[2] # file with observation ids, or - for stdin
+  target = sys.argv[3] # dry | dry-verbose | staging | production
+else:
+  id = sys.argv[1] # id of the iNat observation, or fixture:NAME
+  target = sys.argv[2] # dry | dry-verbose | production
+
+profiling.start(cpu_profile_dir)
 
 # Load private data
-privateObservationData = pandas.read_csv("./privatedata/latest-ALLAS.tsv", sep='\t')
+with profiling.stage("private_load"):
+  privateObservationData = inatHelpers.load_private_observations()
+with profiling.stage("email_load"):
+  private_emails = inatHelpers.load_private_emails()
 
-# Exclude the last row if it is empty
-# Check if the last row is indeed empty
-if privateObservationData.iloc[-1].isnull().all():
-  privateObservationData = privateObservationData.iloc[:-1]
+if taxon_cache.enable() is not None:
+  atexit.register(taxon_cache.cache.save)
 
-private_emails = inatHelpers.load_private_emails()
+if "bulk" == sys.argv[1]:
+  run_bulk(source, target)
+  sys.exit(0)
 
 # Get and transform data
-singleObservationDict = getInat.getSingle(id)
+if id.startswith("fixture:"):
+  singleObservationDict = getInat.loadFixture(id.partition(":")[2])
+else:
+  singleObservationDict = getInat.getSingle(id, record)
 
-dwObservation, lastUpdateKey = inatToDw.convertObservations(singleObservationDict['results'], privateObservationData, private_emails)
+with profiling.stage("convert"):
+  dwObservation, lastUpdateKey = inatToDw.convertObservations(singleObservationDict['results'], privateObservationData, private_emails)
+print_validation_counts()
 
 #print("TEMP DEBUG lastUpdateKey: " + str(lastUpdateKey))
 
@@ -56,7 +193,8 @@ dwObservation, lastUpdateKey = inatToDw.convertObservations(singleObservationDic
 pp = pprint.PrettyPrinter(indent=2)
 
 if "staging" == target or "production" == target:
-  postDw.postSingle(dwObservation, target)
+  with profiling.stage("post"):
+    postDw.postSingle(dwObservation, target)
 
 if "dry-verbose" == target:
   print("INAT:")
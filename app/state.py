@@ -0,0 +1,115 @@
+import os
+import json
+import threading
+
+import logger
+import profiling
+import upload_to_allas
+
+ALLAS_STATE_FILE = './store/data-ALLAS.json'
+MANUAL_STATE_FILE = './store/data-MANUAL.json'
+
+# State can be written from several threads, e.g. pushers of several targets. Reentrant, since the signal handler uploads state in the main thread.
+_state_lock = threading.RLock()
+
+# Variables set by this process that have not been uploaded to Allas yet, by file path. Only these are written to the state object in Allas, so that concurrent runs (e.g. staging and production, or manual jobs) keep each other's variables.
+_pending = {}
+
+
+def set_variable(var_name, var_value, file_path=ALLAS_STATE_FILE, upload_to_allas_enabled=True, upload_now=True):
+    """Set a variable in the data store (optionally upload to Allas).
+
+    Args:
+        var_name (string): Name of the variable
+        var_value: Value to store
+        file_path (string): JSON file path to read/write
+        upload_to_allas_enabled (bool): If True, sync the JSON file to Allas
+        upload_now (bool): If False, the variable is uploaded with the next upload_state() instead of right away
+
+    Raises:
+        Exception: If file operations fail
+    """
+
+    try:
+        with profiling.stage("state_sync"), _state_lock:
+            # Read existing data from the file
+            if os.path.exists(file_path):
+                with open(file_path, 'r') as file:
+                    data = json.load(file)
+            else:
+                data = {}
+
+            # Update the data with new variable
+            data[var_name] = var_value
+
+            # Write the updated data back to the file
+            with open(file_path, 'w') as file:
+                json.dump(data, file, indent=4)
+        
+            if upload_to_allas_enabled and not upload_now:
+                _pending.setdefault(file_path, {})[var_name] = var_value
+                logger.log_minimal(f"Updated variable {var_name} as {var_value} (upload pending)")
+            elif upload_to_allas_enabled:
+                # Upload to Allas after each write (real-time sync)
+                _pending.setdefault(file_path, {})[var_name] = var_value
+                upload_state(file_path, silent=True)
+                logger.log_minimal(f"Updated variable {var_name} as {var_value} and synced to Allas")
+            else:
+                logger.log_minimal(f"Updated variable {var_name} as {var_value} (local only)")
+    except Exception as e:
+        logger.log_minimal(f"Failed to update variable {var_name} as {var_value}")
+        raise Exception(f"Failed to update data store: {str(e)}")
+
+
+def read_variables(file_path=ALLAS_STATE_FILE):
+    """Read variables from the data store.
+
+    Raises:
+        Exception: If file operations fail
+
+    Returns:
+        dict: Stored variables
+    """
+    try:
+        if os.path.exists(file_path):
+            with _state_lock, open(file_path, 'r') as file:
+                variables = json.load(file)
+            logger.log_minimal(f"Read variables from {file_path}: {variables}")
+            return variables
+        else:
+            logger.log_minimal(f"No state file found at {file_path}, starting with empty variables")
+            return {}
+    except Exception as e:
+        raise Exception(f"Failed to read from data store {file_path}: {str(e)}")
+
+
+def upload_state(file_path=ALLAS_STATE_FILE, silent=False):
+    """Upload variables set by this process to Allas, merged into the state object there.
+
+    The merge is a compare-and-swap (see upload_to_allas.update_state_object), so that variables written by other runs in the meantime are kept. Variables of other runs are also copied to the local file.
+
+    Args:
+        file_path (string): JSON file path of the state
+        silent (bool): If True, suppress error messages
+
+    Returns:
+        bool: True if the upload succeeded or there was nothing to upload, False otherwise
+    """
+    with profiling.stage("state_sync"), _state_lock:
+        pending = dict(_pending.get(file_path, {}))
+        if not pending:
+            return True
+
+        merged = upload_to_allas.update_state_object(lambda data: {**data, **pending}, silent=silent)
+        if merged is None:
+            return False
+
+        for var_name in pending:
+            del _pending[file_path][var_name]
+
+        with open(file_path, 'w') as file:
+            json.dump(merged, file, indent=4)
+
+    if not silent:
+        logger.log_minimal(f"Uploaded {len(pending)} variables to Allas")
+    return True
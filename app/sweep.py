@@ -0,0 +1,196 @@
+"""
+Deletion sweep: finds observations that have been pushed to the DW but no longer exist on iNaturalist with the Finnish place filter (deleted, or moved outside Finland), and deletes them from the DW.
+
+Ids of all current observations are paged from the iNat API with only_id=true, in id order, and compared page by page to the registry of ids pushed to the target (see registry.py). Ids that are in the registry but were skipped by the API are deleted in batches, and removed from the local mirror with tombstones if INAT_MIRROR is enabled (see mirror.py), so that reconversion does not push them again. Progress is stored in the state file after each batch, so an interrupted sweep continues from where it stopped.
+
+Usage:
+python sweep.py <target> run [sleep]       # sweep and delete, resumable
+python sweep.py <target> dry [sleep]       # sweep and write ids to ./privatedata/ids_to_be_deleted.csv, no deletions, no state
+python sweep.py <target> seed <ids_file>   # add ids (one per line, e.g. from a FinBIF export) to the registry
+
+target: staging | production
+"""
+
+import sys
+import signal
+import atexit
+
+import numpy as np
+
+import getInat
+import logger
+import mirror
+import postDw
+import registry
+import state
+
+DELETE_BATCH_SIZE = 1000
+CHECKPOINT_PAGES = 10
+
+# Safety limit: abort if a sweep would delete more than this many observations, e.g. because of an API problem. Dry runs are not limited, so run in dry mode to check the ids, and raise the limit if they are correct.
+MAX_DELETIONS_PER_RUN = 10000
+
+DRY_OUTPUT_FILE = './privatedata/ids_to_be_deleted.csv'
+
+# Prefix of DW document ids, removed when seeding from a FinBIF export
+DOCUMENT_ID_PREFIX = "http://tun.fi/HR.3211/"
+
+
+def read_seed_ids(file_path):
+    """Read observation ids from a file, one per line. Lines that are not ids, like headers, are skipped."""
+    ids = []
+    with open(file_path, 'r') as file:
+        for line in file:
+            token = line.strip().removeprefix(DOCUMENT_ID_PREFIX)
+            if token.isdigit():
+                ids.append(int(token))
+    return ids
+
+
+def find_missing(registry_ids, previous_id, page_ids):
+    """Find registry ids in range (previous_id, last id of page] that are not on the page.
+
+    Args:
+        registry_ids (numpy.ndarray): Sorted ids pushed to the target
+        previous_id (int): Last id of the previous page
+        page_ids (list): Ids of the current page, in ascending order
+
+    Returns:
+        numpy.ndarray: Ids to delete
+    """
+    page_ids = np.asarray(page_ids, dtype=np.int64)
+    start = np.searchsorted(registry_ids, previous_id, side='right')
+    end = np.searchsorted(registry_ids, page_ids[-1], side='right')
+    known_ids = registry_ids[start:end]
+    return known_ids[~np.isin(known_ids, page_ids)]
+
+
+### SETUP
+
+if len(sys.argv) < 3:
+    raise ValueError("Missing required arguments. Usage: python sweep.py <target> <run|dry|seed> [sleep|ids_file]")
+
+target = sys.argv[1]
+command = sys.argv[2]
+
+if target not in ("staging", "production"):
+    raise ValueError(f"Invalid target: {target}")
+if command not in ("run", "dry", "seed"):
+    raise ValueError(f"Invalid command: {command}")
+
+logger.setup_logging(False)
+
+state_file = state.ALLAS_STATE_FILE
+variableName_latest_obsId = f"inat_sweep_{target}_latest_obsId"
+variableName_status = f"inat_sweep_{target}_status"
+
+idRegistry = registry.IdRegistry(target, sync_to_allas=True).load()
+atexit.register(idRegistry.save)
+
+if command == "seed":
+    if len(sys.argv) < 4:
+        raise ValueError("Missing ids file. Usage: python sweep.py <target> seed <ids_file>")
+    seed_ids = read_seed_ids(sys.argv[3])
+    idRegistry.add(seed_ids)
+    logger.log_minimal(f"Added {len(seed_ids)} ids to registry of {target}, registry now has {len(idRegistry)} ids")
+    sys.exit(0)
+
+dry_run = (command == "dry")
+
+if len(sys.argv) > 3:
+    try:
+        getInat.rateLimiter.minInterval = max(int(sys.argv[3]), 1)
+    except ValueError:
+        getInat.rateLimiter.minInterval = 1
+else:
+    getInat.rateLimiter.minInterval = 1
+
+registry_ids = idRegistry.ids()
+if len(registry_ids) == 0:
+    logger.log_minimal(f"Registry of {target} is empty, nothing to sweep. Seed it with: python sweep.py {target} seed <ids_file>")
+    sys.exit(0)
+
+if dry_run:
+    latest_obs_id = 0
+else:
+    variables = state.read_variables(state_file)
+    latest_obs_id = variables.get(variableName_latest_obsId, 0)
+
+    def signal_handler(signum, frame):
+        """Handle termination signals by uploading state file before exit."""
+        logger.log_minimal(f"Received signal {signum}, uploading state file to Allas...")
+        state.upload_state(state_file, silent=False)
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+
+    if mirror.enable(sync_to_allas=True) is not None:
+        atexit.register(mirror.writer.close)
+
+logger.log_minimal(f"Sweeping {target} from id {latest_obs_id}, {len(registry_ids)} ids in registry, dry run {dry_run}")
+
+
+### SWEEP
+
+pending = []
+deleted_count = 0
+live_count = 0
+page = 0
+
+
+def flush(checkpoint_id):
+    """Delete pending ids and store the sweep cursor."""
+    global pending, deleted_count
+
+    if pending:
+        if not dry_run and deleted_count + len(pending) > MAX_DELETIONS_PER_RUN:
+            raise Exception(f"Sweep would delete more than {MAX_DELETIONS_PER_RUN} observations, aborting. Check the ids with a dry run.")
+
+        if dry_run:
+            with open(DRY_OUTPUT_FILE, 'a') as file:
+                file.writelines(f"{observationId}\n" for observationId in pending)
+        else:
+            postDw.postDelete(pending, target)
+            idRegistry.remove(pending)
+            if mirror.writer is not None:
+                mirror.writer.remove(pending)
+            logger.log_minimal(f"Deleted {len(pending)} observations from {target}")
+
+        deleted_count += len(pending)
+        pending = []
+
+    if not dry_run:
+        state.set_variable(variableName_latest_obsId, checkpoint_id, file_path=state_file)
+        state.set_variable(variableName_status, "ongoing", file_path=state_file)
+
+
+if dry_run:
+    with open(DRY_OUTPUT_FILE, 'w') as file:
+        file.write("id\n")
+
+try:
+    previous_id = latest_obs_id
+    for page_ids in getInat.getIdsGenerator(latest_obs_id):
+        page += 1
+        live_count += len(page_ids)
+        pending.extend(int(observationId) for observationId in find_missing(registry_ids, previous_id, page_ids))
+        previous_id = page_ids[-1]
+
+        if len(pending) >= DELETE_BATCH_SIZE or page % CHECKPOINT_PAGES == 0:
+            flush(previous_id)
+
+    flush(previous_id)
+
+    # Ids above the highest current id are not deleted, because they may be observations created during the sweep
+    if not dry_run:
+        state.set_variable(variableName_latest_obsId, 0, file_path=state_file)
+        state.set_variable(variableName_status, "finished", file_path=state_file)
+
+except Exception as e:
+    logger.log_minimal(f"Error during sweep: {str(e)}")
+    if not dry_run:
+        state.upload_state(state_file, silent=False)
+    sys.exit(1)
+
+logger.log_minimal(f"Sweep finished: {live_count} ids on iNaturalist, {deleted_count} observations {'to be deleted, written to ' + DRY_OUTPUT_FILE if dry_run else 'deleted'}")
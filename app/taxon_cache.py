@@ -0,0 +1,180 @@
+"""
+Persistent cache of iNat taxa, used to add higher taxa to converted observations so that homonyms can be resolved.
+
+Observations include only the name, rank and iconic taxon of their taxon. Ancestry comes from the /v1/taxa API, which is requested in bulk for taxa that are missing from the cache or older than INAT_TAXON_CACHE_TTL_DAYS, once per page of observations. The cache is saved gzipped to ./store/taxa.json.gz, and synced to Allas in auto and daemon modes.
+
+Enabled with INAT_TAXON_CACHE=true. Preload the taxa observed in Finland with:
+python taxon_cache.py warm [sleep]
+"""
+
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+
+import getInat
+import logger
+import upload_to_allas
+import download_from_allas
+
+CACHE_ENABLED = os.getenv("INAT_TAXON_CACHE", "false").lower() == "true"
+CACHE_TTL_SECONDS = int(os.getenv("INAT_TAXON_CACHE_TTL_DAYS", "30") or 30) * 24 * 60 * 60
+
+CACHE_FILE = './store/taxa.json.gz'
+CACHE_OBJECT_KEY = 'taxa-ALLAS.json.gz'
+
+# Ranks of higher taxa added to observations
+HIGHER_RANKS = ("kingdom", "phylum", "class", "order", "family")
+
+# Iconic taxa, used to page taxa observed in Finland in parts
+ICONIC_TAXA = ("Plantae", "Insecta", "Fungi", "Aves", "Arachnida", "Mollusca", "Mammalia", "Actinopterygii", "Amphibia", "Reptilia", "Animalia", "Chromista", "Protozoa")
+
+
+class TaxonCache:
+    """Taxa by iNat taxon id, with the time each was fetched.
+
+    Args:
+        sync_to_allas (bool): If True, download the cache from Allas on load and upload it on save
+        fetch (bool): If False, prefetch() does nothing, and the cache is used as it was loaded, e.g. in worker processes whose parent has fetched the taxa
+    """
+
+    def __init__(self, sync_to_allas=False, fetch=True):
+        self.sync_to_allas = sync_to_allas
+        self.fetch = fetch
+        self.changed = False
+        self._taxa = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.sync_to_allas:
+            download_from_allas.download_state_object(CACHE_OBJECT_KEY, CACHE_FILE)
+
+        if os.path.exists(CACHE_FILE):
+            with gzip.open(CACHE_FILE, 'rt', encoding='utf-8') as file:
+                self._taxa = {int(taxonId): taxon for taxonId, taxon in json.load(file).items()}
+        logger.log_minimal(f"Loaded {len(self._taxa)} taxa to taxon cache")
+        return self
+
+    def save(self):
+        """Save the cache if it has changed, and upload it to Allas if sync is enabled."""
+        if not self.changed:
+            return
+
+        with self._lock:
+            temp_path = CACHE_FILE + '.tmp'
+            with gzip.open(temp_path, 'wt', encoding='utf-8') as file:
+                json.dump(self._taxa, file, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temp_path, CACHE_FILE)
+            self.changed = False
+            count = len(self._taxa)
+
+        if self.sync_to_allas:
+            upload_to_allas.upload_object(CACHE_FILE, CACHE_OBJECT_KEY, silent=True)
+        logger.log_minimal(f"Saved {count} taxa to taxon cache")
+
+    def __len__(self):
+        return len(self._taxa)
+
+    def missing(self, taxonIds):
+        """Return ids that are not in the cache, or whose cache entry is older than the TTL."""
+        oldest = time.time() - CACHE_TTL_SECONDS
+        return sorted({taxonId for taxonId in taxonIds if taxonId not in self._taxa or self._taxa[taxonId]["fetched"] < oldest})
+
+    def add(self, taxa):
+        """Add taxa from the /v1/taxa API, and their ancestors."""
+        now = int(time.time())
+        with self._lock:
+            for taxon in taxa:
+                for ancestor in taxon.get("ancestors") or []:
+                    # Ancestor entries are kept only until the ancestor itself is fetched
+                    if ancestor["id"] not in self._taxa:
+                        self._taxa[ancestor["id"]] = _entry(ancestor, now)
+                self._taxa[taxon["id"]] = _entry(taxon, now)
+            self.changed = True
+
+    def prefetch(self, taxonIds, sleepSeconds=1):
+        """Fetch missing and expired taxa in bulk. Errors are logged, and conversion continues with the data in the cache."""
+        if not self.fetch:
+            return
+        missingIds = self.missing(taxonIds)
+        if not missingIds:
+            return
+        try:
+            for taxa in getInat.getTaxa(missingIds, sleepSeconds=sleepSeconds):
+                self.add(taxa)
+        except Exception as e:
+            logger.log_minimal(f"Failed to fetch taxa to taxon cache: {str(e)}")
+
+    def higher_taxa(self, taxonId):
+        """Get names of higher taxa of a taxon.
+
+        Args:
+            taxonId (int): iNat taxon id
+
+        Returns:
+            dict: Name by rank for ranks in HIGHER_RANKS, empty if the taxon is not in the cache
+        """
+        taxon = self._taxa.get(taxonId)
+        if not taxon:
+            return {}
+        higherTaxa = {}
+        for ancestorId in taxon["ancestor_ids"]:
+            ancestor = self._taxa.get(ancestorId)
+            if ancestor and ancestor["rank"] in HIGHER_RANKS:
+                higherTaxa[ancestor["rank"]] = ancestor["name"]
+        return higherTaxa
+
+
+def _entry(taxon, fetched):
+    return {
+        "name": taxon.get("name"),
+        "rank": taxon.get("rank"),
+        "iconic_taxon_name": taxon.get("iconic_taxon_name"),
+        "ancestor_ids": [ancestorId for ancestorId in taxon.get("ancestor_ids") or [] if ancestorId != taxon["id"]],
+        # Ancestors without their own ancestry are refetched when needed
+        "fetched": fetched if taxon.get("ancestor_ids") else 0,
+    }
+
+
+# Cache used by the conversion, set by enable()
+cache = None
+
+
+def enable(sync_to_allas=False, fetch=True):
+    """Load the cache for the conversion, if INAT_TAXON_CACHE is enabled.
+
+    Args:
+        sync_to_allas (bool): If True, download the cache from Allas on load and upload it on save
+        fetch (bool): If False, missing taxa are not fetched
+
+    Returns:
+        TaxonCache: The cache, or None if disabled
+    """
+    global cache
+    if CACHE_ENABLED:
+        cache = TaxonCache(sync_to_allas, fetch).load()
+    return cache
+
+
+def warm(sleepSeconds):
+    """Add all taxa observed in Finland to the cache."""
+    taxonCache = TaxonCache(sync_to_allas=True).load()
+    for iconicTaxon in ICONIC_TAXA:
+        taxonIds = []
+        for taxa in getInat.getSpeciesCountsGenerator(iconicTaxon, sleepSeconds=sleepSeconds):
+            taxonIds.extend(taxon["id"] for taxon in taxa)
+        missingIds = taxonCache.missing(taxonIds)
+        logger.log_minimal(f"{iconicTaxon}: {len(taxonIds)} taxa observed, {len(missingIds)} missing from cache")
+        for taxa in getInat.getTaxa(missingIds, sleepSeconds=sleepSeconds):
+            taxonCache.add(taxa)
+        # Save after each group, so that an interrupted warm-up keeps its progress
+        taxonCache.save()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != "warm":
+        raise ValueError("Usage: python taxon_cache.py warm [sleep]")
+    logger.setup_logging(False)
+    warm(int(sys.argv[2]) if len(sys.argv) > 2 else 1)
@@ -0,0 +1,97 @@
+"""
+Synthetic iNat observations for tests, in the shape of the API v1 response. Names and coordinates are made up.
+"""
+
+import copy
+
+OBSERVATION = {
+    "id": 1001,
+    "uri": "https://www.inaturalist.org/observations/1001",
+    "created_at": "2024-05-02T10:00:00+03:00",
+    "created_at_details": {"date": "2024-05-02"},
+    "updated_at": "2024-05-03T12:30:00+03:00",
+    "observed_on_details": {"date": "2024-05-01"},
+    "time_observed_at": None,
+    "taxon": {"id": 13094, "name": "Parus major", "rank": "species", "iconic_taxon_name": "Aves", "ancestor_ids": [48460, 1, 2, 355675, 3, 7251, 15975, 13094]},
+    "species_guess": None,
+    "description": None,
+    "user": {"id": 1, "login": "tester", "name": "Test User", "orcid": None, "spam": False, "suspended": False},
+    "identifications": [{"taxon": {"name": "Parus major"}, "user": {"login": "tester", "name": "Test User"}}],
+    "taxon_geoprivacy": None,
+    "geoprivacy": None,
+    "captive": False,
+    "place_guess": "Helsinki, Finland",
+    "geojson": {"type": "Point", "coordinates": [24.94, 60.17]},
+    "positional_accuracy": 10,
+    "mappable": True,
+    "obscured": False,
+    "observation_photos": [],
+    "sounds": [],
+    "ofvs": [],
+    "license_code": "cc-by",
+    "annotations": [],
+    "quality_metrics": [],
+    "flags": [],
+    "spam": False,
+    "quality_grade": "research",
+    "out_of_range": False,
+    "comments_count": 0,
+    "num_identification_agreements": 1,
+    "num_identification_disagreements": 0,
+    "owners_identification_from_vision": False,
+    "oauth_application_id": None,
+    "identifications_count": 1,
+    "identifications_most_agree": True,
+    "identifications_most_disagree": False,
+    "faves_count": 0,
+    "non_traditional_projects": [],
+    "project_observations": [],
+    "tags": [],
+}
+
+
+# Observation with media, projects, tags, observation fields, annotations, quality metrics and a flag, and some fields that the conversion does not read
+DETAILED = dict(
+    copy.deepcopy(OBSERVATION),
+    id=1002,
+    uri="https://www.inaturalist.org/observations/1002",
+    time_observed_at="2024-05-01T08:15:00+03:00",
+    species_guess="talitiainen",
+    description="<p>Two birds at the feeder</p> atl: 7",
+    geoprivacy="obscured",
+    obscured=True,
+    place_guess="Espoo, Finland",
+    observation_photos=[{"id": 1, "position": 0, "photo": {"id": 501, "url": "https://example.org/photos/501/square.jpg", "license_code": "cc-by-nc", "attribution": "(c) Test User"}}],
+    sounds=[{"id": 601, "file_url": "https://example.org/sounds/601.m4a", "license_code": "cc-by"}],
+    ofvs=[{"name_ci": "Number of individuals", "value_ci": "2", "taxon": None, "datatype": "numeric"}],
+    annotations=[{"controlled_attribute_id": 22, "controlled_value_id": 24, "vote_score": 1, "user_id": 1}],
+    quality_metrics=[{"user": {"spam": False, "suspended": False, "login": "other"}, "agree": True, "metric": "wild"}],
+    flags=[{"id": 701, "flag": "spam", "resolved": False}],
+    non_traditional_projects=[{"project_id": 801, "project": {"title": "Collection"}}],
+    project_observations=[{"project": {"id": 802, "title": "Traditional"}}],
+    tags=["feeder", "winter"],
+    identifications_count=2,
+    num_identification_agreements=2,
+    faves_count=3,
+)
+
+
+def observation(**changes):
+    """Return a copy of OBSERVATION with the given fields changed."""
+    return dict(copy.deepcopy(OBSERVATION), **changes)
+
+
+def detailed_observation(**changes):
+    """Return a copy of DETAILED with the given fields changed."""
+    return dict(copy.deepcopy(DETAILED), **changes)
+
+
+def select(value, fields):
+    """Keep only the given fields of an observation, like the field selection of API v2 in sparse mode (see getInat.observationsUrl())."""
+    if not isinstance(fields, dict):
+        return copy.deepcopy(value)
+    if isinstance(value, list):
+        return [select(item, fields) for item in value]
+    if isinstance(value, dict):
+        return {key: select(item, fields[key]) for key, item in value.items() if key in fields}
+    return value
@@ -0,0 +1,96 @@
+"""
+Tests that the sparse fields mode (INAT_FIELDS=sparse, API v2) gives the same converted documents as the default full observations of API v1, and of the FieldGuard of verify mode.
+
+Synthetic observations (see observations.py) are converted in full, and with only the fields in inatToDw.CONSUMED_FIELDS, as API v2 returns them in sparse mode. Recorded responses of the test observations in single.py are compared too if they exist, recorded in both modes with:
+python single.py record-fixtures
+
+Run from the app directory:
+python -m unittest discover -s tests
+"""
+
+import copy
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import getInat  # noqa: E402
+import inatToDw  # noqa: E402
+from observations import detailed_observation, observation, select  # noqa: E402
+
+# Same as single.TEST_OBSERVATIONS, which runs as a script and cannot be imported
+FIXTURE_NAMES = ("tags", "projects", "locality", "obscured", "private", "no_accuracy", "quality_metrics", "quality_metrics_deleted_user")
+
+
+def convert(inatObservations):
+    """Convert observations without private data, to a comparable JSON string."""
+    dwObservations = inatToDw.convertObservations(inatObservations, {}, {})[0]
+    return json.dumps(dwObservations, indent=2, sort_keys=True, ensure_ascii=False)
+
+
+class SparseFieldsTest(unittest.TestCase):
+
+    maxDiff = None
+
+    def test_sparse_converts_like_all(self):
+        for inat in (observation(), detailed_observation(), detailed_observation(geoprivacy="private", taxon_geoprivacy="obscured", positional_accuracy=None)):
+            with self.subTest(observation=inat["id"]):
+                self.assertEqual(convert([select(inat, inatToDw.CONSUMED_FIELDS)]), convert([inat]))
+
+    def test_verify_converts_like_all(self):
+        inat = detailed_observation()
+        self.assertEqual(convert([getInat.FieldGuard(inat, inatToDw.CONSUMED_FIELDS)]), convert([inat]))
+
+    def test_recorded_sparse_converts_like_all(self):
+        compared = 0
+        for name in FIXTURE_NAMES:
+            if not (os.path.exists(getInat.fixturePath(name)) and os.path.exists(getInat.fixturePath(name + "-sparse"))):
+                continue
+            with self.subTest(fixture=name):
+                self.assertEqual(convert(getInat.loadFixture(name + "-sparse")["results"]), convert(getInat.loadFixture(name)["results"]))
+            compared += 1
+        if not compared:
+            self.skipTest(f"No fixtures in {getInat.FIXTURE_DIR}, record them with python single.py record-fixtures")
+
+
+class FieldGuardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.guard = getInat.FieldGuard(detailed_observation(), inatToDw.CONSUMED_FIELDS)
+        self.sparse = select(detailed_observation(), inatToDw.CONSUMED_FIELDS)
+
+    def test_reading_unlisted_field_fails(self):
+        with self.assertRaises(Exception):
+            self.guard["faves"]
+        with self.assertRaises(Exception):
+            self.guard.get("faves", 0)
+        with self.assertRaises(Exception):
+            "faves" in self.guard
+        with self.assertRaises(Exception):
+            self.guard["observation_photos"][0]["photo"]["attribution"]
+        with self.assertRaises(Exception):
+            self.guard["taxon"].get("ancestor_ids", [])
+
+    def test_iteration_gives_listed_fields(self):
+        self.assertEqual(sorted(self.guard), sorted(self.sparse))
+        self.assertEqual(sorted(self.guard.keys()), sorted(self.sparse))
+        self.assertEqual(len(self.guard), len(self.sparse))
+        self.assertEqual(json.loads(json.dumps(dict(self.guard.items()))), self.sparse)
+        self.assertEqual(json.loads(json.dumps(self.guard)), self.sparse)
+        for value in self.guard.values():
+            json.dumps(value)
+
+    def test_copies_are_guarded(self):
+        for copied in (copy.deepcopy(self.guard), copy.copy(self.guard), self.guard.copy()):
+            self.assertIsInstance(copied, getInat.FieldGuard)
+            self.assertEqual(json.loads(json.dumps(copied)), self.sparse)
+            with self.assertRaises(Exception):
+                copied["faves"]
+            with self.assertRaises(Exception):
+                copied["taxon"]["ancestor_ids"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+"""
+Tests of the compare-and-swap update of JSON objects in Allas (upload_to_allas.update_json_object), against an in-memory S3 stand-in.
+
+Run from the app directory:
+python -m unittest discover -s tests
+"""
+
+import io
+import json
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import upload_to_allas  # noqa: E402
+
+
+class StubS3:
+    """S3 client stand-in with ETags and conditional puts (IfMatch, IfNoneMatch='*'), like Allas.
+
+    Args:
+        after_get (callable): Called after each get_object, e.g. to make concurrent writers read the same version
+    """
+
+    def __init__(self, after_get=None):
+        self.objects = {}
+        self.versions = 0
+        self.puts = 0
+        self.conflicts = 0
+        self.after_get = after_get
+        self._lock = threading.Lock()
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            if Key not in self.objects:
+                raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+            body, etag = self.objects[Key]
+        if self.after_get is not None:
+            self.after_get()
+        return {"Body": io.BytesIO(body), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        with self._lock:
+            self.puts += 1
+            current = self.objects.get(Key)
+            if (IfNoneMatch == "*" and current is not None) or (IfMatch is not None and (current is None or current[1] != IfMatch)):
+                self.conflicts += 1
+                raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+            self.versions += 1
+            self.objects[Key] = (Body, f'"{self.versions}"')
+        return {}
+
+    def data(self, key):
+        return json.loads(self.objects[key][0])
+
+
+class UpdateJsonObjectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(upload_to_allas, "_upload_config", {"bucket": "state", "object_key": "data-ALLAS.json"}),
+            # No backoff between attempts
+            mock.patch.object(upload_to_allas.random, "uniform", return_value=0),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def use(self, client):
+        patch = mock.patch.object(upload_to_allas, "_s3_client", client)
+        patch.start()
+        self.patches.append(patch)
+
+    def test_creates_new_object(self):
+        client = StubS3()
+        self.use(client)
+
+        result = upload_to_allas.update_json_object("new.json", lambda data: {"created": data is None})
+
+        self.assertEqual(result, {"created": True})
+        self.assertEqual(client.data("new.json"), {"created": True})
+
+    def test_conflicting_writers_retry_and_keep_both_updates(self):
+        # Both writers read the same version before either writes, so one of them must get a conflict and retry
+        barrier = threading.Barrier(2)
+        firstReads = threading.local()
+
+        def after_get():
+            if not getattr(firstReads, "done", False):
+                firstReads.done = True
+                barrier.wait(timeout=5)
+
+        client = StubS3(after_get)
+        client.objects["data-ALLAS.json"] = (b'{"keep": 1}', '"0"')
+        self.use(client)
+
+        results = {}
+
+        def writer(key):
+            results[key] = upload_to_allas.update_state_object(lambda data: dict(data, **{key: True}), silent=True)
+
+        threads = [threading.Thread(target=writer, args=(key,)) for key in ("a", "b")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIsNotNone(results["a"])
+        self.assertIsNotNone(results["b"])
+        self.assertEqual(client.conflicts, 1)
+        self.assertEqual(client.data("data-ALLAS.json"), {"keep": 1, "a": True, "b": True})
+
+    def test_concurrent_writers_lose_no_updates(self):
+        client = StubS3()
+        self.use(client)
+        updatesPerWriter = 50
+
+        failed = []
+
+        def writer(name):
+            for index in range(updatesPerWriter):
+                key = f"{name}-{index}"
+                if upload_to_allas.update_json_object("runs.json", lambda data: {"runs": (data or {}).get("runs", []) + [key]}, silent=True) is None:
+                    failed.append(key)
+
+        # Enough attempts that no writer gives up, so that any missing update is lost by a write that did not see it
+        with mock.patch.object(upload_to_allas, "STATE_UPDATE_ATTEMPTS", 1000):
+            threads = [threading.Thread(target=writer, args=(name,)) for name in ("a", "b", "c")]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(failed, [])
+
+        runs = client.data("runs.json")["runs"]
+        self.assertEqual(len(runs), 3 * updatesPerWriter)
+        self.assertEqual(set(runs), {f"{name}-{index}" for name in ("a", "b", "c") for index in range(updatesPerWriter)})
+
+    def test_gives_up_after_attempts(self):
+        client = StubS3()
+        client.objects["busy.json"] = (b'{"version": 0}', '"0"')
+
+        def after_get():
+            # Another run writes after every read
+            with client._lock:
+                client.versions += 1
+                client.objects["busy.json"] = (b'{"version": 1}', f'"other-{client.versions}"')
+
+        client.after_get = after_get
+        self.use(client)
+
+        result = upload_to_allas.update_json_object("busy.json", lambda data: dict(data, mine=True), silent=True)
+
+        self.assertIsNone(result)
+        self.assertEqual(client.puts, upload_to_allas.STATE_UPDATE_ATTEMPTS)
+        self.assertEqual(client.conflicts, upload_to_allas.STATE_UPDATE_ATTEMPTS)
+        self.assertNotIn("mine", client.data("busy.json"))
+
+    def test_update_returning_none_writes_nothing(self):
+        client = StubS3()
+        client.objects["shard.json"] = (b'{"owner": "other"}', '"0"')
+        self.use(client)
+
+        self.assertIsNone(upload_to_allas.update_json_object("shard.json", lambda data: None))
+        self.assertEqual(client.puts, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+Tests of the local validation of converted observations (validate_dw.py).
+
+Run from the app directory:
+python -m unittest discover -s tests
+"""
+
+import collections
+import copy
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import inatToDw  # noqa: E402
+import validate_dw  # noqa: E402
+from observations import observation  # noqa: E402
+
+
+def convert(inat):
+    """Convert one observation without private data, and return its root and the validation counts of the conversion."""
+    validate_dw.take_counts()
+    roots = inatToDw.convertObservations([inat], {}, {})[0]["roots"]
+    return roots, validate_dw.take_counts()
+
+
+class ValidateTest(unittest.TestCase):
+
+    def test_normal_observation_passes_unchanged(self):
+        roots, counts = convert(observation())
+
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(counts, collections.Counter(checked=1))
+
+        root = copy.deepcopy(roots[0])
+        self.assertTrue(validate_dw.validate_root(root))
+        self.assertEqual(root, roots[0])
+        self.assertEqual(validate_dw.take_counts(), collections.Counter(checked=1))
+
+    def test_blank_fact_values_are_kept(self):
+        # Missing time_observed_at and species_guess give facts without a value
+        roots, counts = convert(observation(time_observed_at=None, species_guess=None, description=None))
+
+        self.assertEqual(counts, collections.Counter(checked=1))
+        facts = [fact for fact in roots[0]["publicDocument"]["facts"] if fact["value"] is None]
+        self.assertTrue(facts)
+
+    def test_non_finite_fact_value_is_removed(self):
+        root = convert(observation())[0][0]
+        root["publicDocument"]["facts"].append({"fact": "broken", "value": float("nan")})
+
+        self.assertTrue(validate_dw.validate_root(root))
+        self.assertNotIn("broken", [fact["fact"] for fact in root["publicDocument"]["facts"]])
+        self.assertEqual(validate_dw.take_counts()["fact_invalid"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,8 @@
 # Script that loads two data files, and outputs identifiers that exist in finbif-file but not in the inat-file.
+#
+# Identifiers are handled as int64: the inat-file ids are held in a single sorted NumPy array (8 bytes per id instead of a Python string in a set), and the finbif-file is streamed in chunks, tested against the array with a vectorised binary search, and missing ids are written to the output file as they are found.
 
+import numpy as np
 import pandas as pd
 
 finbif_file = "../privatedata/occurrences.txt"
@@ -9,36 +12,83 @@ output_file = "../privatedata/ids_to_be_deleted.csv"
 # Prefix to remove from finbif identifiers
 PREFIX_TO_REMOVE = "http://tun.fi/HR.3211/"
 
+chunk_size = 100000
+
+
+def load_sorted_ids(file_path):
+    """Load observation ids from the iNat data dump into a sorted int64 array.
+
+    Args:
+        file_path (str): Path to the iNat observations CSV file
+
+    Returns:
+        numpy.ndarray: Sorted, unique int64 ids
+    """
+    parts = []
+    with pd.read_csv(file_path, sep=',', usecols=['id'], dtype={'id': 'Int64'}, chunksize=chunk_size) as reader:
+        for chunk in reader:
+            parts.append(chunk['id'].dropna().to_numpy(dtype=np.int64))
+
+    if not parts:
+        return np.empty(0, dtype=np.int64)
+
+    ids = np.concatenate(parts)
+    del parts
+    ids.sort(kind='stable')
+    return np.unique(ids)
+
+
+def is_member(sorted_ids, values):
+    """Vectorised membership test of values against a sorted id array.
+
+    Args:
+        sorted_ids (numpy.ndarray): Sorted int64 ids
+        values (numpy.ndarray): int64 values to test
+
+    Returns:
+        numpy.ndarray: Boolean mask, True where value exists in sorted_ids
+    """
+    if len(sorted_ids) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(sorted_ids, values)
+    positions[positions == len(sorted_ids)] = 0
+    return sorted_ids[positions] == values
+
+
 print("Loading identifiers from inat_file...")
-# Load all identifiers from inat_file into a set for fast lookup
-inat_df = pd.read_csv(inat_file, sep=',', usecols=['id'])
-inat_ids = set(inat_df['id'].astype(str).dropna())
-print(f"Loaded {len(inat_ids)} identifiers from inat_file")
+inat_ids = load_sorted_ids(inat_file)
+print(f"Loaded {len(inat_ids):,} identifiers from inat_file ({inat_ids.nbytes / 1024 / 1024:.1f} MB)")
 
 print("Processing finbif_file in chunks...")
-# Process finbif_file in chunks to handle large files efficiently
-chunk_size = 100000
-ids_to_delete = []
+missing_count = 0
+skipped_count = 0
+rows_processed = 0
+
+with open(output_file, 'w') as output, \
+        pd.read_csv(finbif_file, sep='\t', usecols=['parentEventID'], dtype={'parentEventID': str}, chunksize=chunk_size, skiprows=[1, 2]) as reader:
+    output.write("id\n")
 
-with pd.read_csv(finbif_file, sep='\t', usecols=['parentEventID'], chunksize=chunk_size, skiprows=[1, 2]) as reader:
     for chunk_num, chunk in enumerate(reader):
-        # Extract identifiers and remove prefix
-        chunk_ids = chunk['parentEventID'].astype(str).dropna()
-        # Remove the prefix from each identifier
-        chunk_ids = chunk_ids.str.replace(PREFIX_TO_REMOVE, '', regex=False)
-        
+        rows_processed += len(chunk)
+
+        # Remove the prefix from each identifier and parse the remaining id as integer
+        chunk_ids = chunk['parentEventID'].dropna()
+        chunk_ids = chunk_ids.str.removeprefix(PREFIX_TO_REMOVE)
+        numeric_ids = pd.to_numeric(chunk_ids, errors='coerce')
+        skipped_count += int(numeric_ids.isna().sum())
+        numeric_ids = numeric_ids.dropna().to_numpy(dtype=np.int64)
+
         # Find identifiers that exist in finbif but not in inat
-        missing_ids = chunk_ids[~chunk_ids.isin(inat_ids)]
-        ids_to_delete.extend(missing_ids.tolist())
-        
-        if (chunk_num + 1) % 10 == 0:
-            print(f"Processed {(chunk_num + 1) * chunk_size:,} rows, found {len(ids_to_delete):,} missing identifiers so far")
+        missing_ids = numeric_ids[~is_member(inat_ids, numeric_ids)]
+        if len(missing_ids):
+            np.savetxt(output, missing_ids, fmt='%d')
+            missing_count += len(missing_ids)
 
-print(f"\nTotal identifiers to delete: {len(ids_to_delete):,}")
+        if (chunk_num + 1) % 10 == 0:
+            print(f"Processed {rows_processed:,} rows, found {missing_count:,} missing identifiers so far")
 
-# Write results to CSV
-print(f"Writing results to {output_file}...")
-output_df = pd.DataFrame({'id': ids_to_delete})
-output_df.to_csv(output_file, index=False)
+if skipped_count:
+    print(f"Skipped {skipped_count:,} identifiers that were not numeric after removing the prefix")
 
+print(f"\nTotal identifiers to delete: {missing_count:,}")
 print(f"Done! Results written to {output_file}")
@@ -1,26 +1,123 @@
 '''
-Extracts observations for Zootoca vivipara from iNaturalist data export.
+Extracts observations of one or more taxa from iNaturalist data export in a single pass.
+
+Taxa are given as scientific names or iNat taxon ids. The export is read in chunks, and rows of each taxon are appended to a file of their own, e.g. ../privatedata/extracted_Bubo_scandiacus.csv or ../privatedata/extracted_taxon_12345.csv.
+
+Usage:
+python extract_taxa.py "Falco rusticolus" "Bubo scandiacus" 4647
 '''
 
+import argparse
+import os
+
 import pandas as pd
 
-scientific_name = 'Falco rusticolus'
-scientific_name = 'Bubo scandiacus'
+DEFAULT_INPUT = '../privatedata/inaturalist-suomi-20-observations.csv'
+DEFAULT_OUTPUT_DIR = '../privatedata'
+
+
+def parse_taxa(taxa):
+    """Split taxon arguments into scientific names and taxon ids.
+
+    Args:
+        taxa (list): Scientific names and/or numeric taxon ids
+
+    Returns:
+        tuple: (set of scientific names, set of taxon ids as strings)
+    """
+    names = set()
+    taxon_ids = set()
+    for taxon in taxa:
+        taxon = taxon.strip()
+        if taxon.isdigit():
+            taxon_ids.add(taxon)
+        elif taxon:
+            names.add(taxon)
+    return names, taxon_ids
+
+
+def output_path(output_dir, column, value):
+    """Get the path of the extracted file of one taxon.
+
+    Args:
+        output_dir (str): Directory for the extracted files
+        column (str): Column the taxon is matched on, 'taxon_id' or 'scientific_name'
+        value (str): Taxon id or scientific name
+
+    Returns:
+        str: Path of the CSV file
+    """
+    if column == 'taxon_id':
+        return os.path.join(output_dir, f'extracted_taxon_{value}.csv')
+    return os.path.join(output_dir, f'extracted_{value.replace(" ", "_")}.csv')
+
+
+def extract(input_file, output_dir, names, taxon_ids, chunk_size):
+    """Stream the data export once and route matching rows to per-taxon files.
+
+    Args:
+        input_file (str): Path to the iNat observations CSV file
+        output_dir (str): Directory for the extracted files
+        names (set): Scientific names to extract
+        taxon_ids (set): Taxon ids (as strings) to extract
+        chunk_size (int): Rows per chunk
+
+    Returns:
+        dict: Output file path -> number of rows written
+    """
+    # Column to match, and the set of values to match against it
+    matchers = []
+    if names:
+        matchers.append(('scientific_name', names))
+    if taxon_ids:
+        matchers.append(('taxon_id', taxon_ids))
+
+    counts = {output_path(output_dir, column, value): 0 for column, values in matchers for value in values}
+    rows_read = 0
+
+    # Read everything as strings, so that values are written out exactly as they are in the export
+    with pd.read_csv(input_file, dtype=str, keep_default_na=False, chunksize=chunk_size) as reader:
+        for chunk in reader:
+            rows_read += len(chunk)
+
+            for column, values in matchers:
+                if column not in chunk.columns:
+                    raise ValueError(f"Column '{column}' not found in {input_file}")
+
+                matches = chunk[chunk[column].isin(values)]
+                for value, rows in matches.groupby(column, sort=False):
+                    path = output_path(output_dir, column, value)
+                    rows.to_csv(path, index=False, mode='a' if counts[path] else 'w', header=(counts[path] == 0))
+                    counts[path] += len(rows)
+
+            print(f"Processed {rows_read:,} rows, {sum(counts.values()):,} rows extracted")
+
+    return counts
+
 
-print("Loading datafile")
+def main():
+    parser = argparse.ArgumentParser(description='Extract observations of one or more taxa from iNaturalist data export.')
+    parser.add_argument('taxa', nargs='+', help='Scientific names or iNat taxon ids')
+    parser.add_argument('--input', default=DEFAULT_INPUT, help='iNat observations CSV file')
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR, help='Directory for the extracted files')
+    parser.add_argument('--chunk-size', type=int, default=200000, help='Rows per chunk')
+    args = parser.parse_args()
 
-# Load the CSV file
-file_path = '../privatedata/inaturalist-suomi-20-observations.csv'
+    names, taxon_ids = parse_taxa(args.taxa)
+    if not names and not taxon_ids:
+        parser.error('No taxa given')
 
-df = pd.read_csv(file_path)
-print("Datafile loaded")
+    print(f"Extracting {len(names) + len(taxon_ids)} taxa from {args.input}")
+    counts = extract(args.input, args.output_dir, names, taxon_ids, args.chunk_size)
 
-filtered_df = df[df['scientific_name'] == scientific_name]
-print(f"Filtered: {len(filtered_df)} rows found")
+    for path, count in counts.items():
+        if count:
+            print(f"{count:,} rows saved as {path}")
+        else:
+            print(f"No rows found for {path}")
 
-# Save to new CSV file with all original columns
-output_file_path = f'../privatedata/extracted_{scientific_name.replace(" ", "_")}.csv'
-filtered_df.to_csv(output_file_path, index=False)
+    print("All done")
 
-print(f"All done, file saved as {output_file_path}")
 
+if __name__ == '__main__':
+    main()
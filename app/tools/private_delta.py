@@ -0,0 +1,119 @@
+'''
+Makes and applies deltas of the private observation data file (latest-ALLAS.tsv), so that refreshing the private data moves only the changed rows.
+
+A delta has the rows that were added or changed (op "upsert") and the ids that were removed (op "remove") between two versions of the file, and a header line with the version it was made from and the version it leads to. The version of a private data file is on its first line, written by simplify.py.
+
+Usage:
+python private_delta.py diff ../privatedata/latest-ALLAS-old.tsv ../privatedata/latest-ALLAS.tsv ../privatedata/latest-ALLAS-delta.tsv
+python private_delta.py apply ../privatedata/latest-ALLAS.tsv ../privatedata/latest-ALLAS-delta.tsv
+
+Upload the delta to Allas as ALLAS_OBJECT_KEY_DELTA. inat.py and single.py apply it to the private data when loading it, and the daemon applies it in place when it changes. Deltas should be made from the file that is in Allas, so that they stay small as long as that file is not replaced. To replace the file, apply the delta to it and upload the result, and then remove the delta or make the next delta from the new file.
+'''
+
+import argparse
+import os
+
+import pandas as pd
+
+VERSION_PREFIX = '# version '
+DELTA_PREFIX = '# private-delta '
+
+
+def read_header(file_path, prefix):
+    """Read a header line, returning the values after the prefix, or None if the file has no such header line."""
+    with open(file_path, 'r') as file:
+        first_line = file.readline().rstrip('\n')
+    if first_line.startswith(prefix):
+        return first_line[len(prefix):].split()
+    return None
+
+
+def read_private_file(file_path):
+    """Read a private data file as strings, so that unchanged values compare equal.
+
+    Returns:
+        tuple: (version, DataFrame indexed by id)
+    """
+    header = read_header(file_path, VERSION_PREFIX)
+    if not header:
+        raise ValueError(f"{file_path} has no version line, make it again with simplify.py")
+
+    df = pd.read_csv(file_path, sep='\t', skiprows=1, dtype=str, keep_default_na=False)
+    df = df[df['id'] != '']
+    return header[0], df.set_index('id', drop=False)
+
+
+def write_file(file_path, header_line, df):
+    """Write a TSV file with a header line, through a temporary file."""
+    temp_file_path = file_path + '.tmp'
+    with open(temp_file_path, 'w') as file:
+        file.write(header_line + '\n')
+        df.to_csv(file, sep='\t', index=False)
+    os.replace(temp_file_path, file_path)
+
+
+def diff(old_file_path, new_file_path, delta_file_path):
+    old_version, old = read_private_file(old_file_path)
+    new_version, new = read_private_file(new_file_path)
+    if old_version == new_version:
+        raise ValueError(f"Both files are version {old_version}")
+    if list(old.columns) != list(new.columns):
+        raise ValueError("Files have different columns")
+
+    removed_ids = old.index.difference(new.index)
+
+    # Rows that are new, or differ in any column from the old file
+    common_ids = new.index.intersection(old.index)
+    changed = (new.loc[common_ids] != old.loc[common_ids, new.columns]).any(axis=1)
+    upsert_ids = new.index.difference(old.index).append(common_ids[changed.to_numpy()])
+
+    upserts = new.loc[upsert_ids]
+    removals = pd.DataFrame({column: '' for column in new.columns}, index=removed_ids)
+    removals['id'] = removed_ids
+
+    delta = pd.concat([upserts, removals])
+    delta.insert(0, 'op', ['upsert'] * len(upserts.index) + ['remove'] * len(removals.index))
+
+    write_file(delta_file_path, f"{DELTA_PREFIX}{old_version} {new_version}", delta)
+    print(f"Delta {old_version} -> {new_version}: {len(upserts.index):,} upserts, {len(removals.index):,} removals, saved as {delta_file_path}")
+
+
+def apply(file_path, delta_file_path):
+    version, df = read_private_file(file_path)
+
+    header = read_header(delta_file_path, DELTA_PREFIX)
+    if not header or len(header) != 2:
+        raise ValueError(f"{delta_file_path} is not a delta file")
+    from_version, to_version = header
+    if version != from_version:
+        raise ValueError(f"Delta is from version {from_version}, but {file_path} is version {version}")
+
+    delta = pd.read_csv(delta_file_path, sep='\t', skiprows=1, dtype=str, keep_default_na=False).set_index('id', drop=False)
+    upserts = delta[delta['op'] == 'upsert'].drop(columns='op')
+
+    df = df.drop(index=delta.index, errors='ignore')
+    df = pd.concat([df, upserts[df.columns]])
+    df = df.sort_index(key=lambda ids: ids.astype('int64'))
+
+    write_file(file_path, f"{VERSION_PREFIX}{to_version}", df)
+    print(f"Applied delta {from_version} -> {to_version} to {file_path}, {len(df.index):,} rows")
+
+
+parser = argparse.ArgumentParser(description='Make and apply deltas of the private observation data file.')
+subparsers = parser.add_subparsers(dest='command', required=True)
+
+diff_parser = subparsers.add_parser('diff', help='Make a delta between two versions of the file')
+diff_parser.add_argument('old')
+diff_parser.add_argument('new')
+diff_parser.add_argument('delta')
+
+apply_parser = subparsers.add_parser('apply', help='Apply a delta to the file in place')
+apply_parser.add_argument('file')
+apply_parser.add_argument('delta')
+
+args = parser.parse_args()
+
+if args.command == 'diff':
+    diff(args.old, args.new, args.delta)
+else:
+    apply(args.file, args.delta)
@@ -1,45 +1,85 @@
 '''
 2023-12-05
 This script takes raw iNaturalist data export observation file, and converts it into format that can be used by synchronization scrips. It removes unnecessary rows and columns.
+
+The file is read in chunks with only the needed columns and explicit dtypes, and each filtered chunk is appended to the output, so peak memory depends on chunk size and not on the size of the data export.
 '''
 
-import pandas as pd
+import datetime
+import os
 
-print("Loading datafile")
+import pandas as pd
 
-# Load the CSV file
 file_path = '../privatedata/inaturalist-suomi-20-observations.csv'
+output_file_path = '../privatedata/latest-ALLAS.tsv'
 
-df = pd.read_csv(file_path)
-print("Datafile loaded")
-
-# Filtering the DataFrame
-filtered_df = df[
-    (df['coordinates_obscured'] == True) & 
-    ((df['place_country_name'] == 'Finland') | (df['place_country_name'] == 'Åland')) &
-    (df['private_latitude'].notna())
-]
-print("Filtered")
+chunk_size = 200000
 
-# Selecting specific columns
+# Columns written to the output file, in this order
 selected_columns = [
     'id',
     'observed_on',
     'positional_accuracy',
-    'private_place_guess', 
+    'private_place_guess',
     'private_latitude',
     'private_longitude'
 ]
 
-filtered_selected_df = filtered_df[selected_columns]
-print("Columns selected")
+# Columns needed only for filtering
+filter_columns = [
+    'coordinates_obscured',
+    'place_country_name',
+]
 
-# Replacing semicolons with commas
-filtered_selected_df_replaced = filtered_selected_df.replace(to_replace=';', value=',', regex=True)
-print("Replacements done")
+dtypes = {
+    'id': 'int64',
+    'observed_on': 'string',
+    'positional_accuracy': 'float64',
+    'private_place_guess': 'string',
+    'private_latitude': 'float64',
+    'private_longitude': 'float64',
+    'coordinates_obscured': 'boolean',
+    'place_country_name': 'string',
+}
 
-# Save as TSV file
-output_file_path = '../privatedata/latest-ALLAS.tsv'
-filtered_selected_df_replaced.to_csv(output_file_path, sep='	', index=False)
+# Version of the private data, written on the first line of the file. Used by private_delta.py and inatHelpers.py to check that a delta applies to the file.
+version = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+# Write to a temporary file first, so that an interrupted run does not leave a partial file in place of the old one
+temp_output_file_path = output_file_path + '.tmp'
+
+print("Processing datafile in chunks")
+
+rows_read = 0
+rows_written = 0
+
+with open(temp_output_file_path, 'w') as file:
+    file.write(f"# version {version}\n")
+
+with pd.read_csv(file_path, usecols=selected_columns + filter_columns, dtype=dtypes, chunksize=chunk_size) as reader:
+    for chunk_num, df in enumerate(reader):
+        rows_read += len(df)
+
+        # Filtering the DataFrame
+        filtered_df = df[
+            df['coordinates_obscured'].fillna(False) &
+            df['place_country_name'].isin(['Finland', 'Åland']) &
+            (df['private_latitude'].notna())
+        ]
+
+        # Selecting specific columns
+        filtered_selected_df = filtered_df[selected_columns].copy()
+
+        # Replacing semicolons with commas. Only text columns can contain them.
+        for column in ['observed_on', 'private_place_guess']:
+            filtered_selected_df[column] = filtered_selected_df[column].str.replace(';', ',', regex=False)
+
+        # Append as TSV, header only with the first chunk
+        filtered_selected_df.to_csv(temp_output_file_path, sep='	', index=False, mode='a', header=(chunk_num == 0))
+        rows_written += len(filtered_selected_df)
+
+        print(f"Processed {rows_read:,} rows, {rows_written:,} rows written")
+
+os.replace(temp_output_file_path, output_file_path)
 
-print(f"All done, file saved as {output_file_path}")
+print(f"All done, file saved as {output_file_path}, version {version}")
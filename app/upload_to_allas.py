@@ -4,11 +4,20 @@ Uploads the JSON state file to Allas S3 object storage.
 This module provides functions to sync the state file back to Allas after each write.
 """
 
+import json
 import os
+import random
 import sys
+import time
 import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
 
+# Attempts to update the state object when other runs change it at the same time
+STATE_UPDATE_ATTEMPTS = 8
+
+# Error codes of a failed conditional write
+CONFLICT_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+
 # Global S3 client (initialized once)
 _s3_client = None
 _upload_config = None
@@ -85,3 +94,128 @@ def upload_state_file(local_file_path='./store/data-ALLAS.json', silent=False):
         if not silent:
             print(f"Error: Unexpected error during upload: {str(e)}", file=sys.stderr)
         return False
+
+
+def update_json_object(object_key, update, silent=False):
+    """Update a JSON object in the Allas state bucket with compare-and-swap, so that concurrent runs do not overwrite each other's changes.
+
+    The object is read with its ETag, update(data) is applied, and the result is written only if the object has not changed in between (If-Match, or If-None-Match for a new object). On a conflict the update is applied again to the latest object.
+
+    Args:
+        object_key (str): Object key in the state bucket
+        update (callable): Gets the current data (dict, or None if the object does not exist) and returns the new data, or None to leave the object as it is
+        silent (bool): If True, suppress error messages
+
+    Returns:
+        dict: Data that was written, or None if update returned None or the update failed
+    """
+    try:
+        s3_client = _get_s3_client()
+        bucket = _upload_config['bucket']
+
+        for attempt in range(1, STATE_UPDATE_ATTEMPTS + 1):
+            try:
+                response = s3_client.get_object(Bucket=bucket, Key=object_key)
+                data = json.loads(response['Body'].read())
+                condition = {'IfMatch': response['ETag']}
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                    raise
+                data = None
+                condition = {'IfNoneMatch': '*'}
+
+            data = update(data)
+            if data is None:
+                return None
+            try:
+                s3_client.put_object(Bucket=bucket, Key=object_key, Body=json.dumps(data, indent=4).encode('utf-8'), ContentType='application/json', **condition)
+                return data
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in CONFLICT_ERROR_CODES:
+                    raise
+                if not silent:
+                    print(f"{object_key} changed in Allas during update, retrying ({attempt}/{STATE_UPDATE_ATTEMPTS})", file=sys.stderr)
+                time.sleep(random.uniform(0, 0.2 * attempt))
+
+        if not silent:
+            print(f"Error: {object_key} in Allas kept changing, gave up after {STATE_UPDATE_ATTEMPTS} attempts", file=sys.stderr)
+        return None
+
+    except Exception as e:
+        if not silent:
+            print(f"Error: Failed to update {object_key} in Allas: {str(e)}", file=sys.stderr)
+        return None
+
+
+def update_state_object(update, silent=False):
+    """Update the JSON state file in Allas with compare-and-swap, see update_json_object().
+
+    Args:
+        update (callable): Gets the current state (dict) and returns the new state
+        silent (bool): If True, suppress error messages
+
+    Returns:
+        dict: State that was written, or None if the update failed
+    """
+    try:
+        _get_s3_client()
+    except Exception as e:
+        if not silent:
+            print(f"Error: Failed to update state file in Allas: {str(e)}", file=sys.stderr)
+        return None
+    return update_json_object(_upload_config['object_key'], lambda data: update(data or {}), silent=silent)
+
+
+def upload_object(local_file_path, object_key, silent=False):
+    """Upload a file to the Allas state bucket under the given object key.
+
+    Used for other state than the JSON state file, e.g. the registry of pushed observation ids.
+
+    Args:
+        local_file_path (str): Path to the local file to upload
+        object_key (str): Object key in the state bucket
+        silent (bool): If True, suppress error messages
+
+    Returns:
+        bool: True if upload succeeded, False otherwise
+    """
+    try:
+        s3_client = _get_s3_client()
+
+        if not os.path.exists(local_file_path):
+            if not silent:
+                print(f"Warning: File {local_file_path} does not exist, skipping upload", file=sys.stderr)
+            return False
+
+        s3_client.upload_file(local_file_path, _upload_config['bucket'], object_key)
+        if not silent:
+            print(f"File uploaded to Allas: {object_key}")
+        return True
+
+    except Exception as e:
+        if not silent:
+            print(f"Error: Failed to upload {object_key} to Allas: {str(e)}", file=sys.stderr)
+        return False
+
+
+def delete_object(object_key, silent=False):
+    """Delete an object from the Allas state bucket.
+
+    Args:
+        object_key (str): Object key in the state bucket
+        silent (bool): If True, suppress error messages
+
+    Returns:
+        bool: True if delete succeeded, False otherwise
+    """
+    try:
+        s3_client = _get_s3_client()
+        s3_client.delete_object(Bucket=_upload_config['bucket'], Key=object_key)
+        if not silent:
+            print(f"Deleted from Allas: {object_key}")
+        return True
+
+    except Exception as e:
+        if not silent:
+            print(f"Error: Failed to delete {object_key} from Allas: {str(e)}", file=sys.stderr)
+        return False
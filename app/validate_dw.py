@@ -0,0 +1,220 @@
+"""
+Local validation of converted observations before they are posted to the DW.
+
+The DW rejects a whole batch if one document is malformed, and this is found out only after the upload. validate_root() checks the structure that convertObservations() produces (root, document, gathering, unit) against the known DW constraints (see notes in inatToDw.py): keywords must be strings, enums are ALL-CAPS, dates are YYYY-MM-DD, coordinates are finite numbers etc.
+
+Violations that can be fixed without losing meaning are repaired in place (reason codes keyword_not_string, enum_not_uppercase, fact_invalid, coordinates_invalid, accuracy_invalid, media_invalid), and roots with other violations are dropped (root_invalid, document_id_invalid, document_invalid, gathering_invalid, event_date_invalid, unit_invalid, enum_invalid). Each violation is counted by reason code, and take_counts() returns the counts for the run metrics.
+"""
+
+import collections
+import math
+import re
+import threading
+
+import logger
+
+ENUM_PATTERN = re.compile(r"^[A-Z][A-Z0-9_]*$")
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+DOCUMENT_ID_PREFIX = "http://tun.fi/HR.3211/"
+
+CONCEALMENTS = {"PUBLIC", "PRIVATE"}
+RECORD_BASES = {"PRESERVED_SPECIMEN", "HUMAN_OBSERVATION_PHOTO", "HUMAN_OBSERVATION_RECORDED_AUDIO", "HUMAN_OBSERVATION_UNSPECIFIED"}
+
+_lock = threading.Lock()
+_counts = collections.Counter()
+
+
+class Violation(Exception):
+    """Violation that cannot be repaired. The root is dropped."""
+
+    def __init__(self, reason, detail):
+        super().__init__(f"{reason}: {detail}")
+        self.reason = reason
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _check_enum(container, key, allowed, found, required=False):
+    """Check that container[key] is an ALL-CAPS enum value, and in allowed if given. Lowercase values are uppercased."""
+    if isinstance(container, dict) and key not in container:
+        if required:
+            raise Violation("enum_invalid", f"missing {key}")
+        return
+    value = container[key]
+    if not isinstance(value, str):
+        raise Violation("enum_invalid", f"{key} is {type(value).__name__}")
+    if not ENUM_PATTERN.match(value) and ENUM_PATTERN.match(value.upper()):
+        value = value.upper()
+        container[key] = value
+        found.append("enum_not_uppercase")
+    if not ENUM_PATTERN.match(value) or (allowed and value not in allowed):
+        raise Violation("enum_invalid", f"{key} is {value}")
+
+
+def _check_enum_list(container, key, found):
+    values = container.get(key, [])
+    if not isinstance(values, list):
+        raise Violation("enum_invalid", f"{key} is not a list")
+    for index in range(len(values)):
+        _check_enum(values, index, None, found)
+
+
+def _check_facts(container, found):
+    facts = container.get("facts", [])
+    if not isinstance(facts, list):
+        raise Violation("document_invalid", "facts is not a list")
+    # Blank values are accepted by the DW, but NaN and infinity cannot be serialized to JSON
+    valid = [fact for fact in facts if isinstance(fact, dict) and isinstance(fact.get("fact"), str) and fact["fact"] and (fact.get("value") is None or isinstance(fact["value"], (str, bool)) or _is_number(fact["value"]))]
+    if len(valid) != len(facts):
+        container["facts"] = valid
+        found.append("fact_invalid")
+
+
+def _check_coordinates(gathering, found):
+    coordinates = gathering.get("coordinates")
+    if coordinates is None:
+        return
+    valid = isinstance(coordinates, dict) and coordinates.get("type") == "WGS84" and all(_is_number(coordinates.get(key)) for key in ("latMin", "latMax", "lonMin", "lonMax"))
+    if valid:
+        valid = -90 <= coordinates["latMin"] <= coordinates["latMax"] <= 90 and -180 <= coordinates["lonMin"] <= coordinates["lonMax"] <= 180
+    if not valid:
+        del gathering["coordinates"]
+        found.append("coordinates_invalid")
+        return
+    if "accuracyInMeters" in coordinates and not (_is_number(coordinates["accuracyInMeters"]) and coordinates["accuracyInMeters"] > 0):
+        del coordinates["accuracyInMeters"]
+        found.append("accuracy_invalid")
+
+
+def _check_unit(unit, found):
+    if not isinstance(unit, dict) or not isinstance(unit.get("unitId"), str) or not isinstance(unit.get("taxonVerbatim", ""), str):
+        raise Violation("unit_invalid", "unitId or taxonVerbatim missing")
+
+    _check_enum(unit, "recordBasis", RECORD_BASES, found, required=True)
+    _check_enum(unit, "lifeStage", None, found)
+    _check_enum(unit, "sex", None, found)
+    _check_enum_list(unit, "sourceTags", found)
+    for key in ("wild", "dead"):
+        if key in unit and not isinstance(unit[key], bool):
+            raise Violation("unit_invalid", f"{key} is not boolean")
+
+    media = unit.get("media")
+    if media is not None:
+        valid = [item for item in media if isinstance(item, dict) and isinstance(item.get("fullURL"), str) and item["fullURL"]] if isinstance(media, list) else []
+        if len(valid) != (len(media) if isinstance(media, list) else -1):
+            unit["media"] = valid
+            found.append("media_invalid")
+
+    _check_facts(unit, found)
+
+
+def _check_gathering(gathering, found):
+    if not isinstance(gathering, dict):
+        raise Violation("gathering_invalid", "gathering is not an object")
+
+    event_date = gathering.get("eventDate")
+    if not isinstance(event_date, dict) or not all(isinstance(event_date.get(key), str) and DATE_PATTERN.match(event_date[key]) for key in ("begin", "end")):
+        raise Violation("event_date_invalid", str(event_date))
+
+    _check_coordinates(gathering, found)
+    _check_facts(gathering, found)
+
+    units = gathering.get("units")
+    if not isinstance(units, list) or not units:
+        raise Violation("gathering_invalid", "no units")
+    for unit in units:
+        _check_unit(unit, found)
+
+
+def _check_document(document, document_id, found):
+    if not isinstance(document, dict) or document.get("documentId") != document_id:
+        raise Violation("document_invalid", "documentId differs from root")
+
+    _check_enum(document, "secureLevel", None, found, required=True)
+    _check_enum(document, "concealment", CONCEALMENTS, found, required=True)
+    _check_enum_list(document, "secureReasons", found)
+
+    keywords = document.get("keywords", [])
+    if not isinstance(keywords, list):
+        raise Violation("document_invalid", "keywords is not a list")
+    if not all(isinstance(keyword, str) for keyword in keywords):
+        document["keywords"] = [str(keyword) for keyword in keywords if keyword is not None]
+        found.append("keyword_not_string")
+
+    _check_facts(document, found)
+
+    gatherings = document.get("gatherings")
+    if not isinstance(gatherings, list) or not gatherings:
+        raise Violation("gathering_invalid", "no gatherings")
+    for gathering in gatherings:
+        _check_gathering(gathering, found)
+
+
+def validate_root(root):
+    """Validate a converted observation, repairing it in place where possible.
+
+    Args:
+        root (dict): Root of one observation in DW format, from convertObservations()
+
+    Returns:
+        bool: True if the root can be posted, False if it should be dropped
+    """
+    found = []
+    try:
+        if not isinstance(root, dict) or root.get("schema") != "laji-etl" or not isinstance(root.get("collectionId"), str):
+            raise Violation("root_invalid", "schema or collectionId missing")
+
+        document_id = root.get("documentId")
+        if not isinstance(document_id, str) or not document_id.startswith(DOCUMENT_ID_PREFIX):
+            raise Violation("document_id_invalid", str(document_id))
+
+        _check_document(root.get("publicDocument"), document_id, found)
+        if "privateDocument" in root:
+            _check_document(root["privateDocument"], document_id, found)
+    except Violation as e:
+        found.append(e.reason)
+        logger.log_minimal(f"Dropped invalid document {root.get('documentId') if isinstance(root, dict) else root}: {str(e)}")
+        valid = False
+    else:
+        valid = True
+        if found:
+            logger.log_record("validate", "Repaired document %s: %s", root["documentId"], ", ".join(found))
+
+    with _lock:
+        _counts["checked"] += 1
+        _counts.update(found)
+        if not valid:
+            _counts["dropped"] += 1
+
+    return valid
+
+
+def take_counts():
+    """Return validation counts since the previous call, and reset them.
+
+    Returns:
+        collections.Counter: Number of checked and dropped roots, and violations by reason code
+    """
+    global _counts
+    with _lock:
+        counts = _counts
+        _counts = collections.Counter()
+    return counts
+
+
+def add_counts(counts):
+    """Add counts that were taken in another process, e.g. in a worker of mirror.py reconvert."""
+    with _lock:
+        _counts.update(counts)
+
+
+def log_counts():
+    """Log validation counts since the previous call, if there were violations."""
+    counts = take_counts()
+    violations = {reason: count for reason, count in counts.items() if reason not in ("checked", "dropped")}
+    if violations:
+        logger.log_minimal(f"Validated {counts['checked']} documents, dropped {counts['dropped']}, violations: " + ", ".join(f"{reason} {count}" for reason, count in sorted(violations.items())))
+    return counts